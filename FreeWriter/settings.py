@@ -52,6 +52,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',  # Add after SecurityMiddleware
+    'bookapp.querycount.QueryCountMiddleware',
+    'bookapp.routers.ReplicaMiddleware',  # Before anything that writes, sessions included
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -90,9 +92,58 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Seconds a connection is reused across requests, 0 opens one per request
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 300)),
     }
 }
 
+# Read replicas for the catalog views, comma separated SQLite files kept in
+# sync with the primary by a replication tool or manage.py sync_replicas.
+# After a write a client reads from the primary for REPLICA_STICKY_SECONDS,
+# which should exceed the replicas' worst lag (bookapp.routers)
+REPLICA_DATABASES = []
+for number, path in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(','))):
+    REPLICA_DATABASES.append(f'replica{number}')
+    DATABASES[f'replica{number}'] = {**DATABASES['default'], 'NAME': path.strip(), 'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['bookapp.routers.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+# Most queries a view may run with a cold cache, by URL name. Requests over
+# budget are logged as warnings and fail HotViewQueryTests
+QUERY_BUDGETS = {
+    'home': 10,
+    'all_books': 10,
+    'category_detail': 10,
+    'book_detail': 15,
+    'book_reviews': 6,
+    'book_search': 10,
+    'dashboard': 12,
+    'newsletter_subscribe': 6,
+}
+
+# PRAGMAs applied to each SQLite connection by bookapp.sqlite: 'production'
+# for WAL, mmap and a busy timeout so gunicorn workers can write side by
+# side, 'default' to leave SQLite as it is
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'production')
+
+
+# Cache
+# Shared between gunicorn workers so catalog invalidation reaches all of them
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(BASE_DIR, 'cache')),
+    }
+}
+
+# Cached catalog fragments are keyed by catalog version, this only bounds staleness
+CATALOG_CACHE_TIMEOUT = int(os.environ.get('CATALOG_CACHE_TIMEOUT', 60 * 60))
+
+# Book vectors of the last similar books build, kept out of the cache so
+# they are never culled; incremental indexing rebuilds everything without them
+SIMILARITY_VECTORS_FILE = os.environ.get('SIMILARITY_VECTORS_FILE', os.path.join(BASE_DIR, 'data', 'similarity_vectors.npz'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -136,6 +187,19 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Protected media (book PDFs) is served by bookapp.delivery. To offload the
+# transfer to the front server set MEDIA_ACCEL_REDIRECT_PREFIX to an nginx
+# internal location aliasing MEDIA_ROOT, or MEDIA_SENDFILE_HEADER to
+# X-Sendfile for Apache/lighttpd
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get('MEDIA_ACCEL_REDIRECT_PREFIX', '')
+MEDIA_SENDFILE_HEADER = os.environ.get('MEDIA_SENDFILE_HEADER', '')
+MEDIA_CACHE_MAX_AGE = int(os.environ.get('MEDIA_CACHE_MAX_AGE', 60 * 60))
+
+# Partial chunked uploads (bookapp.uploads). Keep this on the same
+# filesystem as MEDIA_ROOT so finished files are moved, not copied
+CHUNKED_UPLOAD_DIR = os.environ.get('CHUNKED_UPLOAD_DIR', os.path.join(BASE_DIR, 'uploads'))
+CHUNKED_UPLOAD_MAX_SIZE = int(os.environ.get('CHUNKED_UPLOAD_MAX_SIZE', 200 * 1024 * 1024))
+
 # WhiteNoise configuration for static files
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
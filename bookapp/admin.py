@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Category, Book, BookSearch
+from .models import Category, Book, BookSearch, Task
 # Register your models here.
 
 class CategoryAdmin(admin.ModelAdmin):
@@ -7,6 +7,11 @@ class CategoryAdmin(admin.ModelAdmin):
 class BookAdmin(admin.ModelAdmin):
 	prepopulated_fields = {'slug':('title',)}
 
+class TaskAdmin(admin.ModelAdmin):
+	list_display = ('name', 'status', 'priority', 'attempts', 'run_after', 'finished_at')
+	list_filter = ('status', 'name')
+
 admin.site.register(Category, CategoryAdmin)
 admin.site.register(Book, BookAdmin)
 admin.site.register(BookSearch)
+admin.site.register(Task, TaskAdmin)
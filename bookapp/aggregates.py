@@ -0,0 +1,125 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Subquery, Sum
+from .models import AuthorStats, Book, BookRating, BookReview
+
+AUTHOR_STATS_FIELDS = ('book_count', 'rating_sum', 'rating_count', 'review_count')
+
+
+def adjust_book_aggregates(book_id, **deltas):
+    """Apply deltas to a book's stored aggregates and its author's rollup, one UPDATE each"""
+    deltas = {field: delta for field, delta in deltas.items() if delta}
+    if deltas:
+        increments = {field: F(field) + delta for field, delta in deltas.items()}
+        Book.objects.filter(pk=book_id).update(**increments)
+        AuthorStats.objects.filter(
+            author=Subquery(Book.objects.filter(pk=book_id).values('author')[:1])
+        ).update(**increments)
+
+
+def rate_book(user, book, rating):
+    """Create or update a user's rating, keeping the book aggregates in step"""
+    with transaction.atomic():
+        rating_obj = BookRating.objects.select_for_update().filter(user=user, book=book).first()
+        if rating_obj is None:
+            try:
+                with transaction.atomic():
+                    rating_obj = BookRating.objects.create(user=user, book=book, rating=rating)
+                    adjust_book_aggregates(book.pk, rating_sum=rating, rating_count=1)
+                return rating_obj
+            except IntegrityError:
+                # A concurrent first rating won the unique (user, book) row,
+                # and select_for_update does not lock on SQLite
+                rating_obj = BookRating.objects.get(user=user, book=book)
+        if rating_obj.rating != rating:
+            delta = rating - rating_obj.rating
+            rating_obj.rating = rating
+            rating_obj.save(update_fields=['rating', 'updated_at'])
+            adjust_book_aggregates(book.pk, rating_sum=delta)
+    return rating_obj
+
+
+def review_book(user, book, title, content):
+    """Create a review, keeping the book aggregates in step"""
+    with transaction.atomic():
+        review = BookReview.objects.create(user=user, book=book, title=title, content=content)
+        adjust_book_aggregates(book.pk, review_count=1)
+    return review
+
+
+def recompute_book_aggregates(books=None, batch_size=1000):
+    """
+    Recompute stored aggregates from the rating and review tables.
+
+    Totals are gathered with two grouped queries and only books whose
+    stored values drifted are written back. Returns the number of books
+    updated.
+    """
+    if books is None:
+        books = Book.objects.all()
+    ratings = BookRating.objects.filter(book__in=books).order_by()
+    reviews = BookReview.objects.filter(book__in=books).order_by()
+    rating_totals = {
+        row['book']: (row['total'], row['count'])
+        for row in ratings.values('book').annotate(total=Sum('rating'), count=Count('id'))
+    }
+    review_totals = {
+        row['book']: row['count']
+        for row in reviews.values('book').annotate(count=Count('id'))
+    }
+
+    updated = 0
+    stale = []
+    for book in books.only('id', *Book.AGGREGATE_FIELDS).order_by('id').iterator(chunk_size=batch_size):
+        rating_sum, rating_count = rating_totals.get(book.pk, (0, 0))
+        review_count = review_totals.get(book.pk, 0)
+        if (book.rating_sum, book.rating_count, book.review_count) != (rating_sum, rating_count, review_count):
+            book.rating_sum = rating_sum
+            book.rating_count = rating_count
+            book.review_count = review_count
+            stale.append(book)
+        if len(stale) >= batch_size:
+            Book.objects.bulk_update(stale, Book.AGGREGATE_FIELDS)
+            updated += len(stale)
+            stale = []
+    if stale:
+        Book.objects.bulk_update(stale, Book.AGGREGATE_FIELDS)
+        updated += len(stale)
+    return updated
+
+
+def _author_totals(books):
+    return books.order_by().values('author').annotate(
+        book_count=Count('id'),
+        rating_sum=Sum('rating_sum'),
+        rating_count=Sum('rating_count'),
+        review_count=Sum('review_count'),
+    )
+
+
+def refresh_author_stats(*authors):
+    """Recompute the rollup of the given authors from their books' stored aggregates"""
+    authors = {author for author in authors if author is not None}
+    if not authors:
+        return
+    totals = {row['author']: row for row in _author_totals(Book.objects.filter(author__in=authors))}
+    with transaction.atomic():
+        for author in authors:
+            if author in totals:
+                AuthorStats.objects.update_or_create(
+                    author=author,
+                    defaults={field: totals[author][field] for field in AUTHOR_STATS_FIELDS},
+                )
+            else:
+                AuthorStats.objects.filter(author=author).delete()
+
+
+def recompute_author_stats(batch_size=1000):
+    """Rebuild the whole author rollup table, returns the number of authors"""
+    stats = [
+        AuthorStats(author=row['author'], **{field: row[field] for field in AUTHOR_STATS_FIELDS})
+        for row in _author_totals(Book.objects.all())
+    ]
+    with transaction.atomic():
+        AuthorStats.objects.all().delete()
+        AuthorStats.objects.bulk_create(stats, batch_size=batch_size)
+    return len(stats)
@@ -6,3 +6,5 @@ class BookappConfig(AppConfig):
     
     def ready(self):
         import bookapp.signals
+        import bookapp.sqlite
+        import bookapp.jobs
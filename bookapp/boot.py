@@ -0,0 +1,77 @@
+from django.apps import apps
+from django.db import DatabaseError
+from django.db.models import Q
+import django
+import hashlib
+import json
+import os
+
+from .models import BootState, Book
+
+SCHEMA_KEY = 'schema_hash'
+MEDIA_KEY = 'media_manifest:{}'
+MEDIA_FIELDS = ('cover_image', 'pdf')
+
+
+def get_state(key):
+    """The value bootstrap stored under key, None before the first boot"""
+    try:
+        return BootState.objects.filter(key=key).values_list('value', flat=True).first()
+    except DatabaseError:
+        # The table only exists once the migrations have run
+        return None
+
+
+def set_state(key, value):
+    BootState.objects.update_or_create(key=key, defaults={'value': value})
+
+
+def schema_hash():
+    """
+    SHA-256 of every installed migration file and the Django version.
+
+    Reading the files takes milliseconds, while migrate has to import
+    every migration and build the whole graph just to find nothing to do.
+    The hash is stored in the database it describes, so a restored backup
+    or a fresh database brings its own, or none, and is migrated.
+    """
+    digest = hashlib.sha256(django.get_version().encode())
+    for app_config in sorted(apps.get_app_configs(), key=lambda app_config: app_config.label):
+        directory = os.path.join(app_config.path, 'migrations')
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.py'):
+                continue
+            digest.update(f'{app_config.label}/{name}\0'.encode())
+            with open(os.path.join(directory, name), 'rb') as migration:
+                digest.update(migration.read())
+    return digest.hexdigest()
+
+
+def media_manifest(field):
+    """
+    Cheap fingerprint of what reconciling field would look at.
+
+    Adding, removing or renaming a file changes its directory's mtime, and
+    the count of books without a file covers books added since.
+    """
+    model_field = Book._meta.get_field(field)
+    root = model_field.storage.path(model_field.upload_to.strip('/'))
+    try:
+        mtime, entries = os.stat(root).st_mtime_ns, len(os.listdir(root))
+    except FileNotFoundError:
+        mtime = entries = 0
+    missing = Book.objects.filter(Q(**{field: ''}) | Q(**{f'{field}__isnull': True})).count()
+    return json.dumps({'mtime': mtime, 'entries': entries, 'missing': missing}, sort_keys=True)
+
+
+def changed_media_fields():
+    """The fields whose files or books changed since they were last reconciled"""
+    return [field for field in MEDIA_FIELDS if media_manifest(field) != get_state(MEDIA_KEY.format(field))]
+
+
+def record_media_manifests(fields):
+    """Remember the current state of fields, called once they are reconciled"""
+    for field in fields:
+        set_state(MEDIA_KEY.format(field), media_manifest(field))
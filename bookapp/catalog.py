@@ -0,0 +1,158 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+import time
+
+from .models import Book, Category
+from .routers import primary_reads
+from .utils import get_category_icon
+
+CATALOG_VERSION_KEY = 'catalog:version'
+# Moved by recommendation refreshes, which only change the co-rated lists on
+# book pages and so must not invalidate every catalog cache
+RECOMMENDATIONS_VERSION_KEY = 'recommendations:version'
+
+HOME_SECTIONS = ('recommended_books', 'fiction_books', 'business_books')
+HOME_SECTION_SIZE = 12
+HOME_FALLBACK_SIZE = 6
+
+
+def _new_catalog_version():
+    """Catalog versions are microsecond timestamps so they only move forward"""
+    return time.time_ns() // 1000
+
+
+def _store_version(key):
+    cache.set(key, _new_catalog_version(), None)
+
+
+def _get_version(key):
+    version = cache.get(key)
+    if version is None:
+        version = _new_catalog_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def _bump_version(key):
+    # Bumped straight away and again once the surrounding transaction
+    # commits, so no worker can cache pre-commit data under the new version
+    _store_version(key)
+    transaction.on_commit(lambda: _store_version(key))
+
+
+def get_catalog_version():
+    """Return the current catalog version shared by all workers"""
+    return _get_version(CATALOG_VERSION_KEY)
+
+
+def bump_catalog_version():
+    """Invalidate everything cached against the catalog version"""
+    _bump_version(CATALOG_VERSION_KEY)
+
+
+def get_recommendations_version():
+    """Return the version of the co-rated book lists shared by all workers"""
+    return _get_version(RECOMMENDATIONS_VERSION_KEY)
+
+
+def bump_recommendations_version():
+    """Invalidate validators of pages showing co-rated books"""
+    _bump_version(RECOMMENDATIONS_VERSION_KEY)
+
+
+def catalog_cache_key(name, *parts):
+    """Build a cache key that changes whenever the catalog changes"""
+    return ':'.join(['catalog', name, str(get_catalog_version())] + [str(part) for part in parts])
+
+
+_category_links = (None, None)
+
+
+def get_category_links():
+    """
+    Return every category with its icon resolved.
+
+    The list lives in the shared cache under the catalog version and each
+    worker keeps its own copy until the version moves, so a render costs a
+    single version lookup.
+    """
+    global _category_links
+    version = get_catalog_version()
+    cached_version, categories = _category_links
+    if cached_version != version:
+        key = f'catalog:category_links:{version}'
+        categories = cache.get(key)
+        if categories is None:
+            with primary_reads():
+                categories = list(Category.objects.all())
+            for category in categories:
+                category.icon = get_category_icon(category.name)
+            cache.set(key, categories, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60))
+        _category_links = (version, categories)
+    return categories
+
+
+def get_catalog_book_count():
+    """Return the number of books in the catalog, cached per catalog version"""
+    key = catalog_cache_key('book_count')
+    count = cache.get(key)
+    if count is None:
+        with primary_reads():
+            count = Book.objects.count()
+        cache.set(key, count, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60))
+    return count
+
+
+def get_catalog_authors():
+    """Return the distinct author names in the catalog, cached per catalog version"""
+    key = catalog_cache_key('authors')
+    authors = cache.get(key)
+    if authors is None:
+        with primary_reads():
+            authors = list(Book.objects.order_by('author').values_list('author', flat=True).distinct())
+        cache.set(key, authors, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60))
+    return authors
+
+
+def build_home_sections():
+    """
+    Select the books for every home page section.
+
+    Each section reads its newest ids from its own partial index, so a
+    section with few books never walks the whole catalog, then all selected
+    books are loaded with their categories in one prefetched query.
+    """
+    newest = Book.objects.order_by('-created_at', '-id').values_list('id', flat=True)
+    section_ids = {name: list(newest.filter(**{name: True})[:HOME_SECTION_SIZE]) for name in HOME_SECTIONS}
+    latest_ids = list(newest[:HOME_FALLBACK_SIZE])
+
+    # If no specific books are found, show some general books
+    for name, ids in section_ids.items():
+        if not ids:
+            section_ids[name] = latest_ids
+
+    wanted_ids = set().union(*section_ids.values())
+    books = Book.objects.filter(id__in=wanted_ids).prefetch_related('category').in_bulk()
+    for book in books.values():
+        for category in book.category.all():
+            category.icon = get_category_icon(category.name)
+
+    return {
+        name: [books[book_id] for book_id in ids if book_id in books]
+        for name, ids in section_ids.items()
+    }
+
+
+def render_home_sections():
+    """Return the rendered home page sections, cached per catalog version"""
+    key = catalog_cache_key('home_sections')
+    html = cache.get(key)
+    if html is None:
+        # A lagging replica would leave stale books cached under the new version
+        with primary_reads():
+            html = render_to_string('home_sections.html', build_home_sections())
+        cache.set(key, html, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60))
+    return html
@@ -0,0 +1,73 @@
+from datetime import datetime, timezone as dt_timezone
+from functools import wraps
+import hashlib
+
+from django.middleware.csrf import get_token
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .catalog import get_catalog_version, get_recommendations_version
+from .models import Book
+
+
+def viewer_key(request):
+    """Everything about the viewer that changes a rendered catalog page"""
+    # On a first visit the page sets a new CSRF cookie, which the tag has to
+    # match for the client's revalidation to hit; pages render the token anyway
+    get_token(request)
+    return f'{request.user.pk or 0}:{request.META["CSRF_COOKIE"]}'
+
+
+def _etag(*parts):
+    return hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def catalog_etag(request, *args, **kwargs):
+    """ETag for pages built only from the catalog, one cache lookup"""
+    return _etag(get_catalog_version(), viewer_key(request), request.get_full_path())
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    """Catalog versions are microsecond timestamps of the last change"""
+    return datetime.fromtimestamp(get_catalog_version() / 1_000_000, tz=dt_timezone.utc)
+
+
+def book_etag(request, slug, *args, **kwargs):
+    """
+    ETag for a book page from the catalog version and one narrow row lookup.
+
+    Rating and review aggregates are part of the tag because they are
+    updated in place without touching updated_at, and so is the version of
+    the co-rated lists the page shows.
+    """
+    row = (
+        Book.objects.filter(slug=slug)
+        .values_list('id', 'updated_at', *Book.AGGREGATE_FIELDS)
+        .first()
+    )
+    if row is None:
+        return None
+    return _etag(get_catalog_version(), get_recommendations_version(), viewer_key(request), request.get_full_path(), *row)
+
+
+def conditional_page(etag_func, last_modified_func=None):
+    """
+    Answer revalidations with 304 Not Modified before the view runs.
+
+    Responses must be revalidated on every use, and pages rendered for a
+    signed in user are never stored by shared caches.
+    """
+    def decorator(view_func):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view_func)
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                if request.user.is_authenticated:
+                    patch_cache_control(response, no_cache=True, private=True)
+                else:
+                    patch_cache_control(response, no_cache=True)
+            return response
+        return wrapper
+    return decorator
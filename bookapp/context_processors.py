@@ -1,13 +1,10 @@
-from .models import Category
+from django.utils.functional import SimpleLazyObject
 from .forms import BookSearchForm
-from .utils import get_category_icon
+from .catalog import get_category_links
 
 def category_links(request):
-    categories = Category.objects.all()
-    # Add icons to each category
-    for category in categories:
-        category.icon = get_category_icon(category.name)
-    return {'categories': categories}
+    # Lazy so renders that never show the category nav skip even the cache lookup
+    return {'categories': SimpleLazyObject(get_category_links)}
 
 def book_search(request):
     search_form = BookSearchForm()
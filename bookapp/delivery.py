@@ -0,0 +1,136 @@
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
+from urllib.parse import quote
+import os
+import re
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+def file_etag(stat):
+    """Strong validator from a file's size and modification time"""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    Parse a single byte range, returns (start, end) inclusive.
+
+    Returns None when the whole file should be sent (no header, a malformed
+    one or several ranges) and raises ValueError when it is unsatisfiable.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range, the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+class RangeFile:
+    """File-like view of a byte range so FileResponse streams only that slice"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _offload_response(field_file, content_type):
+    """Hand the transfer to the front server, which then does ranges itself"""
+    response = HttpResponse(content_type=content_type)
+    if settings.MEDIA_ACCEL_REDIRECT_PREFIX:
+        # nginx decodes the URI, so names with spaces, ? or # must be encoded
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(field_file.name)
+    else:
+        response[settings.MEDIA_SENDFILE_HEADER] = field_file.path
+    return response
+
+
+def serve_file(request, field_file, content_type, filename, as_attachment=False):
+    """
+    Stream a FileField to the client with Range, ETag and Content-Length.
+
+    The file is never read into memory: full responses go through
+    FileResponse (and the server's wsgi.file_wrapper), ranges through a
+    bounded RangeFile. When a front server offload is configured the worker
+    only sends headers. Storages without local paths redirect to their URL.
+    """
+    try:
+        path = field_file.path
+    except NotImplementedError:
+        return redirect(field_file.url)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return HttpResponse(status=404)
+
+    disposition = 'attachment' if as_attachment else 'inline'
+    etag = file_etag(stat)
+    if settings.MEDIA_ACCEL_REDIRECT_PREFIX or settings.MEDIA_SENDFILE_HEADER:
+        response = _offload_response(field_file, content_type)
+    else:
+        response = _stream_response(request, path, stat, etag, content_type)
+    response['ETag'] = etag
+    response['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(filename)}"
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'MEDIA_CACHE_MAX_AGE', 60 * 60))
+    return response
+
+
+def _stream_response(request, path, stat, etag, content_type):
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        return HttpResponseNotModified()
+
+    size = stat.st_size
+    range_header = request.META.get('HTTP_RANGE', '')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        # The client's partial copy is stale, send everything
+        range_header = ''
+    try:
+        byte_range = parse_range(range_header, size) if request.method == 'GET' else None
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response.block_size = STREAM_BLOCK_SIZE
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        length = end - start + 1
+        response = FileResponse(RangeFile(open(path, 'rb'), start, length), status=206, content_type=content_type)
+        response.block_size = STREAM_BLOCK_SIZE
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Accept-Ranges'] = 'bytes'
+    return response
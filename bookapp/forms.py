@@ -30,6 +30,8 @@ class BookUploadForm(forms.ModelForm):
 	pdf = forms.FileField(required=False, widget=forms.FileInput(attrs={
 		'class': 'form-control', 'accept': '.pdf'
 	}))
+	# Set by the upload page once the PDF went through the chunked upload API
+	pdf_upload = forms.UUIDField(required=False, widget=forms.HiddenInput())
 	category = forms.ModelMultipleChoiceField(
 		queryset=Category.objects.all(),
 		widget=forms.CheckboxSelectMultiple(attrs={
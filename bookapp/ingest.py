@@ -0,0 +1,168 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef
+from itertools import islice
+from pypdf import PdfReader
+import hashlib
+import logging
+
+from . import search, tasks
+from .catalog import bump_catalog_version
+from .models import Book, PdfDocument, PdfPage
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+PAGE_BATCH_SIZE = 500
+
+
+def _clean(text):
+    # NUL bytes show up in some PDFs and are not valid in every database
+    return (text or '').replace('\x00', '').strip()
+
+
+def extract_pdf(source_name, storage=default_storage):
+    """
+    Read the facts of one PDF: size, hash, metadata and the text of each page.
+
+    Only storage is touched, so it is safe to call from worker processes.
+    Unreadable files still return their size and hash, with the reason in
+    'error'.
+    """
+    digest = hashlib.sha256()
+    with storage.open(source_name, 'rb') as pdf:
+        for block in iter(lambda: pdf.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+        result = {
+            'source_name': source_name, 'file_size': pdf.tell(), 'content_hash': digest.hexdigest(),
+            'title': '', 'author': '', 'pages': [], 'error': '',
+        }
+        pdf.seek(0)
+        try:
+            reader = PdfReader(pdf)
+            if reader.is_encrypted:
+                reader.decrypt('')
+            metadata = reader.metadata or {}
+            result['title'] = _clean(metadata.get('/Title'))[:500]
+            result['author'] = _clean(metadata.get('/Author'))[:500]
+            result['pages'] = [_clean(page.extract_text()) for page in reader.pages]
+        except Exception as error:
+            # pypdf raises almost any exception on damaged files, one must not stop a batch
+            logger.warning('Could not parse %s', source_name, exc_info=True)
+            result['error'] = f'{type(error).__name__}: {error}'
+    return result
+
+
+def store_extraction(book_id, result):
+    """Replace a book's stored document and pages with an extract_pdf result"""
+    word_counts = [len(text.split()) for text in result['pages']]
+    with transaction.atomic():
+        document, _ = PdfDocument.objects.update_or_create(book_id=book_id, defaults={
+            'source_name': result['source_name'],
+            'file_size': result['file_size'],
+            'content_hash': result['content_hash'],
+            'page_count': len(result['pages']),
+            'word_count': sum(word_counts),
+            'title': result['title'],
+            'author': result['author'],
+            'error': result['error'],
+        })
+        search.unindex_document_pages(document.pk)
+        document.pages.all().delete()
+        PdfPage.objects.bulk_create([
+            PdfPage(document=document, number=number, text=text, word_count=words)
+            for number, (text, words) in enumerate(zip(result['pages'], word_counts), start=1)
+        ], batch_size=PAGE_BATCH_SIZE)
+        search.index_document_pages(document.pk)
+        # Book pages show the page count and reading time
+        bump_catalog_version()
+    return document
+
+
+def needs_ingestion(book):
+    """True when the book's PDF has not been extracted in its current form"""
+    if not book.pdf:
+        return False
+    return not PdfDocument.objects.filter(book_id=book.pk, source_name=book.pdf.name).exists()
+
+
+def pending_ingestion(books):
+    """Narrow a Book queryset to the books needs_ingestion picks, in the same query"""
+    extracted = PdfDocument.objects.filter(book_id=OuterRef('pk'), source_name=OuterRef('pdf'))
+    return books.exclude(pdf='').exclude(pdf__isnull=True).exclude(Exists(extracted))
+
+
+def _needing_ingestion(books, batch_size=500):
+    """Yield the books needs_ingestion picks, one query per batch_size books"""
+    books = iter(books)
+    while True:
+        batch = list(islice(books, batch_size))
+        if not batch:
+            return
+        with_pdf = [book for book in batch if book.pdf]
+        extracted = set(
+            PdfDocument.objects.filter(book_id__in=[book.pk for book in with_pdf]).values_list('book_id', 'source_name')
+        )
+        for book in with_pdf:
+            if (book.pk, book.pdf.name) not in extracted:
+                yield book
+
+
+def ingest_book(book_id):
+    """Extract and store the PDF of one book if it changed, returns the document"""
+    book = Book.objects.filter(pk=book_id).only('id', 'pdf').first()
+    if book is None or not needs_ingestion(book):
+        return None
+    try:
+        result = extract_pdf(book.pdf.name)
+    except OSError:
+        logger.exception('Could not read %s', book.pdf.name)
+        return None
+    return store_extraction(book.pk, result)
+
+
+def schedule_ingestion(book_id):
+    """Queue the extraction of a book's PDF for the background worker"""
+    tasks.enqueue('extract_pdf', dedup_key=f'extract_pdf:{book_id}', book_id=book_id)
+
+
+def _extract_for_pool(source_name):
+    # Runs in a worker process, errors are reported back rather than raised
+    try:
+        return source_name, extract_pdf(source_name), None
+    except Exception as error:
+        logger.exception('Could not read %s', source_name)
+        return source_name, None, f'{type(error).__name__}: {error}'
+
+
+def ingest_books(books, jobs=1):
+    """
+    Extract the PDFs of many books, reading them in up to jobs processes.
+
+    Books whose PDF is already extracted are skipped, checked a batch at a
+    time. Workers only read storage, the parent stores the results. Yields
+    (book, document, error) as each PDF finishes.
+    """
+    books_by_source = {}
+    for book in _needing_ingestion(books):
+        books_by_source.setdefault(book.pdf.name, []).append(book)
+    if not books_by_source:
+        return
+
+    if jobs > 1:
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(_extract_for_pool, books_by_source)
+    else:
+        executor = None
+        results = map(_extract_for_pool, books_by_source)
+    try:
+        for source_name, result, error in results:
+            for book in books_by_source[source_name]:
+                document = store_extraction(book.pk, result) if error is None else None
+                yield book, document, error
+    finally:
+        if executor is not None:
+            executor.shutdown()
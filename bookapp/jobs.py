@@ -0,0 +1,114 @@
+from datetime import timedelta
+from django.core.management import call_command
+from django.utils import timezone
+import io
+
+from . import boot, ingest, recommendations, similarity, storage, thumbnails, uploads
+from .aggregates import recompute_author_stats, recompute_book_aggregates
+from .catalog import (
+    bump_catalog_version, get_catalog_authors, get_catalog_book_count, get_category_links, render_home_sections,
+)
+from .models import Book, ChunkedUpload, Task
+from .tasks import task
+
+# Finished tasks are kept this long for inspection in the admin
+FINISHED_TASK_RETENTION = timedelta(days=7)
+
+
+@task(priority=10)
+def build_cover_variants(book_id):
+    """Resize a newly uploaded cover"""
+    book = Book.objects.filter(pk=book_id).only('id', 'cover_image', 'cover_variants').first()
+    if book is not None and thumbnails.refresh_cover_variants(book):
+        # Catalog pages may already have been cached without the new srcset
+        bump_catalog_version()
+
+
+@task(priority=5)
+def extract_pdf(book_id):
+    """Extract the metadata and page text of a newly attached PDF"""
+    ingest.ingest_book(book_id)
+
+
+@task(priority=20)
+def finalize_upload(upload_id, book_id=None):
+    """Verify a fully received chunked upload, the uploader is waiting for it"""
+    upload = ChunkedUpload.objects.filter(pk=upload_id).first()
+    if upload is None:
+        return
+    upload = uploads.finalize_upload(upload)
+    book = Book.objects.filter(pk=book_id).first() if book_id is not None else None
+    if book is not None and upload.status == ChunkedUpload.COMPLETE:
+        uploads.attach_upload(upload, book)
+
+
+@task(priority=1)
+def build_missing_cover_variants():
+    """Resize every cover without current derivatives, queued after bulk imports"""
+    books = Book.objects.exclude(cover_image='').exclude(cover_image__isnull=True).only('id', 'cover_image', 'cover_variants')
+    stale = [book for book in books.iterator() if not thumbnails.variants_are_current(book)]
+    errors = [error for _, error in thumbnails.backfill_cover_variants(stale)]
+    if None in errors:
+        bump_catalog_version()
+
+
+@task(priority=1)
+def extract_missing_pdfs():
+    """Extract every PDF that has not been extracted yet, queued after bulk imports"""
+    books = ingest.pending_ingestion(Book.objects.only('id', 'pdf'))
+    for _ in ingest.ingest_books(books.iterator()):
+        pass
+
+
+@task(every=timedelta(minutes=10))
+def warm_catalog_cache():
+    """Render the shared catalog fragments so no reader pays for a cold cache"""
+    render_home_sections()
+    get_category_links()
+    get_catalog_authors()
+    get_catalog_book_count()
+
+
+@task(every=timedelta(hours=1))
+def index_similar_books():
+    similarity.update_similar_books(similarity.unindexed_book_ids())
+
+
+@task(every=timedelta(hours=1), max_attempts=1)
+def refresh_recommendations():
+    recommendations.refresh_recommendations()
+
+
+@task(every=timedelta(days=1), max_attempts=1)
+def repair_aggregates():
+    """Correct any drift in the denormalized rating and review totals"""
+    recompute_book_aggregates()
+    recompute_author_stats()
+
+
+@task(every=timedelta(days=1), max_attempts=1)
+def repair_media(fields=None):
+    """Relink missing covers and PDFs, queued by bootstrap for the fields that changed"""
+    fields = fields or list(boot.MEDIA_FIELDS)
+    call_command('reconcile_media', field=fields, stdout=io.StringIO())
+    # The next boot only reconciles again what changed after this
+    boot.record_media_manifests(fields)
+
+
+@task(every=timedelta(days=1))
+def purge_finished_tasks():
+    Task.objects.filter(
+        status__in=[Task.DONE, Task.FAILED], finished_at__lt=timezone.now() - FINISHED_TASK_RETENTION,
+    ).delete()
+
+
+@task(every=timedelta(hours=1))
+def purge_stale_uploads():
+    """Drop chunked uploads that were abandoned or never attached to a book"""
+    uploads.purge_stale_uploads()
+
+
+@task(every=timedelta(days=1), max_attempts=1)
+def collect_media_blobs():
+    """Delete stored covers, PDFs and avatars that no row refers to any more"""
+    storage.collect_garbage()
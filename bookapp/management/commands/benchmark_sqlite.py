@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections
+from bookapp.models import Book, NewsletterSubscription
+from bookapp.sqlite import PROFILES
+import multiprocessing
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+
+def run_client(path, profile, persistent, seconds, write_ratio, start, results):
+    """Make catalog reads and newsletter signups until the time is up, runs in each process"""
+    settings.SQLITE_PROFILE = profile
+    connection = connections['default']
+    connection.settings_dict['NAME'] = path
+    rng = random.Random(os.getpid())
+    reads = writes = locked = 0
+    latencies = []
+    start.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        began = time.monotonic()
+        try:
+            if rng.random() < write_ratio:
+                NewsletterSubscription.objects.create(email=f'bench-{os.getpid()}-{writes}@example.com')
+                writes += 1
+            else:
+                list(Book.objects.filter(recommended_books=True).order_by('-created_at')[:12])
+                Book.objects.count()
+                reads += 1
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        latencies.append(time.monotonic() - began)
+        if not persistent:
+            # As a request would without CONN_MAX_AGE
+            connection.close()
+    connection.close()
+    results.put((reads, writes, locked, latencies))
+
+
+class Command(BaseCommand):
+    help = 'Measure concurrent read and write throughput of a copy of the database under each SQLite profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', action='append', choices=sorted(PROFILES),
+                            help='Profile to measure, may be repeated (default: all)')
+        parser.add_argument('--processes', type=int, default=3, help='Concurrent client processes, like gunicorn workers')
+        parser.add_argument('--seconds', type=float, default=10, help='How long each profile is measured')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of requests that write')
+
+    def handle(self, *args, **options):
+        source = connections['default']
+        if source.vendor != 'sqlite':
+            raise CommandError('benchmark_sqlite only measures SQLite databases')
+        self.stdout.write(
+            f"{options['processes']} processes, {options['seconds']:g}s per profile, "
+            f"{options['write_ratio']:.0%} writes, on a copy of {source.settings_dict['NAME']}"
+        )
+        self.stdout.write(f"{'profile':<12}{'reads/s':>10}{'writes/s':>10}{'locked':>8}{'p50 ms':>9}{'p99 ms':>9}")
+        workdir = tempfile.mkdtemp(prefix='benchmark_sqlite-')
+        try:
+            for profile in options['profile'] or sorted(PROFILES):
+                self.measure(profile, os.path.join(workdir, f'{profile}.sqlite3'), options)
+        finally:
+            shutil.rmtree(workdir)
+
+    def copy_database(self, path, profile):
+        with sqlite3.connect(connections['default'].settings_dict['NAME']) as original, sqlite3.connect(path) as copy:
+            original.backup(copy)
+            if not PROFILES[profile]:
+                # The copy keeps the original's journal mode, start from SQLite's own default
+                copy.execute('PRAGMA journal_mode = DELETE')
+
+    def measure(self, profile, path, options):
+        self.copy_database(path, profile)
+        # Forked clients must not share our connection
+        connections.close_all()
+        # The default profile stands for the old setup, a new connection per request
+        persistent = bool(settings.DATABASES['default'].get('CONN_MAX_AGE')) and bool(PROFILES[profile])
+        context = multiprocessing.get_context('fork')
+        start, results = context.Event(), context.Queue()
+        clients = [
+            context.Process(target=run_client, args=(
+                path, profile, persistent, options['seconds'], options['write_ratio'], start, results,
+            ))
+            for _ in range(options['processes'])
+        ]
+        for client in clients:
+            client.start()
+        start.set()
+        reads = writes = locked = 0
+        latencies = []
+        for _ in clients:
+            client_reads, client_writes, client_locked, client_latencies = results.get()
+            reads += client_reads
+            writes += client_writes
+            locked += client_locked
+            latencies += client_latencies
+        for client in clients:
+            client.join()
+
+        latencies.sort()
+        percentile = lambda share: latencies[min(len(latencies) - 1, int(len(latencies) * share))] * 1000 if latencies else 0
+        seconds = options['seconds']
+        self.stdout.write(
+            f'{profile:<12}{reads / seconds:>10.0f}{writes / seconds:>10.0f}{locked:>8}'
+            f'{percentile(0.5):>9.2f}{percentile(0.99):>9.2f}'
+        )
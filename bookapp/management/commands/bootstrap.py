@@ -0,0 +1,59 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.utils import OperationalError
+from bookapp import boot, tasks
+from bookapp.models import Book
+import time
+
+class Command(BaseCommand):
+    help = 'Prepare the database and media for serving in one process, skipping whatever is already up to date'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--attempts', type=int, default=30, help='Database connection attempts before giving up')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds between connection attempts')
+        parser.add_argument('--force', action='store_true',
+                            help='Run migrate and queue a full media repair even if nothing changed')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        self.wait_for_database(options['attempts'], options['interval'])
+        self.migrate(options['force'])
+        call_command('create_superuser', stdout=self.stdout)
+
+        if not Book.objects.exists():
+            self.stdout.write('No books found, creating books from existing images...')
+            call_command('create_books_from_images', stdout=self.stdout)
+        self.schedule_media_repair(options['force'])
+        self.stdout.write(self.style.SUCCESS(f'Bootstrap finished in {time.monotonic() - started:.2f}s'))
+
+    def wait_for_database(self, attempts, interval):
+        for attempt in range(1, attempts + 1):
+            try:
+                connection.ensure_connection()
+                return
+            except OperationalError as e:
+                if attempt == attempts:
+                    raise CommandError(f'Failed to connect to database after {attempts} attempts: {e}')
+                self.stdout.write(f'Database not ready ({e}), retrying in {interval:g} seconds...')
+                time.sleep(interval)
+
+    def migrate(self, force):
+        """Run migrate only when the migration files differ from the last successful run"""
+        current = boot.schema_hash()
+        if not force and boot.get_state(boot.SCHEMA_KEY) == current:
+            self.stdout.write('Schema unchanged, skipping migrations')
+            return
+        self.stdout.write('Running migrations...')
+        call_command('migrate', interactive=False, stdout=self.stdout)
+        boot.set_state(boot.SCHEMA_KEY, current)
+
+    def schedule_media_repair(self, force):
+        # Reconciling reads every book and file, so it is left to the worker
+        # and only for the folders that changed since it last ran
+        fields = list(boot.MEDIA_FIELDS) if force else boot.changed_media_fields()
+        if not fields:
+            self.stdout.write('Media unchanged, skipping repair')
+            return
+        tasks.enqueue('repair_media', dedup_key=f"repair_media:{','.join(fields)}", fields=fields)
+        self.stdout.write(f"Queued media repair of {', '.join(fields)} for run_worker")
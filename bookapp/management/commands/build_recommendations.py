@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from bookapp.recommendations import refresh_recommendations
+
+class Command(BaseCommand):
+    help = 'Refresh the "readers also rated" books and per-user recommendations from book ratings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Rebuild everything instead of refreshing what changed since the last run')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Refreshing recommendations...')
+        refresh = refresh_recommendations(full=options['full'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{refresh}: scored {refresh.books_refreshed} books and {refresh.users_refreshed} users!'
+        ))
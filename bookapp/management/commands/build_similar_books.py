@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from bookapp import similarity
+
+class Command(BaseCommand):
+    help = 'Build the top-K similar books table from category overlap and TF-IDF similarity of titles and summaries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true', help='Only index books that have no similar books yet')
+        parser.add_argument('-k', type=int, default=similarity.SIMILAR_BOOKS_K, help='Similar books kept per book')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows written per bulk insert')
+
+    def handle(self, *args, **options):
+        if options['incremental']:
+            self.stdout.write('Indexing books without similar books...')
+            indexed = similarity.update_similar_books(
+                similarity.unindexed_book_ids(), k=options['k'], batch_size=options['batch_size'],
+            )
+        else:
+            self.stdout.write('Rebuilding similar books table...')
+            indexed = similarity.rebuild_similar_books(k=options['k'], batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed similar books for {indexed} books!'))
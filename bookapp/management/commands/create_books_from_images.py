@@ -1,100 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor
 from django.core.management.base import BaseCommand
+from django.db import transaction
+from bookapp import search, tasks
+from bookapp.aggregates import refresh_author_stats
+from bookapp.catalog import bump_catalog_version
+from bookapp.ingest import ingest_books
 from bookapp.models import Book, Category
-from django.core.files import File
+from bookapp.reconcile import file_stem, match_files, welib_search_url
+from bookapp.storage import add_references
+from bookapp.thumbnails import backfill_cover_variants
 import os
 import re
 
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+CATEGORIES = {
+    'fiction': 'Fiction',
+    'business': 'Business',
+    'science': 'Science',
+    'technology': 'Technology',
+    'self-help': 'Self-Help',
+}
+
 class Command(BaseCommand):
     help = 'Create books based on existing images in media folder'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--inline', action='store_true',
+                            help='Extract PDFs and resize covers here instead of queueing them for run_worker')
+        parser.add_argument('--jobs', type=int, default=1, help='Worker processes used for PDF text extraction and resizing with --inline')
+        parser.add_argument('--threads', type=int, default=8, help='Threads storing cover and PDF files')
+        parser.add_argument('--batch-size', type=int, default=500, help='Books inserted per bulk query')
+
     def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        created = self.create_books(options['threads'], options['batch_size'])
+        if not created:
+            return
+        with_pdf = [book_id for book_id, has_pdf in created if has_pdf]
+        book_ids = [book_id for book_id, _ in created]
+        if options['inline']:
+            self.extract_pdfs(self.fetch(with_pdf, ['id', 'pdf'], options['batch_size']), options['jobs'])
+            self.build_covers(self.fetch(book_ids, ['id', 'cover_image', 'cover_variants'], options['batch_size']), options['jobs'])
+        else:
+            # bulk_create skips the save signals that queue this work per book
+            tasks.enqueue('extract_missing_pdfs', dedup_key='extract_missing_pdfs')
+            tasks.enqueue('build_missing_cover_variants', dedup_key='build_missing_cover_variants')
+            self.stdout.write('Queued PDF extraction and cover resizing for run_worker')
+
+    def create_books(self, threads, batch_size):
+        """Insert a book per new image with bulk queries, returns [(book id, has PDF)]"""
         self.stdout.write('Creating books from existing images...')
         
-        # Get all image files from media/img directory
-        img_dir = os.path.join('media', 'img')
+        storage = Book._meta.get_field('cover_image').storage
+        img_dir = storage.path('img')
         if not os.path.exists(img_dir):
             self.stdout.write(self.style.ERROR(f'Image directory not found: {img_dir}'))
-            return
+            return []
         
-        image_files = [f for f in os.listdir(img_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png', '.gif'))]
-        self.stdout.write(f'Found {len(image_files)} image files in {img_dir}')
+        # One query for every slug taken, instead of one per image
+        taken = set(Book.objects.values_list('slug', flat=True))
+        planned = []
+        found = 0
+        with os.scandir(img_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                found += 1
+                title = self.generate_book_title(entry.name)
+                planned.append((entry.name, title, self.generate_slug(title)))
+        self.stdout.write(f'Found {found} image files in {img_dir}')
         
-        # Create categories if they don't exist
-        categories = {
-            'fiction': Category.objects.get_or_create(slug='fiction', defaults={'name': 'Fiction'})[0],
-            'business': Category.objects.get_or_create(slug='business', defaults={'name': 'Business'})[0],
-            'science': Category.objects.get_or_create(slug='science', defaults={'name': 'Science'})[0],
-            'technology': Category.objects.get_or_create(slug='technology', defaults={'name': 'Technology'})[0],
-            'self-help': Category.objects.get_or_create(slug='self-help', defaults={'name': 'Self-Help'})[0],
-        }
+        books = []
+        for img_file, title, slug in sorted(planned):
+            if slug in taken:
+                self.stdout.write(f'Book already exists: {title}')
+                continue
+            taken.add(slug)
+            books.append({'img_file': img_file, 'title': title, 'slug': slug})
+        if not books:
+            self.stdout.write(self.style.SUCCESS('Created 0 books from images!'))
+            return []
         
-        created_count = 0
+        pdf_dir = storage.path('pdf')
+        pdf_files = []
+        if os.path.isdir(pdf_dir):
+            with os.scandir(pdf_dir) as entries:
+                pdf_files = [entry.name for entry in entries if entry.is_file() and entry.name.lower().endswith('.pdf')]
+        pdfs = {slug: pdf_file for slug, pdf_file, _ in match_files(((book['slug'], book['title']) for book in books), pdf_files)}
         
-        for img_file in image_files:
-            # Generate book title from image filename
-            book_title = self.generate_book_title(img_file)
-            book_slug = self.generate_slug(book_title)
-            
-            # Skip if book already exists
-            if Book.objects.filter(slug=book_slug).exists():
-                self.stdout.write(f'Book already exists: {book_title}')
-                continue
-            
-            # Determine category based on image name
-            category = self.determine_category(img_file)
-            
-            # Create the book
-            book = Book.objects.create(
-                title=book_title,
-                slug=book_slug,
-                author=self.generate_author(img_file),
-                summary=self.generate_summary(book_title, category),
-                recommended_books=self.is_recommended(img_file),
-                fiction_books=category.name.lower() == 'fiction',
-                business_books=category.name.lower() == 'business',
-            )
-            
-            # Add category
-            book.category.add(categories[category.slug])
-            
-            # Assign the image
-            img_path = os.path.join(img_dir, img_file)
-            with open(img_path, 'rb') as img_file_obj:
-                book.cover_image.save(img_file, File(img_file_obj), save=True)
-            
-            # Assign PDF file if available
-            pdf_file = self.find_matching_pdf(img_file)
-            if pdf_file:
-                pdf_dir = os.path.join('media', 'pdf')
-                pdf_path = os.path.join(pdf_dir, pdf_file)
-                if os.path.exists(pdf_path):
-                    with open(pdf_path, 'rb') as pdf_file_obj:
-                        book.pdf.save(pdf_file, File(pdf_file_obj), save=True)
-                    self.stdout.write(f'  - Assigned PDF: {pdf_file}')
-                else:
-                    self.stdout.write(f'  - PDF not found: {pdf_file}')
-                    # Add PDFDrive.com link as fallback
-                    pdfdrive_url = self.generate_pdfdrive_url(book_title)
-                    book.pdf_url = pdfdrive_url
-                    book.save()
-                    self.stdout.write(f'  - Added PDFDrive link: {pdfdrive_url}')
-            else:
-                self.stdout.write(f'  - No matching PDF found')
-                # Add PDFDrive.com link as fallback
-                pdfdrive_url = self.generate_pdfdrive_url(book_title)
-                book.pdf_url = pdfdrive_url
-                book.save()
-                self.stdout.write(f'  - Added PDFDrive link: {pdfdrive_url}')
-            
-            self.stdout.write(f'Created book: {book_title} (Category: {category.name})')
-            created_count += 1
+        # Files are hashed and linked into storage in parallel, no database access
+        jobs = [(os.path.join(img_dir, book['img_file']), f"img/{book['img_file']}") for book in books]
+        jobs += [(os.path.join(pdf_dir, pdfs[book['slug']]), f"pdf/{pdfs[book['slug']]}") for book in books if book['slug'] in pdfs]
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            placed = list(pool.map(lambda job: storage.place(*job), jobs))
+        stored = {path: name for (path, _), (name, _, _) in zip(jobs, placed)}
+        
+        categories = self.get_categories()
+        through = Book.category.through
+        created = []
+        with transaction.atomic():
+            add_references(placed)
+            for start in range(0, len(books), batch_size):
+                batch = []
+                for book in books[start:start + batch_size]:
+                    category = self.determine_category(book['img_file'])
+                    pdf_file = pdfs.get(book['slug'])
+                    book['category'] = category
+                    batch.append(Book(
+                        title=book['title'],
+                        slug=book['slug'],
+                        author=self.generate_author(book['img_file']),
+                        summary=self.generate_summary(book['title'], CATEGORIES[category]),
+                        recommended_books=self.is_recommended(book['img_file']),
+                        fiction_books=category == 'fiction',
+                        business_books=category == 'business',
+                        cover_image=stored[os.path.join(img_dir, book['img_file'])],
+                        pdf=stored[os.path.join(pdf_dir, pdf_file)] if pdf_file else None,
+                        pdf_url=None if pdf_file else welib_search_url(book['title']),
+                    ))
+                Book.objects.bulk_create(batch)
+                # SQLite does not return the new ids from a bulk insert
+                ids = dict(Book.objects.filter(slug__in=[book.slug for book in batch]).values_list('slug', 'id'))
+                through.objects.bulk_create([
+                    through(book_id=ids[book['slug']], category_id=categories[book['category']].pk)
+                    for book in books[start:start + batch_size]
+                ])
+                search.index_books(ids.values())
+                refresh_author_stats(*{book.author for book in batch})
+                created.extend((ids[book.slug], bool(book.pdf)) for book in batch)
+                if self.verbosity > 1:
+                    for book in books[start:start + batch_size]:
+                        self.stdout.write(f"Created book: {book['title']} (Category: {CATEGORIES[book['category']]})")
+        bump_catalog_version()
         
-        self.stdout.write(self.style.SUCCESS(f'Created {created_count} books from images!'))
+        self.stdout.write(f'Assigned PDFs to {len(pdfs)} books, Welib.org links to {len(books) - len(pdfs)}')
+        self.stdout.write(self.style.SUCCESS(f'Created {len(created)} books from images!'))
+        return created
+
+    def get_categories(self):
+        categories = {category.slug: category for category in Category.objects.filter(slug__in=CATEGORIES)}
+        missing = [Category(slug=slug, name=name) for slug, name in CATEGORIES.items() if slug not in categories]
+        if missing:
+            Category.objects.bulk_create(missing)
+            categories = {category.slug: category for category in Category.objects.filter(slug__in=CATEGORIES)}
+        return categories
+
+    def fetch(self, book_ids, fields, batch_size):
+        # Batched so the id lists stay under SQLite's variable limit
+        for start in range(0, len(book_ids), batch_size):
+            yield from Book.objects.filter(pk__in=book_ids[start:start + batch_size]).only(*fields)
+
+    def extract_pdfs(self, books, jobs):
+        """Extract page text and metadata of the books' PDFs in parallel"""
+        extracted = failed = 0
+        for book, document, error in ingest_books(books, jobs=jobs):
+            if error is None and not document.error:
+                extracted += 1
+            else:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'  - Could not extract {book.pdf.name}: {error or document.error}'))
+        self.stdout.write(self.style.SUCCESS(f'Extracted text from {extracted} PDFs!'))
+        if failed:
+            self.stdout.write(self.style.ERROR(f'{failed} PDFs could not be read'))
+
+    def build_covers(self, books, jobs):
+        """Build the resized covers of the new books in parallel"""
+        built = failed = 0
+        for book, error in backfill_cover_variants(books, jobs=jobs):
+            if error is None:
+                built += 1
+            else:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'  - {book.cover_image.name}: {error}'))
+        if built:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Built thumbnails for {built} books!'))
 
     def generate_book_title(self, img_filename):
         """Generate a book title from image filename"""
-        # Remove file extension
-        name = os.path.splitext(img_filename)[0]
+        # Remove file extension and the suffix storage adds to clashing names
+        name = file_stem(img_filename)
         
         # Replace underscores and hyphens with spaces
         name = name.replace('_', ' ').replace('-', ' ')
@@ -165,7 +250,7 @@ class Command(BaseCommand):
         
         return 'Various Authors'
 
-    def generate_summary(self, title, category):
+    def generate_summary(self, title, category_name):
         """Generate a summary based on title and category"""
         summaries = {
             'Fiction': f'A captivating {title.lower()} that will keep you engaged from start to finish.',
@@ -174,98 +259,28 @@ class Command(BaseCommand):
             'Technology': f'Master the latest technology trends and techniques in {title.lower()}.',
             'Self-Help': f'Transform your life with practical advice and insights from {title.lower()}.',
         }
-        return summaries.get(category.name, f'An informative and engaging book about {title.lower()}.')
+        return summaries.get(category_name, f'An informative and engaging book about {title.lower()}.')
 
     def determine_category(self, img_filename):
-        """Determine book category based on image filename"""
+        """Determine the slug of the book category based on image filename"""
         name_lower = img_filename.lower()
         
         if any(word in name_lower for word in ['fiction', 'oliver', 'serial', 'purple']):
-            return Category.objects.get_or_create(slug='fiction', defaults={'name': 'Fiction'})[0]
+            return 'fiction'
         elif any(word in name_lower for word in ['business', 'random walk', 'intelligent']):
-            return Category.objects.get_or_create(slug='business', defaults={'name': 'Business'})[0]
+            return 'business'
         elif any(word in name_lower for word in ['science', 'manga guide']):
-            return Category.objects.get_or_create(slug='science', defaults={'name': 'Science'})[0]
+            return 'science'
         elif any(word in name_lower for word in ['hacking', 'linux', 'technology']):
-            return Category.objects.get_or_create(slug='technology', defaults={'name': 'Technology'})[0]
+            return 'technology'
         elif any(word in name_lower for word in ['penis', 'exercise', 'health']):
-            return Category.objects.get_or_create(slug='self-help', defaults={'name': 'Self-Help'})[0]
+            return 'self-help'
         
         # Default to fiction
-        return Category.objects.get_or_create(slug='fiction', defaults={'name': 'Fiction'})[0]
+        return 'fiction'
 
     def is_recommended(self, img_filename):
         """Determine if book should be recommended"""
         name_lower = img_filename.lower()
         recommended_keywords = ['random walk', 'intelligent', 'oliver', 'serial killer', 'manga guide']
         return any(keyword in name_lower for keyword in recommended_keywords)
-
-    def find_matching_pdf(self, img_filename):
-        """Find matching PDF file for an image"""
-        pdf_dir = os.path.join('media', 'pdf')
-        if not os.path.exists(pdf_dir):
-            return None
-        
-        pdf_files = [f for f in os.listdir(pdf_dir) if f.lower().endswith('.pdf')]
-        
-        # Clean image filename for matching
-        img_name = os.path.splitext(img_filename)[0].lower()
-        img_name = img_name.replace('_', ' ').replace('-', ' ')
-        
-        # Try to find matching PDF
-        for pdf_file in pdf_files:
-            pdf_name = os.path.splitext(pdf_file)[0].lower()
-            pdf_name = pdf_name.replace('_', ' ').replace('-', ' ')
-            
-            # Check for exact matches or partial matches
-            if img_name in pdf_name or pdf_name in img_name:
-                return pdf_file
-            
-            # Check for common keywords
-            img_words = img_name.split()
-            pdf_words = pdf_name.split()
-            
-            # If more than 2 words match, consider it a match
-            common_words = set(img_words) & set(pdf_words)
-            if len(common_words) >= 2:
-                return pdf_file
-        
-        # Handle specific cases
-        if 'random walk' in img_name:
-            return 'A_Random_Walk_Down_Wall_Street.pdf'
-        elif 'oliver' in img_name:
-            return 'oliver-twist.pdf'
-        elif 'serial killer' in img_name:
-            return 'My_Sister_the_Serial_Killer.pdf'
-        elif 'manga guide' in img_name:
-            return 'The_Manga_Guide_to_Molecular_Biology__PDFDrive_.pdf'
-        elif 'manga master' in img_name:
-            return 'Mastering_Manga_How_to_Draw_Manga_Faces__PDFDrive_.pdf'
-        elif 'linux' in img_name:
-            return 'Linux_Tips_Tricks_PPS__Hacks_Vol_3.pdf'
-        elif 'hacking' in img_name:
-            return 'The_Basics_Of_Hacking_And_Penetration_Testing__Ethical_Hacking_And_Penetration_Testing.pdf'
-        elif 'intelligent' in img_name:
-            return 'The_Intelligent_Investor.pdf'
-        elif 'science' in img_name:
-            return 'The_Handy_Science_Answer_Book_The_Handy_Answer_Book_Series____PDFDrive_.pdf'
-        elif 'penis' in img_name:
-            return 'Penis_Exercises_A_Healthy_Book_for_Enlargement_Enhancement_Hardness__Health__PDFDrive_.pdf'
-        elif 'purple' in img_name:
-            return 'Purple_Hibiscus.pdf'
-        
-        return None
-
-    def generate_pdfdrive_url(self, book_title):
-        """Generate a welib.org search URL for a book title"""
-        import urllib.parse
-        
-        # Clean the title for URL
-        clean_title = book_title.replace(':', '').replace('(', '').replace(')', '')
-        clean_title = ' '.join(clean_title.split())  # Remove extra spaces
-        
-        # Encode for URL
-        encoded_title = urllib.parse.quote(clean_title)
-        
-        # Create welib.org search URL
-        return f'https://www.welib.org/search?q={encoded_title}'
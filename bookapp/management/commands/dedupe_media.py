@@ -0,0 +1,124 @@
+from django.core.management.base import BaseCommand
+from bookapp.catalog import bump_catalog_version
+from bookapp.models import Book, MediaBlob, PdfDocument
+from bookapp.storage import BLOB_DIR, file_sha256, link_or_copy, media_fields, recount_references
+import os
+
+class Command(BaseCommand):
+    help = 'Move covers, PDFs and avatars into content addressed storage and hardlink duplicate media files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without touching anything')
+        parser.add_argument('--delete-originals', action='store_true',
+                            help='Remove the old files once stored as blobs instead of keeping them as hardlinks')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        # Content hash -> path of the file every identical copy is linked to
+        self.canonical = {}
+        self.reclaimed = 0
+
+        migrated = self.migrate_fields()
+        deduped = self.dedupe_directories(options['delete_originals'])
+        if not self.dry_run:
+            recount_references()
+            if migrated:
+                # Cached pages still carry the old media URLs
+                bump_catalog_version()
+
+        verb = 'Would migrate' if self.dry_run else 'Migrated'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {migrated} media names to content addressed blobs!'))
+        self.stdout.write(self.style.SUCCESS(
+            f'Deduplicated {deduped} files, reclaiming {self.reclaimed / (1024 * 1024):.1f} MiB'
+        ))
+
+    def migrate_fields(self):
+        """Point every file field still naming an old upload path at its blob"""
+        migrated = 0
+        for model, field in media_fields():
+            storage = model._meta.get_field(field).storage
+            names = (
+                model._default_manager.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+                .exclude(**{f'{field}__startswith': f'{BLOB_DIR}/'})
+                .values_list(field, flat=True).distinct()
+            )
+            for name in names:
+                path = storage.path(name)
+                if not os.path.isfile(path):
+                    self.stdout.write(self.style.WARNING(f'  - Missing {model.__name__}.{field} file: {name}'))
+                    continue
+                digest = file_sha256(path)
+                blob = storage.blob_name(digest, name)
+                self.stdout.write(f'  - {name} -> {blob}')
+                migrated += 1
+                if self.dry_run:
+                    # The old file stands in for the blob it would become
+                    self.canonical.setdefault(digest, path)
+                    continue
+                if not storage.exists(blob):
+                    link_or_copy(path, storage.path(blob))
+                MediaBlob.objects.get_or_create(name=blob, defaults={'sha256': digest, 'size': os.path.getsize(path)})
+                self.canonical.setdefault(digest, storage.path(blob))
+                self.rename(model, field, name, blob)
+        return migrated
+
+    def rename(self, model, field, old, new):
+        # Updated in place so no save signals queue covers or PDFs for rebuilding
+        if model is Book and field == 'cover_image':
+            # Same bytes, so the derivatives made from the old name stay valid
+            for book in Book.objects.filter(cover_image=old).only('id', 'cover_variants'):
+                variants = book.cover_variants
+                if variants.get('source') == old:
+                    variants = {**variants, 'source': new}
+                Book.objects.filter(pk=book.pk).update(cover_image=new, cover_variants=variants)
+            return
+        if model is Book and field == 'pdf':
+            # Likewise the extracted text
+            PdfDocument.objects.filter(book__pdf=old, source_name=old).update(source_name=new)
+        model._default_manager.filter(**{field: old}).update(**{field: new})
+
+    def dedupe_directories(self, delete_originals):
+        """Replace duplicate files in the old upload directories with hardlinks"""
+        storage = Book._meta.get_field('pdf').storage
+        blob_root = storage.path(BLOB_DIR) + os.sep
+        directories = sorted({
+            model._meta.get_field(field).upload_to.strip('/') for model, field in media_fields()
+            if isinstance(model._meta.get_field(field).upload_to, str)
+        })
+        for digest, name in MediaBlob.objects.values_list('sha256', 'name'):
+            if storage.exists(name):
+                self.canonical.setdefault(digest, storage.path(name))
+
+        deduped = 0
+        for directory in directories:
+            root = storage.path(directory)
+            if not os.path.isdir(root):
+                continue
+            for entry in sorted(os.scandir(root), key=lambda entry: entry.name):
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                # Files linked on an earlier run need no hashing
+                if entry.stat().st_nlink > 1 and not delete_originals:
+                    continue
+                digest = file_sha256(entry.path)
+                canonical = self.canonical.setdefault(digest, entry.path)
+                if canonical == entry.path:
+                    continue
+                remove = delete_originals and canonical.startswith(blob_root)
+                linked = os.path.samefile(canonical, entry.path)
+                if linked and not remove:
+                    continue
+                self.stdout.write(f'  - {directory}/{entry.name} is a copy of {os.path.relpath(canonical, storage.location)}')
+                deduped += 1
+                if not linked:
+                    self.reclaimed += entry.stat().st_size
+                if self.dry_run:
+                    continue
+                if remove:
+                    os.remove(entry.path)
+                else:
+                    # Link beside the copy first so the name never goes missing
+                    staged = entry.path + '.dedupe'
+                    link_or_copy(canonical, staged)
+                    os.replace(staged, entry.path)
+        return deduped
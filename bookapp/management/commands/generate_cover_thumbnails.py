@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from bookapp.catalog import bump_catalog_version
+from bookapp.models import Book
+from bookapp.thumbnails import backfill_cover_variants, variants_are_current
+
+class Command(BaseCommand):
+    help = 'Build the resized JPEG and WebP covers for books that do not have current ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--jobs', type=int, default=1, help='Worker processes used for resizing')
+        parser.add_argument('--force', action='store_true', help='Rebuild every cover, even current ones')
+        parser.add_argument('--batch-size', type=int, default=200, help='Books written per bulk update')
+
+    def handle(self, *args, **options):
+        books = Book.objects.exclude(cover_image='').exclude(cover_image__isnull=True).only('id', 'cover_image', 'cover_variants')
+        if not options['force']:
+            books = [book for book in books.iterator() if not variants_are_current(book)]
+        else:
+            books = list(books)
+        self.stdout.write(f'Building cover thumbnails for {len(books)} books with {options["jobs"]} jobs...')
+
+        built = failed = 0
+        for book, error in backfill_cover_variants(books, jobs=options['jobs'], batch_size=options['batch_size']):
+            if error is None:
+                built += 1
+            else:
+                failed += 1
+                self.stdout.write(self.style.WARNING(f'  - {book.cover_image.name}: {error}'))
+        if built:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Built thumbnails for {built} books!'))
+        if failed:
+            self.stdout.write(self.style.ERROR(f'{failed} covers could not be read'))
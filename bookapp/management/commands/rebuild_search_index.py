@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from bookapp import search
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search indexes over book details and extracted PDF pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Books indexed per batch')
+
+    def handle(self, *args, **options):
+        if not search.search_index_available():
+            self.stdout.write(self.style.ERROR('Full-text search index requires SQLite with FTS5'))
+            return
+        self.stdout.write('Rebuilding full-text search index...')
+        indexed = search.rebuild_index(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} books!'))
+        self.stdout.write('Rebuilding PDF page search index...')
+        pages = search.rebuild_page_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {pages} pages!'))
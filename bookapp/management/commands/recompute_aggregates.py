@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from bookapp.aggregates import recompute_author_stats, recompute_book_aggregates
+
+class Command(BaseCommand):
+    help = 'Recompute the stored rating and review aggregates on every book and the author rollups'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Books written per bulk update')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Recomputing book rating and review aggregates...')
+        updated = recompute_book_aggregates(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Repaired aggregates on {updated} books!'))
+        authors = recompute_author_stats(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rollups for {authors} authors!'))
@@ -0,0 +1,158 @@
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from bookapp import tasks
+from bookapp.catalog import bump_catalog_version
+from bookapp.ingest import ingest_books, pending_ingestion
+from bookapp.models import Book
+from bookapp.reconcile import MIN_SCORE, match_files, welib_search_url
+import json
+import os
+import sys
+
+FIELD_EXTENSIONS = {
+    'cover_image': ('.jpg', '.jpeg', '.png', '.gif', '.webp'),
+    'pdf': ('.pdf',),
+}
+
+class Command(BaseCommand):
+    help = 'Link books without a cover or PDF to the best matching files in the media folders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--field', action='append', choices=sorted(FIELD_EXTENSIONS),
+                            help='Only reconcile this field, may be repeated (default: all)')
+        parser.add_argument('--relink', action='store_true',
+                            help='Also rematch books whose current file exists')
+        parser.add_argument('--min-score', type=float, default=MIN_SCORE, help='Weakest match that is applied (0-1)')
+        parser.add_argument('--dry-run', action='store_true', help='Report matches without changing any book')
+        parser.add_argument('--report', help='Write a JSON report of every match to this file, - for stdout')
+        parser.add_argument('--batch-size', type=int, default=500, help='Books written per bulk update')
+        parser.add_argument('--jobs', type=int, default=1, help='Worker processes used for PDF text extraction')
+
+    def handle(self, *args, **options):
+        # Human output moves to stderr when the report goes to stdout
+        self.out = self.stderr if options['report'] == '-' else self.stdout
+        report = {'dry_run': options['dry_run'], 'min_score': options['min_score'], 'fields': {}}
+        for field in options['field'] or sorted(FIELD_EXTENSIONS):
+            report['fields'][field] = self.reconcile(field, options)
+
+        if not options['dry_run'] and 'pdf' in report['fields']:
+            # Also picks up books whose PDFs were never extracted
+            self.extract_pdfs(pending_ingestion(Book.objects.all()), options['jobs'])
+        if options['report']:
+            output = json.dumps(report, indent=2)
+            if options['report'] == '-':
+                sys.stdout.write(output + '\n')
+            else:
+                with open(options['report'], 'w') as report_file:
+                    report_file.write(output)
+                self.out.write(f'Report written to {options["report"]}')
+
+    def reconcile(self, field, options):
+        model_field = Book._meta.get_field(field)
+        storage, directory = model_field.storage, model_field.upload_to.strip('/')
+        root = storage.path(directory)
+        names = []
+        if os.path.isdir(root):
+            names = sorted(
+                entry.name for entry in os.scandir(root)
+                if entry.is_file() and entry.name.lower().endswith(FIELD_EXTENSIONS[field])
+            )
+        self.out.write(f'Reconciling {field}: {len(names)} files in {directory}/')
+
+        # Files are content addressed, so an old upload still in use is the
+        # same inode as the blob a book names
+        pending, missing, used_names, used_inodes = [], set(), set(), set()
+        fields = ['id', 'title', field] + (['pdf_url'] if field == 'pdf' else [])
+        for book in Book.objects.only(*fields).iterator():
+            current = getattr(book, field)
+            try:
+                stat = os.stat(current.path) if current else None
+            except FileNotFoundError:
+                stat = None
+            if stat is None:
+                missing.add(book.pk)
+            else:
+                used_names.add(current.name)
+                used_inodes.add((stat.st_dev, stat.st_ino))
+            if stat is None or options['relink']:
+                pending.append(book)
+
+        available = names
+        if not options['relink']:
+            available = []
+            for name in names:
+                stat = os.stat(os.path.join(root, name))
+                if f'{directory}/{name}' not in used_names and (stat.st_dev, stat.st_ino) not in used_inodes:
+                    available.append(name)
+
+        books = {book.pk: book for book in pending}
+        matches = match_files(((book.pk, book.title) for book in pending), available, options['min_score'])
+        matched = set()
+        changed, released = [], []
+        for book_id, name, score in matches:
+            book = books[book_id]
+            matched.add(book_id)
+            if options['verbosity'] > 1:
+                self.out.write(f'  - {book.title}: {name} ({score})')
+            if options['dry_run']:
+                continue
+            with open(os.path.join(root, name), 'rb') as media_file:
+                stored = storage.save(f'{directory}/{name}', File(media_file))
+            if stored == getattr(book, field).name:
+                # Already linked, drop the reference the save just took
+                storage.delete(stored)
+                continue
+            if getattr(book, field):
+                released.append(getattr(book, field).name)
+            setattr(book, field, stored)
+            changed.append(book)
+
+        unmatched = [book for book in pending if book.pk not in matched and book.pk in missing]
+        fallbacks = []
+        if field == 'pdf':
+            fallbacks = [book for book in unmatched if not book.pdf_url]
+            for book in fallbacks:
+                book.pdf_url = welib_search_url(book.title)
+
+        if not options['dry_run']:
+            Book.objects.bulk_update(changed, [field], batch_size=options['batch_size'])
+            Book.objects.bulk_update(fallbacks, ['pdf_url'], batch_size=options['batch_size'])
+            for name in released:
+                storage.delete(name)
+            if changed or fallbacks:
+                bump_catalog_version()
+            if field == 'cover_image':
+                # bulk_update skips the save signals that queue the resized covers
+                for book in changed:
+                    tasks.enqueue('build_cover_variants', dedup_key=f'build_cover_variants:{book.pk}', book_id=book.pk)
+
+        verb = 'Would link' if options['dry_run'] else 'Linked'
+        self.out.write(self.style.SUCCESS(f'{verb} {len(matches)} of {len(pending)} books to {field} files!'))
+        if fallbacks:
+            self.out.write(f'Added Welib.org links for {len(fallbacks)} books without a PDF')
+        matched_names = {name for _, name, _ in matches}
+        return {
+            'files': len(names),
+            'books_considered': len(pending),
+            'matches': [
+                {'book': book_id, 'title': books[book_id].title, 'file': f'{directory}/{name}', 'score': score}
+                for book_id, name, score in matches
+            ],
+            'unmatched_books': [{'book': book.pk, 'title': book.title} for book in unmatched],
+            'welib_links': [book.pk for book in fallbacks],
+            'unused_files': [f'{directory}/{name}' for name in available if name not in matched_names],
+        }
+
+    def extract_pdfs(self, books, jobs):
+        """Extract page text and metadata of the books' PDFs in parallel"""
+        extracted = failed = 0
+        for book, document, error in ingest_books(books.only('id', 'pdf'), jobs=jobs):
+            if error is None and not document.error:
+                extracted += 1
+            else:
+                failed += 1
+                self.out.write(self.style.WARNING(f'  - Could not extract {book.pdf.name}: {error or document.error}'))
+        if extracted or failed:
+            self.out.write(self.style.SUCCESS(f'Extracted text from {extracted} PDFs!'))
+        if failed:
+            self.out.write(self.style.ERROR(f'{failed} PDFs could not be read'))
@@ -0,0 +1,97 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+from bookapp import tasks
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+
+def work(worker_name, stop, poll_interval):
+    """Claim and run tasks until stop is set, runs in each pool process"""
+    # Ctrl+C reaches the whole process group, let the parent stop us cleanly
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while not stop.is_set():
+        task = tasks.claim_task(worker_name)
+        if task is None:
+            stop.wait(poll_interval)
+        else:
+            tasks.run_task(task)
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks and periodic schedules in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=2, help='Worker processes running tasks')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds an idle worker waits before polling again')
+        parser.add_argument('--schedule-interval', type=float, default=30.0, help='Seconds between checks for due periodic tasks')
+        parser.add_argument('--once', action='store_true', help='Run every due task in this process, then exit')
+
+    def handle(self, *args, **options):
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        if options['once']:
+            self.run_once(name)
+        else:
+            self.run_pool(name, options)
+
+    def request_stop(self, *args):
+        self.stopping = True
+
+    def run_once(self, name):
+        tasks.requeue_stale_tasks()
+        tasks.enqueue_due_schedules()
+        done = failed = 0
+        while True:
+            task = tasks.claim_task(name)
+            if task is None:
+                break
+            if tasks.run_task(task):
+                done += 1
+            else:
+                failed += 1
+        self.stdout.write(self.style.SUCCESS(f'Ran {done} tasks, {failed} failed'))
+
+    def run_pool(self, name, options):
+        stop = multiprocessing.Event()
+        # Setting the event inside a handler can deadlock on its lock, so
+        # the handler only flips a flag the loop below checks
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+        workers = {}
+
+        def start_worker(slot):
+            # Forked workers must not share the parent's database connections
+            connections.close_all()
+            process = multiprocessing.Process(
+                target=work, args=(f'{name}/{slot}', stop, options['poll_interval']), daemon=True,
+            )
+            process.start()
+            workers[slot] = process
+
+        self.stdout.write(f'Starting {options["processes"]} task workers as {name}...')
+        for slot in range(options['processes']):
+            start_worker(slot)
+        while not self.stopping:
+            requeued = tasks.requeue_stale_tasks()
+            if requeued:
+                self.stdout.write(self.style.WARNING(f'Requeued {requeued} tasks from workers that stopped'))
+            for scheduled in tasks.enqueue_due_schedules():
+                self.stdout.write(f'Queued periodic task {scheduled}')
+            connections.close_all()
+            deadline = time.monotonic() + options['schedule_interval']
+            while not self.stopping and time.monotonic() < deadline:
+                for slot, process in list(workers.items()):
+                    if not process.is_alive():
+                        self.stdout.write(self.style.WARNING(f'Worker {slot} exited with {process.exitcode}, restarting'))
+                        start_worker(slot)
+                time.sleep(1)
+
+        self.stdout.write('Stopping task workers after their current tasks...')
+        stop.set()
+        for process in workers.values():
+            process.join()
+        self.stdout.write(self.style.SUCCESS('Task workers stopped'))
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from contextlib import closing
+import sqlite3
+import time
+
+class Command(BaseCommand):
+    help = 'Copy the primary SQLite database over every read replica, a stand-in for real replication'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float,
+                            help='Keep copying, waiting this many seconds between copies')
+
+    def handle(self, *args, **options):
+        if not settings.REPLICA_DATABASES:
+            raise CommandError('No replicas configured, set DATABASE_REPLICAS')
+        for alias in ['default'] + settings.REPLICA_DATABASES:
+            if connections[alias].vendor != 'sqlite':
+                raise CommandError(f'{alias} is not an SQLite database, replicate it with its own tools')
+        while True:
+            started = time.monotonic()
+            self.sync()
+            self.stdout.write(f'Synced {len(settings.REPLICA_DATABASES)} replicas in {time.monotonic() - started:.2f}s')
+            if options['interval'] is None:
+                break
+            time.sleep(options['interval'])
+
+    def sync(self):
+        # The backup API copies a consistent snapshot while both sides stay in use
+        with closing(sqlite3.connect(connections['default'].settings_dict['NAME'])) as primary:
+            for alias in settings.REPLICA_DATABASES:
+                with closing(sqlite3.connect(connections[alias].settings_dict['NAME'], timeout=30)) as replica:
+                    primary.backup(replica)
@@ -0,0 +1,26 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_created_at(apps, schema_editor):
+    """Give books created before 0006 a timestamp so keyset pagination sees them"""
+    Book = apps.get_model('bookapp', 'Book')
+    Book.objects.filter(created_at__isnull=True, updated_at__isnull=False).update(created_at=models.F('updated_at'))
+    Book.objects.filter(created_at__isnull=True).update(created_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0007_alter_category_options_alter_book_author_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_created_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['created_at', 'id'], name='book_created_at_id_idx'),
+        ),
+    ]
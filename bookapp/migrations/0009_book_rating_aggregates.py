@@ -0,0 +1,45 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+
+
+def populate_aggregates(apps, schema_editor):
+    """Fill the new aggregate columns from the existing ratings and reviews"""
+    Book = apps.get_model('bookapp', 'Book')
+    BookRating = apps.get_model('bookapp', 'BookRating')
+    BookReview = apps.get_model('bookapp', 'BookReview')
+    rating_totals = (
+        BookRating.objects.order_by().values('book')
+        .annotate(total=models.Sum('rating'), count=models.Count('id'))
+    )
+    for row in rating_totals:
+        Book.objects.filter(pk=row['book']).update(rating_sum=row['total'], rating_count=row['count'])
+    review_totals = BookReview.objects.order_by().values('book').annotate(count=models.Count('id'))
+    for row in review_totals:
+        Book.objects.filter(pk=row['book']).update(review_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0008_book_created_at_backfill_and_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_aggregates, migrations.RunPython.noop),
+    ]
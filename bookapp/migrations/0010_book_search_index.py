@@ -0,0 +1,39 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    """Create and fill the FTS5 book index, SQLite only"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from bookapp.search import BOOK_FTS_TABLE, CREATE_BOOK_FTS_SQL
+    Book = apps.get_model('bookapp', 'Book')
+    schema_editor.execute(CREATE_BOOK_FTS_SQL)
+    rows = [
+        (book.pk, book.title, book.author, book.summary, ' '.join(category.name for category in book.category.all()))
+        for book in Book.objects.prefetch_related('category').iterator()
+    ]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {BOOK_FTS_TABLE} (rowid, title, author, summary, categories) VALUES (%s, %s, %s, %s, %s)',
+            rows,
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from bookapp.search import DROP_BOOK_FTS_SQL
+    schema_editor.execute(DROP_BOOK_FTS_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0009_book_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0010_book_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarBook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_entries', to='bookapp.book')),
+                ('similar_book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_to_entries', to='bookapp.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='similarbook',
+            index=models.Index(fields=['book', '-score'], name='similar_book_score_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='similarbook',
+            unique_together={('book', 'similar_book')},
+        ),
+    ]
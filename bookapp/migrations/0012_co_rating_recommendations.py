@@ -0,0 +1,64 @@
+# Generated by Django 3.2.23
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('bookapp', '0011_similar_books'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecommendationRefresh',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started_at', models.DateTimeField()),
+                ('full', models.BooleanField(default=False)),
+                ('books_refreshed', models.PositiveIntegerField(default=0)),
+                ('users_refreshed', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'get_latest_by': 'started_at',
+            },
+        ),
+        migrations.CreateModel(
+            name='UserRecommendation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_recommendations', to='bookapp.book')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='book_recommendations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CoRatedBook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('support', models.PositiveIntegerField(help_text='Readers who rated both books')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='co_rated_entries', to='bookapp.book')),
+                ('similar_book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='co_rated_to_entries', to='bookapp.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='userrecommendation',
+            index=models.Index(fields=['user', '-score'], name='user_recommendation_score_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='userrecommendation',
+            unique_together={('user', 'book')},
+        ),
+        migrations.AddIndex(
+            model_name='coratedbook',
+            index=models.Index(fields=['book', '-score'], name='co_rated_book_score_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='coratedbook',
+            unique_together={('book', 'similar_book')},
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+
+
+def populate_author_stats(apps, schema_editor):
+    """Roll the existing book aggregates up per author"""
+    AuthorStats = apps.get_model('bookapp', 'AuthorStats')
+    Book = apps.get_model('bookapp', 'Book')
+    totals = Book.objects.order_by().values('author').annotate(
+        book_count=models.Count('id'),
+        rating_sum=models.Sum('rating_sum'),
+        rating_count=models.Sum('rating_count'),
+        review_count=models.Sum('review_count'),
+    )
+    AuthorStats.objects.bulk_create([AuthorStats(**row) for row in totals], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0012_co_rating_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuthorStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('author', models.CharField(max_length=200, unique=True)),
+                ('book_count', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('review_count', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Author Stats',
+                'verbose_name_plural': 'Author Stats',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['author', '-created_at'], name='book_author_created_at_idx'),
+        ),
+        migrations.RunPython(populate_author_stats, migrations.RunPython.noop),
+    ]
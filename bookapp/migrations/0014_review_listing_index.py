@@ -0,0 +1,17 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0013_author_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='bookreview',
+            index=models.Index(fields=['book', 'is_public', 'created_at'], name='review_book_public_created_idx'),
+        ),
+    ]
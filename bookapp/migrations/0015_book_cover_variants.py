@@ -0,0 +1,18 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0014_review_listing_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cover_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0015_book_cover_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PdfDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_name', models.CharField(help_text='Book.pdf name the facts were extracted from', max_length=255)),
+                ('file_size', models.PositiveBigIntegerField(default=0)),
+                ('content_hash', models.CharField(db_index=True, help_text='SHA-256 of the file', max_length=64)),
+                ('page_count', models.PositiveIntegerField(default=0)),
+                ('word_count', models.PositiveIntegerField(default=0)),
+                ('title', models.CharField(blank=True, max_length=500)),
+                ('author', models.CharField(blank=True, max_length=500)),
+                ('error', models.TextField(blank=True, help_text='Why text could not be extracted, if it failed')),
+                ('extracted_at', models.DateTimeField(auto_now=True)),
+                ('book', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pdf_document', to='bookapp.book')),
+            ],
+            options={
+                'verbose_name': 'PDF Document',
+                'verbose_name_plural': 'PDF Documents',
+            },
+        ),
+        migrations.CreateModel(
+            name='PdfPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('text', models.TextField(blank=True)),
+                ('word_count', models.PositiveIntegerField(default=0)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='bookapp.pdfdocument')),
+            ],
+            options={
+                'ordering': ['number'],
+                'unique_together': {('document', 'number')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations
+
+
+def create_page_index(apps, schema_editor):
+    """Create and fill the FTS5 page index, SQLite only"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from bookapp.search import CREATE_PAGE_FTS_SQL, PAGE_FTS_TABLE
+    schema_editor.execute(CREATE_PAGE_FTS_SQL)
+    schema_editor.execute(f"INSERT INTO {PAGE_FTS_TABLE} ({PAGE_FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_page_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from bookapp.search import DROP_PAGE_FTS_SQL
+    schema_editor.execute(DROP_PAGE_FTS_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0016_pdf_documents'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_page_index, drop_page_index),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 3.2.23
+
+import bookapp.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0019_chunked_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('size', models.PositiveBigIntegerField()),
+                ('references', models.PositiveIntegerField(default=0, help_text='Model fields naming this file')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='cover_image',
+            field=models.ImageField(blank=True, null=True, storage=bookapp.storage.ContentAddressedStorage(), upload_to='img/'),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='pdf',
+            field=models.FileField(blank=True, null=True, storage=bookapp.storage.ContentAddressedStorage(), upload_to='pdf/'),
+        ),
+        migrations.AlterField(
+            model_name='userprofile',
+            name='avatar',
+            field=models.ImageField(blank=True, null=True, storage=bookapp.storage.ContentAddressedStorage(), upload_to='avatars/'),
+        ),
+    ]
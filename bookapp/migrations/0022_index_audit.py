@@ -0,0 +1,33 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0021_boot_state'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('recommended_books', True)), fields=['-created_at', '-id'], name='book_recommended_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('fiction_books', True)), fields=['-created_at', '-id'], name='book_fiction_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('business_books', True)), fields=['-created_at', '-id'], name='book_business_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookrating',
+            index=models.Index(fields=['user', '-created_at'], name='rating_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bookreview',
+            index=models.Index(fields=['user', '-created_at'], name='review_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def mark_indexed_books(apps, schema_editor):
+    """Books that already have similar books were ranked by an earlier build"""
+    Book = apps.get_model('bookapp', 'Book')
+    Book.objects.filter(similar_entries__isnull=False).update(similar_indexed_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0022_index_audit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='similar_indexed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(mark_indexed_books, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(condition=models.Q(('similar_indexed_at__isnull', True)), fields=['id'], name='book_similar_unindexed_idx'),
+        ),
+    ]
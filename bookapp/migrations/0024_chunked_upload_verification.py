@@ -0,0 +1,23 @@
+# Generated by Django 3.2.23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bookapp', '0023_book_similar_indexed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunkedupload',
+            name='error',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='status',
+            field=models.CharField(choices=[('uploading', 'Uploading'), ('verifying', 'Verifying'), ('complete', 'Complete'), ('attached', 'Attached'), ('failed', 'Failed')], default='uploading', max_length=10),
+        ),
+    ]
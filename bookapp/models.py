@@ -1,5 +1,8 @@
 from django.db import models
 from django.contrib.auth.models import User
+import uuid
+from . import thumbnails
+from .storage import ContentAddressedStorage
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -16,8 +19,8 @@ class Book(models.Model):
     title = models.CharField(max_length=200)
     author = models.CharField(max_length=200)
     summary = models.TextField()
-    cover_image = models.ImageField(upload_to='img/', blank=True, null=True)
-    pdf = models.FileField(upload_to='pdf/', blank=True, null=True)
+    cover_image = models.ImageField(upload_to='img/', storage=ContentAddressedStorage(), blank=True, null=True)
+    pdf = models.FileField(upload_to='pdf/', storage=ContentAddressedStorage(), blank=True, null=True)
     pdf_url = models.URLField(blank=True, null=True, help_text='Welib.org link as fallback')
     category = models.ManyToManyField(Category)
     slug = models.SlugField(unique=True)
@@ -26,27 +29,112 @@ class Book(models.Model):
     business_books = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # Denormalized rating/review aggregates, maintained by bookapp.aggregates
+    # with F() updates. Save long-held instances with update_fields so a
+    # stale copy cannot overwrite them
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    review_count = models.PositiveIntegerField(default=0, editable=False)
+    # Resized JPEG/WebP covers, maintained by bookapp.thumbnails
+    cover_variants = models.JSONField(default=dict, blank=True, editable=False)
+    # When bookapp.similarity last ranked this book's neighbours, even if none
+    # scored high enough to be stored
+    similar_indexed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='book_created_at_id_idx'),
+            models.Index(fields=['author', '-created_at'], name='book_author_created_at_idx'),
+            # One small index per home page section, newest first
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(recommended_books=True),
+                         name='book_recommended_created_idx'),
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(fiction_books=True),
+                         name='book_fiction_created_idx'),
+            models.Index(fields=['-created_at', '-id'], condition=models.Q(business_books=True),
+                         name='book_business_created_idx'),
+            models.Index(fields=['id'], condition=models.Q(similar_indexed_at__isnull=True),
+                         name='book_similar_unindexed_idx'),
+        ]
+    
+    AGGREGATE_FIELDS = ('rating_sum', 'rating_count', 'review_count')
+    # Compared by the save signals against what the row held when loaded
+    TRACKED_FIELDS = ('author', 'cover_image', 'pdf')
     
     def __str__(self):
         return self.title
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            field: value for field, value in zip(field_names, values)
+            if field in cls.TRACKED_FIELDS and value is not models.DEFERRED
+        }
+        return instance
+    
     @property
     def average_rating(self):
         """Calculate average rating for the book"""
-        ratings = self.ratings.all()
-        if not ratings:
+        if not self.rating_count:
             return 0
-        return sum(rating.rating for rating in ratings) / len(ratings)
+        return self.rating_sum / self.rating_count
+    
+    @property
+    def cover_srcset(self):
+        return thumbnails.srcset(self.cover_variants, 'jpeg')
     
     @property
-    def rating_count(self):
-        """Get total number of ratings"""
-        return self.ratings.count()
+    def cover_webp_srcset(self):
+        return thumbnails.srcset(self.cover_variants, 'webp')
     
     @property
-    def review_count(self):
-        """Get total number of reviews"""
-        return self.reviews.count()
+    def cover_thumbnail(self):
+        """The largest JPEG derivative as {url, width, height}, None before they are built"""
+        variants = self.cover_variants.get('jpeg')
+        if not variants:
+            return None
+        return {
+            'url': self.cover_image.storage.url(variants[-1]['name']),
+            'width': variants[-1]['width'],
+            'height': variants[-1]['height'],
+        }
+
+class AuthorStats(models.Model):
+    """Per-author rollup of the book aggregates, maintained by bookapp.aggregates"""
+    author = models.CharField(max_length=200, unique=True)
+    book_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_count = models.PositiveIntegerField(default=0)
+    review_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "Author Stats"
+        verbose_name_plural = "Author Stats"
+
+    def __str__(self):
+        return self.author
+
+    @property
+    def average_rating(self):
+        """Average rating over all of the author's books"""
+        if not self.rating_count:
+            return 0
+        return self.rating_sum / self.rating_count
+
+class SimilarBook(models.Model):
+    """Precomputed top-K neighbours of a book, built by bookapp.similarity"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_entries')
+    similar_book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_to_entries')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ['book', 'similar_book']
+        indexes = [
+            models.Index(fields=['book', '-score'], name='similar_book_score_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.similar_book_id} is similar to {self.book_id} ({self.score:.3f})"
 
 class BookSearch(models.Model):
     name_of_book = models.CharField(max_length=100)
@@ -78,7 +166,7 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     user_type = models.CharField(max_length=10, choices=USER_TYPE_CHOICES, default='reader')
     bio = models.TextField(blank=True, max_length=500)
-    avatar = models.ImageField(upload_to='avatars/', blank=True, null=True)
+    avatar = models.ImageField(upload_to='avatars/', storage=ContentAddressedStorage(), blank=True, null=True)
     date_of_birth = models.DateField(blank=True, null=True)
     location = models.CharField(max_length=100, blank=True)
     website = models.URLField(blank=True)
@@ -113,6 +201,9 @@ class BookRating(models.Model):
         verbose_name = "Book Rating"
         verbose_name_plural = "Book Ratings"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at'], name='rating_user_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.user.username} rated {self.book.title} {self.rating}/5"
@@ -130,6 +221,204 @@ class BookReview(models.Model):
         verbose_name = "Book Review"
         verbose_name_plural = "Book Reviews"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['book', 'is_public', 'created_at'], name='review_book_public_created_idx'),
+            models.Index(fields=['user', '-created_at'], name='review_user_created_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.user.username}'s review of {self.book.title}"
\ No newline at end of file
+        return f"{self.user.username}'s review of {self.book.title}"
+
+class CoRatedBook(models.Model):
+    """Top-K books rated alike by the same readers, built by bookapp.recommendations"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='co_rated_entries')
+    similar_book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='co_rated_to_entries')
+    score = models.FloatField()
+    support = models.PositiveIntegerField(help_text='Readers who rated both books')
+
+    class Meta:
+        unique_together = ['book', 'similar_book']
+        indexes = [
+            models.Index(fields=['book', '-score'], name='co_rated_book_score_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.similar_book_id} is co-rated with {self.book_id} ({self.score:.3f})"
+
+class UserRecommendation(models.Model):
+    """Precomputed "recommended for you" books, built by bookapp.recommendations"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='book_recommendations')
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='user_recommendations')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ['user', 'book']
+        indexes = [
+            models.Index(fields=['user', '-score'], name='user_recommendation_score_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id} recommended to {self.user_id} ({self.score:.3f})"
+
+class RecommendationRefresh(models.Model):
+    """One run of the recommendation build, incremental runs start from the last one"""
+    started_at = models.DateTimeField()
+    full = models.BooleanField(default=False)
+    books_refreshed = models.PositiveIntegerField(default=0)
+    users_refreshed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        get_latest_by = 'started_at'
+
+    def __str__(self):
+        return f"{'Full' if self.full else 'Incremental'} refresh at {self.started_at}"
+
+class PdfDocument(models.Model):
+    """Facts extracted from a book's PDF, built by bookapp.ingest"""
+    WORDS_PER_MINUTE = 230
+
+    book = models.OneToOneField(Book, on_delete=models.CASCADE, related_name='pdf_document')
+    source_name = models.CharField(max_length=255, help_text='Book.pdf name the facts were extracted from')
+    file_size = models.PositiveBigIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, db_index=True, help_text='SHA-256 of the file')
+    page_count = models.PositiveIntegerField(default=0)
+    word_count = models.PositiveIntegerField(default=0)
+    title = models.CharField(max_length=500, blank=True)
+    author = models.CharField(max_length=500, blank=True)
+    error = models.TextField(blank=True, help_text='Why text could not be extracted, if it failed')
+    extracted_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "PDF Document"
+        verbose_name_plural = "PDF Documents"
+
+    def __str__(self):
+        return f"{self.source_name} ({self.page_count} pages)"
+
+    @property
+    def reading_minutes(self):
+        """Estimated time to read the whole book"""
+        if not self.word_count:
+            return 0
+        return max(1, round(self.word_count / self.WORDS_PER_MINUTE))
+
+    @property
+    def reading_time(self):
+        """reading_minutes for display, such as 45 min or 3 h 20 min"""
+        hours, minutes = divmod(self.reading_minutes, 60)
+        if not hours:
+            return f"{minutes} min"
+        return f"{hours} h {minutes} min" if minutes else f"{hours} h"
+
+class PdfPage(models.Model):
+    """Plain text of one PDF page, numbered from 1"""
+    document = models.ForeignKey(PdfDocument, on_delete=models.CASCADE, related_name='pages')
+    number = models.PositiveIntegerField()
+    text = models.TextField(blank=True)
+    word_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['document', 'number']
+        ordering = ['number']
+
+    def __str__(self):
+        return f"Page {self.number} of {self.document.source_name}"
+
+class Task(models.Model):
+    """One unit of background work, run by manage.py run_worker (see bookapp.tasks)"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict, blank=True)
+    priority = models.SmallIntegerField(default=0, help_text='Higher runs first')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    dedup_key = models.CharField(max_length=200, blank=True, null=True,
+                                 help_text='At most one queued task per key')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField()
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_after'], name='task_claim_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['dedup_key'], condition=models.Q(status='queued'),
+                                    name='task_queued_dedup_key_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+class TaskSchedule(models.Model):
+    """When a periodic task was last queued, the schedules themselves live in bookapp.jobs"""
+    name = models.CharField(max_length=100, unique=True)
+    last_queued_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} last queued at {self.last_queued_at}"
+
+class ChunkedUpload(models.Model):
+    """A file sent in resumable chunks, see bookapp.uploads"""
+    UPLOADING = 'uploading'
+    VERIFYING = 'verifying'
+    COMPLETE = 'complete'
+    ATTACHED = 'attached'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (UPLOADING, 'Uploading'),
+        (VERIFYING, 'Verifying'),
+        (COMPLETE, 'Complete'),
+        (ATTACHED, 'Attached'),
+        (FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    expected_sha256 = models.CharField(max_length=64, blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=UPLOADING)
+    error = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes)"
+
+class MediaBlob(models.Model):
+    """One stored file of the content addressed media storage, see bookapp.storage"""
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.PositiveBigIntegerField()
+    references = models.PositiveIntegerField(default=0, help_text='Model fields naming this file')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references} references)"
+
+class BootState(models.Model):
+    """What manage.py bootstrap last saw, so unchanged work is skipped at the next start"""
+    key = models.CharField(max_length=100, unique=True)
+    value = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} = {self.value}"
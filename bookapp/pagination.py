@@ -0,0 +1,94 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+import base64
+import binascii
+
+
+class KeysetPage:
+    """One page of a keyset paginated queryset, newest first"""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+def encode_cursor(value, pk):
+    """Encode an (ordering value, primary key) pair as an opaque URL-safe cursor"""
+    raw = f'{value.isoformat()}|{pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor from encode_cursor, returns None for anything malformed"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        value, pk = raw.rsplit('|', 1)
+        value = parse_datetime(value)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if value is None:
+        return None
+    return value, pk
+
+
+def paginate_keyset(queryset, after=None, before=None, page_size=24, field='created_at'):
+    """
+    Paginate a queryset newest first on (field, id) using cursors.
+
+    Unlike OFFSET pagination every page is a single index range scan, so
+    page N costs the same as page 1. `after` continues towards older rows
+    and `before` goes back towards newer ones.
+    """
+    descending = [f'-{field}', '-id']
+    position = decode_cursor(before)
+    backwards = position is not None
+    if not backwards:
+        position = decode_cursor(after)
+
+    if position is None:
+        queryset = queryset.order_by(*descending)
+    elif backwards:
+        value, pk = position
+        queryset = queryset.filter(
+            Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': pk})
+        ).order_by(field, 'id')
+    else:
+        value, pk = position
+        queryset = queryset.filter(
+            Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': pk})
+        ).order_by(*descending)
+
+    rows = list(queryset[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows)
+
+    first, last = rows[0], rows[-1]
+    more_older = (has_more and not backwards) or backwards
+    more_newer = (has_more and backwards) or (position is not None and not backwards)
+    return KeysetPage(
+        rows,
+        next_cursor=encode_cursor(getattr(last, field), last.pk) if more_older else None,
+        previous_cursor=encode_cursor(getattr(first, field), first.pk) if more_newer else None,
+    )
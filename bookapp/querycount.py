@@ -0,0 +1,124 @@
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Literals that differ between otherwise identical queries
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+
+def fingerprint(sql):
+    """The shape of a query, with literals and parameter lists folded to ?"""
+    sql = _NUMBER.sub('?', _STRING.sub('?', sql.replace('%s', '?')))
+    return _IN_LIST.sub('(...)', sql)
+
+
+class QueryStats:
+    """
+    Counts and times every query run on the connections it wraps.
+
+    Installed as a connection.execute_wrapper, so it sees the queries of
+    the ORM and of raw cursors alike.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    @property
+    def duplicates(self):
+        """{fingerprint: times run} of the queries run more than once, the N+1 suspects"""
+        return {sql: times for sql, times in self.fingerprints.items() if times > 1}
+
+
+@contextmanager
+def count_queries():
+    """Collect QueryStats of every database connection inside the block"""
+    stats = QueryStats()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(stats))
+        yield stats
+
+
+def budget_for(url_name):
+    return getattr(settings, 'QUERY_BUDGETS', {}).get(url_name)
+
+
+@contextmanager
+def query_budget(budget):
+    """
+    Fail with AssertionError when the block runs more queries than budget.
+
+    budget is a number of queries or the URL name of a view in
+    QUERY_BUDGETS, for tests such as:
+
+        with query_budget('home'):
+            self.client.get(reverse('home'))
+    """
+    limit = budget_for(budget) if isinstance(budget, str) else budget
+    if limit is None:
+        raise AssertionError(f'No query budget set for {budget!r} in QUERY_BUDGETS')
+    with count_queries() as stats:
+        yield stats
+    if stats.count > limit:
+        repeated = ''.join(f'\n  {times}x {sql}' for sql, times in stats.duplicates.items())
+        raise AssertionError(f'{stats.count} queries run, the budget of {budget!r} is {limit}{repeated}')
+
+
+class QueryCountMiddleware:
+    """
+    Report each request's query count, database time and repeated queries.
+
+    With DEBUG they come back as X-DB-* response headers, otherwise they
+    are logged with the URL name as structured fields. Requests over their
+    QUERY_BUDGETS entry are logged as warnings either way.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with count_queries() as stats:
+            response = self.get_response(request)
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.url_name if match else None
+        duplicates = stats.duplicates
+        fields = {
+            'url_name': url_name,
+            'db_queries': stats.count,
+            'db_time_ms': round(stats.seconds * 1000, 2),
+            'db_duplicate_queries': sum(times - 1 for times in duplicates.values()),
+        }
+        if settings.DEBUG:
+            response['X-DB-Query-Count'] = str(fields['db_queries'])
+            response['X-DB-Time-Ms'] = str(fields['db_time_ms'])
+            response['X-DB-Duplicate-Queries'] = str(fields['db_duplicate_queries'])
+        else:
+            logger.info('%s ran %s queries in %s ms', url_name, stats.count, fields['db_time_ms'], extra=fields)
+        budget = budget_for(url_name)
+        if budget is not None and stats.count > budget:
+            worst = max(duplicates.items(), key=lambda item: item[1], default=(None, 0))
+            logger.warning(
+                '%s ran %s queries, over its budget of %s; most repeated (%sx): %s',
+                url_name, stats.count, budget, worst[1], worst[0], extra={**fields, 'db_query_budget': budget},
+            )
+        return response
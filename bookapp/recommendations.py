@@ -0,0 +1,271 @@
+from array import array
+from django.db import transaction
+from django.utils import timezone
+import numpy as np
+from scipy import sparse
+
+from .catalog import bump_recommendations_version
+from .models import Book, BookRating, CoRatedBook, RecommendationRefresh, UserRecommendation
+from .similarity import top_k_per_row, trim_to_top_k
+
+CO_RATED_BOOKS_K = 20
+RECOMMENDATIONS_PER_USER = 12
+# Pairs need this many common raters before their similarity is trusted
+MIN_SUPPORT = 3
+# Similarities are damped by support / (support + SUPPORT_SHRINKAGE)
+SUPPORT_SHRINKAGE = 10
+MIN_SCORE = 0.01
+# Upper bound on the dense block held in memory (rows * books)
+BLOCK_CELLS = 16_000_000
+WRITE_BATCH_SIZE = 5000
+
+
+class RatingMatrix:
+    """
+    Sparse users x books matrix of ratings centered on each user's mean.
+
+    Ratings are streamed into typed arrays, so a million ratings cost a few
+    tens of megabytes rather than a million model instances.
+    """
+
+    def __init__(self):
+        users, books, ratings = array('q'), array('q'), array('b')
+        rows = BookRating.objects.order_by().values_list('user_id', 'book_id', 'rating')
+        for user_id, book_id, rating in rows.iterator(chunk_size=10000):
+            users.append(user_id)
+            books.append(book_id)
+            ratings.append(rating)
+        self.user_ids, user_rows = np.unique(np.frombuffer(users, dtype=np.int64), return_inverse=True)
+        self.book_ids, book_columns = np.unique(np.frombuffer(books, dtype=np.int64), return_inverse=True)
+        ratings = np.frombuffer(ratings, dtype=np.int8).astype(np.float32)
+        shape = (len(self.user_ids), len(self.book_ids))
+
+        rating_counts = np.maximum(np.bincount(user_rows, minlength=shape[0]), 1)
+        user_means = np.bincount(user_rows, weights=ratings, minlength=shape[0]) / rating_counts
+        centered = ratings - user_means[user_rows].astype(np.float32)
+        self.centered = sparse.csr_matrix((centered, (user_rows, book_columns)), shape=shape)
+        self.rated = sparse.csr_matrix((np.ones_like(ratings), (user_rows, book_columns)), shape=shape)
+        self.norms = np.sqrt(np.asarray(self.centered.multiply(self.centered).sum(axis=0)).ravel())
+        self.norms[self.norms == 0] = 1
+
+    def book_columns(self, book_ids):
+        """Matrix columns of the given books, books without ratings are skipped"""
+        return np.intersect1d(self.book_ids, np.fromiter(book_ids, dtype=np.int64), return_indices=True)[1]
+
+    def user_rows(self, user_ids):
+        """Matrix rows of the given users, users without ratings are skipped"""
+        return np.intersect1d(self.user_ids, np.fromiter(user_ids, dtype=np.int64), return_indices=True)[1]
+
+
+def _co_rating_blocks(matrix, columns):
+    """
+    Yield (columns, scores, support) in blocks of rows over every book.
+
+    Scores are the adjusted cosine of the centered rating columns, damped by
+    support and zeroed below MIN_SUPPORT common raters or on the diagonal.
+    """
+    centered_by_book = matrix.centered.T.tocsr()
+    rated_by_book = matrix.rated.T.tocsr()
+    block_size = max(1, BLOCK_CELLS // max(1, len(matrix.book_ids)))
+    for start in range(0, len(columns), block_size):
+        block = columns[start:start + block_size]
+        support = (rated_by_book[block] @ matrix.rated).toarray()
+        scores = (centered_by_book[block] @ matrix.centered).toarray()
+        scores /= matrix.norms[block, None]
+        scores /= matrix.norms[None, :]
+        scores[support < MIN_SUPPORT] = 0
+        damping = support + SUPPORT_SHRINKAGE
+        np.divide(support, damping, out=damping)
+        scores *= damping
+        scores[np.arange(len(block)), block] = 0
+        yield block, scores, support
+
+
+def _co_rated_neighbours(matrix, columns, k):
+    """Yield (columns, scores, support, top k entries) per block, entries as parallel arrays"""
+    for block, scores, support in _co_rating_blocks(matrix, columns):
+        neighbours, best = top_k_per_row(scores, k)
+        keep = best >= MIN_SCORE
+        yield block, scores, support, (
+            np.repeat(block, neighbours.shape[1])[keep.ravel()],
+            neighbours[keep],
+            best[keep],
+            np.take_along_axis(support, neighbours, axis=1)[keep],
+        )
+
+
+def _write_co_rated(matrix, books, neighbours, scores, supports):
+    for start in range(0, len(books), WRITE_BATCH_SIZE):
+        end = start + WRITE_BATCH_SIZE
+        CoRatedBook.objects.bulk_create([
+            CoRatedBook(
+                book_id=int(matrix.book_ids[book]), similar_book_id=int(matrix.book_ids[neighbour]),
+                score=float(score), support=int(support),
+            )
+            for book, neighbour, score, support in zip(books[start:end], neighbours[start:end], scores[start:end], supports[start:end])
+        ], ignore_conflicts=True)
+
+
+def _concatenate(parts, width=4):
+    if not parts:
+        return [np.empty(0, dtype=np.int64)] * width
+    return [np.concatenate(column) for column in zip(*parts)]
+
+
+def rebuild_co_rated_books(matrix, k=CO_RATED_BOOKS_K):
+    """Rebuild the whole co-rated books table, returns the number of books scored"""
+    parts = [entries for _, _, _, entries in _co_rated_neighbours(matrix, np.arange(len(matrix.book_ids)), k)]
+    with transaction.atomic():
+        CoRatedBook.objects.all().delete()
+        _write_co_rated(matrix, *_concatenate(parts))
+    return len(matrix.book_ids)
+
+
+def refresh_co_rated_books(matrix, book_ids, k=CO_RATED_BOOKS_K):
+    """
+    Rescore the given books against every other book.
+
+    Their own lists are rebuilt, and because the similarity is symmetric the
+    same scores are merged into the lists of every other book, which are
+    then trimmed back to k. Returns the number of books scored.
+    """
+    book_ids = set(book_ids)
+    columns = matrix.book_columns(book_ids)
+    dirty = np.zeros(len(matrix.book_ids), dtype=bool)
+    dirty[columns] = True
+    parts = []
+    for block, scores, support, entries in _co_rated_neighbours(matrix, columns, k):
+        parts.append(entries)
+        block_rows, others = np.nonzero((scores >= MIN_SCORE) & ~dirty[None, :])
+        parts.append((others, block[block_rows], scores[block_rows, others], support[block_rows, others]))
+    books, neighbours, scores, supports = _concatenate(parts)
+
+    with transaction.atomic():
+        CoRatedBook.objects.filter(book_id__in=book_ids).delete()
+        CoRatedBook.objects.filter(similar_book_id__in=book_ids).delete()
+        _write_co_rated(matrix, books, neighbours, scores, supports)
+        trim_to_top_k(CoRatedBook, matrix.book_ids[np.unique(books)].tolist(), k)
+    return len(columns)
+
+
+def _neighbour_matrix(matrix):
+    """The stored co-rated lists as a sparse books x books matrix over the rating matrix columns"""
+    books, neighbours, scores = array('q'), array('q'), array('f')
+    for book_id, similar_book_id, score in CoRatedBook.objects.values_list('book_id', 'similar_book_id', 'score').iterator(chunk_size=10000):
+        books.append(book_id)
+        neighbours.append(similar_book_id)
+        scores.append(score)
+    size = len(matrix.book_ids)
+    if not size:
+        return sparse.csr_matrix((0, 0), dtype=np.float32)
+    books, neighbours = np.frombuffer(books, dtype=np.int64), np.frombuffer(neighbours, dtype=np.int64)
+    book_columns = np.minimum(np.searchsorted(matrix.book_ids, books), size - 1)
+    neighbour_columns = np.minimum(np.searchsorted(matrix.book_ids, neighbours), size - 1)
+    # Books whose ratings are all gone since the lists were built drop out
+    known = (matrix.book_ids[book_columns] == books) & (matrix.book_ids[neighbour_columns] == neighbours)
+    return sparse.csr_matrix(
+        (np.frombuffer(scores, dtype=np.float32)[known], (book_columns[known], neighbour_columns[known])),
+        shape=(size, size),
+    )
+
+
+def _user_recommendations(matrix, neighbours, rows, per_user):
+    """
+    Yield UserRecommendation batches for the given user rows.
+
+    A book's score for a user sums the similarity from every book they rated,
+    weighted by how far above their own mean they rated it.
+    """
+    block_size = max(1, BLOCK_CELLS // max(1, len(matrix.book_ids)))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = (matrix.centered[block] @ neighbours).toarray()
+        rated_rows, rated_columns = matrix.rated[block].nonzero()
+        scores[rated_rows, rated_columns] = 0
+        books, best = top_k_per_row(scores, per_user)
+        yield [
+            UserRecommendation(user_id=int(matrix.user_ids[row]), book_id=int(matrix.book_ids[book]), score=float(score))
+            for row, row_books, row_scores in zip(block, books, best)
+            for book, score in zip(row_books, row_scores)
+            if score >= MIN_SCORE
+        ]
+
+
+def rebuild_user_recommendations(matrix, per_user=RECOMMENDATIONS_PER_USER):
+    """Rebuild every user's recommendations, returns the number of users scored"""
+    neighbours = _neighbour_matrix(matrix)
+    with transaction.atomic():
+        UserRecommendation.objects.all().delete()
+        for batch in _user_recommendations(matrix, neighbours, np.arange(len(matrix.user_ids)), per_user):
+            UserRecommendation.objects.bulk_create(batch, batch_size=WRITE_BATCH_SIZE)
+    return len(matrix.user_ids)
+
+
+def refresh_user_recommendations(matrix, user_ids, per_user=RECOMMENDATIONS_PER_USER):
+    """Recompute the recommendations of the given users, returns the number scored"""
+    user_ids = list(set(user_ids))
+    rows = matrix.user_rows(user_ids)
+    neighbours = _neighbour_matrix(matrix)
+    with transaction.atomic():
+        for start in range(0, len(user_ids), 500):
+            UserRecommendation.objects.filter(user_id__in=user_ids[start:start + 500]).delete()
+        for batch in _user_recommendations(matrix, neighbours, rows, per_user):
+            UserRecommendation.objects.bulk_create(batch, batch_size=WRITE_BATCH_SIZE)
+    return len(rows)
+
+
+def refresh_recommendations(full=False):
+    """
+    Bring the co-rated books and user recommendations up to date.
+
+    Incremental runs rescore only the books rated since the previous run and
+    the users who rated them. Neighbour lists of other books and the shift
+    of a reader's mean rating are only settled by a full run, as are deleted
+    ratings, so schedule one periodically. Returns the RecommendationRefresh
+    recorded for this run.
+    """
+    started_at = timezone.now()
+    previous = RecommendationRefresh.objects.order_by('-started_at').first()
+    full = full or previous is None
+    books_refreshed = users_refreshed = 0
+    if full:
+        matrix = RatingMatrix()
+        books_refreshed = rebuild_co_rated_books(matrix)
+        users_refreshed = rebuild_user_recommendations(matrix)
+    else:
+        changed = BookRating.objects.filter(updated_at__gte=previous.started_at).values_list('user_id', 'book_id')
+        user_ids, book_ids = set(), set()
+        for user_id, book_id in changed.iterator():
+            user_ids.add(user_id)
+            book_ids.add(book_id)
+        if book_ids:
+            matrix = RatingMatrix()
+            books_refreshed = refresh_co_rated_books(matrix, book_ids)
+            # Everyone who rated a rescored book may see different recommendations
+            columns = matrix.book_columns(book_ids)
+            raters = matrix.rated.tocsc()[:, columns].nonzero()[0]
+            user_ids.update(matrix.user_ids[np.unique(raters)].tolist())
+            users_refreshed = refresh_user_recommendations(matrix, user_ids)
+    if books_refreshed or users_refreshed:
+        # Book pages show the co-rated lists, so their validators must move
+        bump_recommendations_version()
+    return RecommendationRefresh.objects.create(
+        started_at=started_at, full=full,
+        books_refreshed=books_refreshed, users_refreshed=users_refreshed,
+    )
+
+
+def get_co_rated_books(book, limit=6):
+    """Books most often rated alike by readers of book, best first"""
+    return list(
+        Book.objects.filter(co_rated_to_entries__book=book)
+        .order_by('-co_rated_to_entries__score')[:limit]
+    )
+
+
+def get_recommended_books(user, limit=RECOMMENDATIONS_PER_USER):
+    """The user's precomputed recommendations, best first"""
+    return list(
+        Book.objects.filter(user_recommendations__user=user)
+        .order_by('-user_recommendations__score')[:limit]
+    )
@@ -0,0 +1,151 @@
+from collections import defaultdict
+from difflib import SequenceMatcher
+import heapq
+import math
+import posixpath
+import re
+import urllib.parse
+
+# Words that say nothing about which book a file belongs to
+STOPWORDS = frozenset(
+    'a an and at but by for from in of on or the to with '
+    'book books ebook edition pdf pdfdrive img image images jpeg jpg png gif cover vol'.split()
+)
+# Django appends _ and 7 random letters and digits when an upload name is
+# taken. Unlike a word they have a digit or a capital past the first letter
+_STORAGE_SUFFIX = re.compile(r'_(?=[A-Za-z0-9]{7}$)(?=.*[0-9]|.[A-Za-z0-9]*[A-Z])[A-Za-z0-9]{7}$')
+_TOKEN = re.compile(r'[a-z0-9]+')
+
+# Tokens in more files than this are too common to pick candidates by
+MAX_POSTINGS = 200
+# Tokens one edit apart from a file token (typos, plurals) count this much
+FUZZY_WEIGHT = 0.7
+FUZZY_MIN_LENGTH = 5
+CANDIDATES_PER_BOOK = 3
+# Candidates this close to the best are told apart by edit distance
+TIE_MARGIN = 0.05
+MIN_SCORE = 0.35
+
+
+def tokenize(text):
+    return {token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS and (len(token) > 2 or token.isdigit())}
+
+
+def file_stem(name):
+    """The descriptive part of a file name, without directory, extension or storage suffix"""
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    return _STORAGE_SUFFIX.sub('', stem)
+
+
+def _normalized(text):
+    return ' '.join(_TOKEN.findall(text.lower()))
+
+
+def _deletions(token):
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+def welib_search_url(title):
+    """Welib.org search link offered when a book has no PDF of its own"""
+    clean_title = ' '.join(title.replace(':', '').replace('(', '').replace(')', '').split())
+    return f'https://www.welib.org/search?q={urllib.parse.quote(clean_title)}'
+
+
+class FileIndex:
+    """
+    Inverted index of file name tokens.
+
+    Tokens are weighted by inverse document frequency, so a rare word like
+    'hibiscus' decides a match and a common one barely counts. A
+    one-deletion neighbourhood of each token finds misspelt words without
+    comparing every pair.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.stems = [_normalized(file_stem(name)) for name in self.names]
+        self.postings = defaultdict(list)
+        file_tokens = [tokenize(stem) for stem in self.stems]
+        for position, tokens in enumerate(file_tokens):
+            for token in tokens:
+                self.postings[token].append(position)
+        self.idf = {token: math.log(1 + len(self.names) / len(posting)) for token, posting in self.postings.items()}
+        self.missing_idf = math.log(1 + len(self.names))
+        self.weights = [sum(self.idf[token] for token in tokens) for tokens in file_tokens]
+        self.near = defaultdict(set)
+        for token in self.postings:
+            if len(token) >= FUZZY_MIN_LENGTH:
+                for deletion in _deletions(token):
+                    self.near[deletion].add(token)
+
+    def _matches(self, token):
+        if token in self.postings:
+            return [(token, 1.0)]
+        if len(token) < FUZZY_MIN_LENGTH:
+            return []
+        # Same length with one substitution, or one letter more or less
+        near = set(self.near.get(token, ()))
+        for deletion in _deletions(token):
+            near.update(self.near.get(deletion, ()))
+            if deletion in self.postings:
+                near.add(deletion)
+        return [(match, FUZZY_WEIGHT) for match in near]
+
+    def candidates(self, title, min_score=0.0):
+        """[(score, position)] of the files that best match title, best first"""
+        tokens = tokenize(title)
+        if not tokens:
+            return []
+        shared = defaultdict(float)
+        for token in tokens:
+            for match, factor in self._matches(token):
+                posting = self.postings[match]
+                if len(posting) > MAX_POSTINGS:
+                    continue
+                weight = self.idf[match] * factor
+                for position in posting:
+                    shared[position] += weight
+        if not shared:
+            return []
+        title_weight = sum(self.idf.get(token, self.missing_idf) for token in tokens)
+        # Weighted Dice coefficient of the two token sets
+        ranked = heapq.nlargest(CANDIDATES_PER_BOOK, (
+            (2 * weight / (title_weight + self.weights[position]), position) for position, weight in shared.items()
+        ))
+        best = ranked[0][0]
+        if best < min_score:
+            return []
+        if len(ranked) > 1 and ranked[1][0] >= best - TIE_MARGIN:
+            normalized = _normalized(title)
+            ranked = sorted((
+                (score + TIE_MARGIN * SequenceMatcher(None, normalized, self.stems[position]).ratio(), position)
+                if score >= best - TIE_MARGIN else (score, position)
+                for score, position in ranked
+            ), reverse=True)
+        return ranked
+
+
+def match_files(books, names, min_score=MIN_SCORE):
+    """
+    Pair books with the files whose names best match their titles.
+
+    books is an iterable of (key, title). Every candidate pair is scored
+    once, then pairs are taken best first so each book and each file is
+    used at most once. Returns [(key, name, score)] best first.
+    """
+    index = FileIndex(names)
+    pairs = []
+    for key, title in books:
+        for score, position in index.candidates(title, min_score):
+            if score >= min_score:
+                pairs.append((score, key, position))
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+
+    matched_keys, matched_positions, matches = set(), set(), []
+    for score, key, position in pairs:
+        if key in matched_keys or position in matched_positions:
+            continue
+        matched_keys.add(key)
+        matched_positions.add(position)
+        matches.append((key, index.names[position], round(min(score, 1.0), 3)))
+    return matches
@@ -0,0 +1,126 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+# Clients that wrote recently carry this cookie, the time until which their
+# reads stay on the primary
+STICKY_COOKIE = 'primary_until'
+# Read and written together by the task queue, uploads and storage, or by
+# every request, so never served stale. Users, their profile's user type and
+# permissions decide what a request may do, so a new account or a revoked
+# right must count at once
+PRIMARY_MODELS = frozenset([
+    'auth.Group', 'auth.Permission', 'auth.User',
+    'bookapp.BootState', 'bookapp.ChunkedUpload', 'bookapp.MediaBlob', 'bookapp.Task', 'bookapp.TaskSchedule',
+    'bookapp.UserProfile', 'sessions.Session',
+])
+
+
+class _RequestState:
+    def __init__(self):
+        self.replica = None
+        self.wrote = False
+
+
+_request_state = ContextVar('replica_request_state', default=None)
+
+
+class ReplicaRouter:
+    """
+    Send the reads of views marked with replica_reads to a read replica.
+
+    Everything else goes to the primary: writes, reads outside those views,
+    reads once the request has written or inside a transaction, and every
+    read of a client that wrote within REPLICA_STICKY_SECONDS, which should
+    exceed the replicas' worst lag.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        if state is None or state.replica is None or state.wrote:
+            return None
+        if model._meta.label in PRIMARY_MODELS or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # Replicas get their schema with the data they copy
+        return db == DEFAULT_DB_ALIAS
+
+
+def read_database(model):
+    """Alias raw SQL reading model's tables should run on, like the ORM would"""
+    return router.db_for_read(model) or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside the block, for results that outlive the request"""
+    state = _request_state.get()
+    if state is None:
+        yield
+        return
+    replica, state.replica = state.replica, None
+    try:
+        yield
+    finally:
+        state.replica = replica
+
+
+class ReplicaMiddleware:
+    """Track writes per request and keep the client on the primary for a while after one"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = _RequestState()
+        token = _request_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_state.reset(token)
+        if state.wrote:
+            response.set_cookie(
+                STICKY_COOKIE, str(int(time.time()) + settings.REPLICA_STICKY_SECONDS),
+                max_age=settings.REPLICA_STICKY_SECONDS, httponly=True, samesite='Lax',
+            )
+        return response
+
+
+def _sticky(request):
+    try:
+        return int(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def replica_reads(view_func):
+    """
+    Let a view that only reads, whatever the method, read from one of the
+    REPLICA_DATABASES. Should it write after all, its later reads return
+    to the primary.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        state = _request_state.get()
+        if state is not None and settings.REPLICA_DATABASES and not _sticky(request):
+            # One replica for the whole request, so its reads agree
+            state.replica = random.choice(settings.REPLICA_DATABASES)
+        return view_func(request, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,241 @@
+from collections import defaultdict
+from django.db import connection, connections
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+import re
+
+from .models import Book, Category, PdfDocument, PdfPage
+from .routers import read_database
+
+BOOK_FTS_TABLE = 'bookapp_book_fts'
+
+# bm25() column weights for title, author, summary and categories
+BOOK_FTS_WEIGHTS = (10.0, 5.0, 1.0, 2.0)
+
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+SNIPPET_TOKENS = 16
+
+CREATE_BOOK_FTS_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {BOOK_FTS_TABLE} USING fts5("
+    "title, author, summary, categories, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+DROP_BOOK_FTS_SQL = f'DROP TABLE IF EXISTS {BOOK_FTS_TABLE}'
+
+# Page text lives in PdfPage, the index only references it (external content)
+PAGE_FTS_TABLE = 'bookapp_pdfpage_fts'
+CREATE_PAGE_FTS_SQL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {PAGE_FTS_TABLE} USING fts5("
+    f"text, content = '{PdfPage._meta.db_table}', content_rowid = 'id', "
+    "tokenize = 'unicode61 remove_diacritics 2')"
+)
+DROP_PAGE_FTS_SQL = f'DROP TABLE IF EXISTS {PAGE_FTS_TABLE}'
+PAGE_SNIPPET_TOKENS = 24
+
+
+def search_index_available():
+    """The FTS5 index only exists on SQLite"""
+    return connection.vendor == 'sqlite'
+
+
+def build_match_query(text, prefix_last_only=False):
+    """
+    Turn free text into an FTS5 MATCH expression.
+
+    Every word becomes a quoted prefix term so user input can never be
+    parsed as FTS5 syntax, and all terms must match. With prefix_last_only
+    only the word being typed is a prefix, which keeps queries over large
+    vocabularies such as page text fast.
+    """
+    terms = re.findall(r'\w+', text.lower())
+    if not terms:
+        return None
+    if prefix_last_only:
+        return ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def highlight_snippet(snippet):
+    """Escape an FTS5 snippet and turn the match markers into <mark> tags"""
+    html = escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+    return mark_safe(html)
+
+
+def _like_pattern(text):
+    """A LIKE pattern for text anywhere in a value, as icontains builds it"""
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{text}%'
+
+
+def search_books(text, limit=100, category=None, author=None):
+    """
+    Return [(book_id, snippet)] for the best BM25 matches of text.
+
+    Snippets are taken from whichever column matched best and are already
+    escaped and highlighted. The category and author filters match like
+    icontains and are applied inside the query, before the limit.
+    """
+    match = build_match_query(text)
+    if match is None:
+        return []
+    weights = ', '.join(str(weight) for weight in BOOK_FTS_WEIGHTS)
+    sql = (
+        f"SELECT {BOOK_FTS_TABLE}.rowid, snippet({BOOK_FTS_TABLE}, -1, %s, %s, '…', %s) "
+        f"FROM {BOOK_FTS_TABLE} WHERE {BOOK_FTS_TABLE} MATCH %s"
+    )
+    params = [SNIPPET_START, SNIPPET_END, SNIPPET_TOKENS, match]
+    if author:
+        sql += (
+            f" AND EXISTS (SELECT 1 FROM {Book._meta.db_table} book "
+            f"WHERE book.id = {BOOK_FTS_TABLE}.rowid AND book.author LIKE %s ESCAPE '\\')"
+        )
+        params.append(_like_pattern(author))
+    if category:
+        through = Book.category.through
+        sql += (
+            f" AND EXISTS (SELECT 1 FROM {through._meta.db_table} book_category "
+            f"JOIN {Category._meta.db_table} category ON category.id = book_category.category_id "
+            f"WHERE book_category.book_id = {BOOK_FTS_TABLE}.rowid AND category.name LIKE %s ESCAPE '\\')"
+        )
+        params.append(_like_pattern(category))
+    sql += f" ORDER BY bm25({BOOK_FTS_TABLE}, {weights}) LIMIT %s"
+    params.append(limit)
+    with connections[read_database(Book)].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(book_id, highlight_snippet(snippet)) for book_id, snippet in cursor.fetchall()]
+
+
+def _index_rows(books):
+    # Plain values rather than model instances, bulk imports index thousands of books at once
+    rows = list(books.values_list('id', 'title', 'author', 'summary'))
+    categories = defaultdict(list)
+    through = Book.category.through.objects.filter(book_id__in=[row[0] for row in rows])
+    for book_id, name in through.values_list('book_id', 'category__name'):
+        categories[book_id].append(name)
+    return [(*row, ' '.join(categories[row[0]])) for row in rows]
+
+
+def index_books(book_ids):
+    """(Re)index the given books, dropping ids that no longer exist"""
+    if not search_index_available():
+        return
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+    rows = _index_rows(Book.objects.filter(id__in=book_ids))
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {BOOK_FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in book_ids])
+        cursor.executemany(
+            f'INSERT INTO {BOOK_FTS_TABLE} (rowid, title, author, summary, categories) VALUES (%s, %s, %s, %s, %s)',
+            rows,
+        )
+
+
+def remove_books(book_ids):
+    """Drop the given books from the index"""
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {BOOK_FTS_TABLE} WHERE rowid = %s', [(pk,) for pk in book_ids])
+
+
+def rebuild_index(batch_size=1000):
+    """Rebuild the whole index in id ordered batches, returns the number of books indexed"""
+    if not search_index_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_BOOK_FTS_SQL)
+        cursor.execute(f'DELETE FROM {BOOK_FTS_TABLE}')
+    indexed = 0
+    last_id = 0
+    while True:
+        rows = _index_rows(Book.objects.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not rows:
+            break
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {BOOK_FTS_TABLE} (rowid, title, author, summary, categories) VALUES (%s, %s, %s, %s, %s)',
+                rows,
+            )
+        indexed += len(rows)
+        last_id = rows[-1][0]
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {BOOK_FTS_TABLE} ({BOOK_FTS_TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+def search_pages(text, book_id=None, limit=50):
+    """
+    Return [(book_id, page_number, snippet)] for PDF pages matching text.
+
+    Across the catalog pages are ranked by BM25, inside one book they come
+    in page order. Snippets are already escaped and highlighted.
+    """
+    match = build_match_query(text, prefix_last_only=True)
+    if match is None or not search_index_available():
+        return []
+    page_table, document_table = PdfPage._meta.db_table, PdfDocument._meta.db_table
+    sql = (
+        f"SELECT document.book_id, page.number, snippet({PAGE_FTS_TABLE}, 0, %s, %s, '…', %s) "
+        f"FROM {PAGE_FTS_TABLE} "
+        f"JOIN {page_table} page ON page.id = {PAGE_FTS_TABLE}.rowid "
+        f"JOIN {document_table} document ON document.id = page.document_id "
+        f"WHERE {PAGE_FTS_TABLE} MATCH %s"
+    )
+    params = [SNIPPET_START, SNIPPET_END, PAGE_SNIPPET_TOKENS, match]
+    if book_id is None:
+        sql += f" ORDER BY bm25({PAGE_FTS_TABLE}) LIMIT %s"
+    else:
+        # A document's pages are written together, so their ids form one
+        # range that FTS5 can restrict itself to
+        sql += (
+            f" AND {PAGE_FTS_TABLE}.rowid BETWEEN "
+            f"(SELECT MIN(page.id) FROM {page_table} page JOIN {document_table} document ON document.id = page.document_id WHERE document.book_id = %s) AND "
+            f"(SELECT MAX(page.id) FROM {page_table} page JOIN {document_table} document ON document.id = page.document_id WHERE document.book_id = %s) "
+            "AND document.book_id = %s ORDER BY page.number LIMIT %s"
+        )
+        params += [book_id, book_id, book_id]
+    params.append(limit)
+    with connections[read_database(PdfPage)].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [(book, number, highlight_snippet(snippet)) for book, number, snippet in cursor.fetchall()]
+
+
+def index_document_pages(document_id):
+    """Add a document's stored pages to the page index, the text is copied inside SQLite"""
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {PAGE_FTS_TABLE} (rowid, text) "
+            f"SELECT id, text FROM {PdfPage._meta.db_table} WHERE document_id = %s",
+            [document_id],
+        )
+
+
+def unindex_document_pages(document_id):
+    """Drop a document's pages from the page index, call before the pages are deleted"""
+    if not search_index_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {PAGE_FTS_TABLE} ({PAGE_FTS_TABLE}, rowid, text) "
+            f"SELECT 'delete', id, text FROM {PdfPage._meta.db_table} WHERE document_id = %s",
+            [document_id],
+        )
+
+
+def rebuild_page_index():
+    """
+    Rebuild the page index from PdfPage, returns the number of pages indexed.
+
+    FTS5 reads the pages itself, so no page text passes through Python.
+    """
+    if not search_index_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_PAGE_FTS_SQL)
+        cursor.execute(f"INSERT INTO {PAGE_FTS_TABLE} ({PAGE_FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {PAGE_FTS_TABLE} ({PAGE_FTS_TABLE}) VALUES ('optimize')")
+    return PdfPage.objects.count()
@@ -1,7 +1,15 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.dispatch import receiver
-from .models import UserProfile
+from datetime import timedelta
+from .models import UserProfile, Book, Category, BookRating, BookReview, PdfDocument
+from .catalog import bump_catalog_version
+from .aggregates import adjust_book_aggregates, refresh_author_stats
+from . import ingest, search, tasks, thumbnails
+
+CATALOG_WARM_DELAY = timedelta(seconds=30)
+CATALOG_WARM_PENDING_KEY = 'catalog:warm_pending'
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -16,3 +24,138 @@ def save_user_profile(sender, instance, **kwargs):
         instance.profile.save()
     except UserProfile.DoesNotExist:
         UserProfile.objects.create(user=instance)
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog(sender, **kwargs):
+    """Invalidate cached catalog pages when a book or category changes"""
+    bump_catalog_version()
+    # Rebuild the shared fragments shortly after a burst of changes settles.
+    # One queued warm-up covers every change made before it runs, so the
+    # rest of the burst skips the task queue
+    if cache.add(CATALOG_WARM_PENDING_KEY, True, CATALOG_WARM_DELAY.total_seconds()):
+        tasks.enqueue('warm_catalog_cache', dedup_key='warm_catalog_cache', delay=CATALOG_WARM_DELAY)
+
+@receiver(m2m_changed, sender=Book.category.through)
+def invalidate_catalog_categories(sender, action, **kwargs):
+    """Invalidate cached catalog pages when book categories change"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_catalog_version()
+
+@receiver(post_delete, sender=BookRating)
+def remove_rating_from_aggregates(sender, instance, **kwargs):
+    """Keep the book aggregates in step when a rating is deleted"""
+    adjust_book_aggregates(instance.book_id, rating_sum=-instance.rating, rating_count=-1)
+
+@receiver(post_delete, sender=BookReview)
+def remove_review_from_aggregates(sender, instance, **kwargs):
+    """Keep the book aggregates in step when a review is deleted"""
+    adjust_book_aggregates(instance.book_id, review_count=-1)
+
+@receiver(pre_save, sender=Book)
+def remember_book_author(sender, instance, **kwargs):
+    """Note the author and media the book had before this save, for the post_save receivers"""
+    if instance._state.adding:
+        return
+    previous = getattr(instance, '_loaded_values', {})
+    if len(previous) < len(Book.TRACKED_FIELDS):
+        # Built by hand or loaded with those fields deferred
+        previous = Book.objects.filter(pk=instance.pk).values(*Book.TRACKED_FIELDS).first() or {}
+    instance._previous_author = previous.get('author')
+    instance._previous_media = {field: previous.get(field) for field in ('cover_image', 'pdf')}
+    # A later save of this instance compares against what this one writes
+    instance._loaded_values = {
+        'author': instance.author, 'cover_image': instance.cover_image.name, 'pdf': instance.pdf.name,
+    }
+
+@receiver(post_save, sender=Book)
+def update_author_stats(sender, instance, created, **kwargs):
+    """Keep the author rollups in step when a book is added or changes author"""
+    previous_author = getattr(instance, '_previous_author', None)
+    if created or previous_author != instance.author:
+        refresh_author_stats(instance.author, previous_author)
+
+@receiver(post_delete, sender=Book)
+def remove_book_from_author_stats(sender, instance, **kwargs):
+    """Keep the author rollup in step when a book is deleted"""
+    refresh_author_stats(instance.author)
+
+@receiver(post_save, sender=Book)
+def update_cover_variants(sender, instance, **kwargs):
+    """Have the worker build the resized covers whenever a book gets a new cover image"""
+    if not thumbnails.variants_are_current(instance):
+        tasks.enqueue('build_cover_variants', dedup_key=f'build_cover_variants:{instance.pk}', book_id=instance.pk)
+
+@receiver(post_save, sender=Book)
+def extract_book_pdf(sender, instance, **kwargs):
+    """Extract a newly attached PDF in the background"""
+    if not instance.pdf:
+        PdfDocument.objects.filter(book_id=instance.pk).delete()
+    elif ingest.needs_ingestion(instance):
+        ingest.schedule_ingestion(instance.pk)
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, **kwargs):
+    """Keep the full-text search index current when a book is saved"""
+    search.index_books([instance.pk])
+
+@receiver(post_save, sender=Book)
+def release_replaced_media(sender, instance, **kwargs):
+    """Drop the storage reference of a cover or PDF the book no longer uses"""
+    for field, previous in getattr(instance, '_previous_media', {}).items():
+        if previous and previous != getattr(instance, field).name:
+            getattr(instance, field).storage.delete(previous)
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=UserProfile)
+def release_deleted_media(sender, instance, **kwargs):
+    """Drop the storage references of a deleted book's or profile's files"""
+    for field in ('cover_image', 'pdf', 'avatar'):
+        field_file = getattr(instance, field, None)
+        if field_file:
+            field_file.storage.delete(field_file.name)
+
+@receiver(post_delete, sender=Book)
+def remove_cover_variants(sender, instance, **kwargs):
+    """Resized covers go with their book, unless another book shares the cover"""
+    if not instance.cover_image or not Book.objects.filter(cover_image=instance.cover_image.name).exists():
+        thumbnails.delete_cover_variants(instance.cover_variants)
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    """Drop deleted books from the full-text search index"""
+    search.remove_books([instance.pk])
+
+@receiver(m2m_changed, sender=Book.category.through)
+def index_book_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    """Reindex books whose category names changed"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        search.index_books([instance.pk])
+    elif pk_set:
+        search.index_books(pk_set)
+    else:
+        search.index_books(instance.book_set.values_list('id', flat=True))
+
+@receiver(post_save, sender=Category)
+def index_category_books(sender, instance, created, **kwargs):
+    """A renamed category changes the indexed text of all of its books"""
+    if not created:
+        search.index_books(instance.book_set.values_list('id', flat=True))
+
+@receiver(pre_delete, sender=Category)
+def remember_category_books(sender, instance, **kwargs):
+    instance._indexed_book_ids = list(instance.book_set.values_list('id', flat=True))
+
+@receiver(post_delete, sender=Category)
+def index_deleted_category_books(sender, instance, **kwargs):
+    """Reindex the books of a deleted category once it is gone"""
+    search.index_books(getattr(instance, '_indexed_book_ids', []))
+
+@receiver(pre_delete, sender=PdfDocument)
+def unindex_document_pages(sender, instance, **kwargs):
+    """Page index rows must go while the page text they reference still exists"""
+    search.unindex_document_pages(instance.pk)
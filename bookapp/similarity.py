@@ -0,0 +1,349 @@
+from collections import Counter
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+import logging
+import numpy as np
+from scipy import sparse
+import os
+import re
+import tempfile
+import zipfile
+
+from .catalog import bump_catalog_version
+from .models import Book, SimilarBook
+
+SIMILAR_BOOKS_K = 12
+
+# Scores are TEXT_WEIGHT * TF-IDF cosine + CATEGORY_WEIGHT * category cosine
+TEXT_WEIGHT = 0.7
+CATEGORY_WEIGHT = 0.3
+# A title word counts as this many summary words
+TITLE_BOOST = 3
+# Terms in more than this share of books say nothing about similarity
+MAX_DOCUMENT_FREQUENCY = 0.5
+MIN_SCORE = 0.05
+# Upper bound on the dense similarity block held in memory (rows * books)
+BLOCK_CELLS = 16_000_000
+
+STOP_WORDS = frozenset("""
+    a about after all also an and any are as at be been before being but by can could did do does
+    for from had has have he her his how i if in into is it its just more most my no not of on one
+    or our out over she so some such than that the their them then there these they this those to
+    up was we were what when where which who will with would you your
+""".split())
+
+logger = logging.getLogger(__name__)
+
+
+def _tokens(text):
+    return [token for token in re.findall(r'[^\W\d_]{2,}', (text or '').lower()) if token not in STOP_WORDS]
+
+
+def _normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+def _book_terms(title, summary):
+    terms = Counter(_tokens(summary))
+    for token in _tokens(title):
+        terms[token] += TITLE_BOOST
+    return terms
+
+
+class BookVectors:
+    """
+    One L2-normalized row per book, with the vocabulary, IDF weights and
+    category columns the rows were built with.
+
+    A row is the weighted concatenation of the book's TF-IDF vector over
+    title and summary and its category indicator vector, so the dot product
+    of two rows is the combined similarity score. Books added later are
+    vectorized with the same weights, ignoring terms and categories the
+    build did not see.
+    """
+
+    def __init__(self, book_ids, matrix, vocabulary, idf, category_columns):
+        self.book_ids = book_ids
+        self.matrix = matrix
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.category_columns = category_columns
+
+    def _rows(self, book_ids, rows, columns, counts, book_categories):
+        """Normalized matrix of the given term counts and (book_id, category_id) pairs"""
+        columns = np.asarray(columns, dtype=np.int64)
+        weights = np.log1p(np.asarray(counts, dtype=np.float64)) * self.idf[columns]
+        text = sparse.csr_matrix((weights, (rows, columns)), shape=(len(book_ids), len(self.vocabulary)))
+        text.eliminate_zeros()
+
+        position = {book_id: row for row, book_id in enumerate(book_ids)}
+        category_rows, category_cols = [], []
+        for book_id, category_id in book_categories:
+            if book_id in position and category_id in self.category_columns:
+                category_rows.append(position[book_id])
+                category_cols.append(self.category_columns[category_id])
+        categories = sparse.csr_matrix(
+            (np.ones(len(category_rows)), (category_rows, category_cols)),
+            shape=(len(book_ids), len(self.category_columns)),
+        )
+        return sparse.hstack([
+            _normalize_rows(text) * np.sqrt(TEXT_WEIGHT),
+            _normalize_rows(categories) * np.sqrt(CATEGORY_WEIGHT),
+        ]).tocsr().astype(np.float32)
+
+    def add_books(self, book_ids):
+        """Drop the rows of deleted books and append rows for books not vectorized yet"""
+        live = np.isin(self.book_ids, list(Book.objects.values_list('id', flat=True)))
+        if not live.all():
+            self.book_ids, self.matrix = self.book_ids[live], self.matrix[np.flatnonzero(live)]
+        known = set(self.book_ids.tolist())
+        new_ids, rows, columns, counts = [], [], [], []
+        books = Book.objects.filter(id__in=[pk for pk in set(book_ids) if pk not in known])
+        for row, (book_id, title, summary) in enumerate(books.order_by('id').values_list('id', 'title', 'summary')):
+            new_ids.append(book_id)
+            for term, count in _book_terms(title, summary).items():
+                if term in self.vocabulary:
+                    rows.append(row)
+                    columns.append(self.vocabulary[term])
+                    counts.append(count)
+        if new_ids:
+            self.book_ids = np.concatenate([self.book_ids, np.asarray(new_ids, dtype=np.int64)])
+            book_categories = Book.category.through.objects.filter(book_id__in=new_ids).values_list('book_id', 'category_id')
+            self.matrix = sparse.vstack([self.matrix, self._rows(new_ids, rows, columns, counts, book_categories)]).tocsr()
+
+
+def build_book_vectors():
+    """Vectorize every book, fitting the vocabulary and IDF weights to the whole catalog"""
+    book_ids = []
+    vocabulary = {}
+    rows, columns, counts = [], [], []
+    books = Book.objects.order_by('id').values_list('id', 'title', 'summary')
+    for row, (book_id, title, summary) in enumerate(books.iterator(chunk_size=2000)):
+        book_ids.append(book_id)
+        for term, count in _book_terms(title, summary).items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(count)
+
+    size = len(book_ids)
+    document_frequency = np.bincount(np.asarray(columns, dtype=np.int64), minlength=len(vocabulary))
+    idf = np.log((1 + size) / (1 + document_frequency)) + 1
+    idf[document_frequency > max(1, MAX_DOCUMENT_FREQUENCY * size)] = 0
+    category_ids = Book.category.through.objects.order_by().values_list('category_id', flat=True).distinct()
+    category_columns = {category_id: column for column, category_id in enumerate(sorted(category_ids))}
+
+    vectors = BookVectors(np.asarray(book_ids, dtype=np.int64), None, vocabulary, idf, category_columns)
+    book_categories = Book.category.through.objects.values_list('book_id', 'category_id').iterator()
+    vectors.matrix = vectors._rows(book_ids, rows, columns, counts, book_categories)
+    return vectors
+
+
+def save_book_vectors(vectors):
+    """
+    Store vectors in SIMILARITY_VECTORS_FILE for the workers that index new
+    books. The file is replaced in one rename, so readers never see half of it.
+    """
+    path = settings.SIMILARITY_VECTORS_FILE
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    matrix = vectors.matrix.tocsr()
+    handle = tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False)
+    try:
+        with handle:
+            np.savez(
+                handle,
+                book_ids=vectors.book_ids,
+                data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=np.asarray(matrix.shape),
+                terms=np.asarray(sorted(vectors.vocabulary, key=vectors.vocabulary.get), dtype=str),
+                idf=vectors.idf,
+                category_ids=np.asarray(sorted(vectors.category_columns, key=vectors.category_columns.get), dtype=np.int64),
+            )
+        os.replace(handle.name, path)
+    except BaseException:
+        os.remove(handle.name)
+        raise
+
+
+def load_book_vectors(new_book_ids=()):
+    """The vectors of the last build with new_book_ids added, None when none are stored"""
+    path = settings.SIMILARITY_VECTORS_FILE
+    try:
+        with np.load(path, allow_pickle=False) as stored:
+            matrix = sparse.csr_matrix(
+                (stored['data'], stored['indices'], stored['indptr']), shape=tuple(stored['shape']),
+            )
+            vectors = BookVectors(
+                stored['book_ids'], matrix,
+                {term: column for column, term in enumerate(stored['terms'].tolist())},
+                stored['idf'],
+                {category_id: column for column, category_id in enumerate(stored['category_ids'].tolist())},
+            )
+    except FileNotFoundError:
+        return None
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        logger.warning('Could not read the similarity vectors in %s', path, exc_info=True)
+        return None
+    vectors.add_books(new_book_ids)
+    return vectors
+
+
+def _score_blocks(matrix, rows):
+    """Yield (rows, dense scores of those rows against every book), self matches zeroed"""
+    transposed = matrix.T.tocsr()
+    block_size = max(1, BLOCK_CELLS // max(1, matrix.shape[0]))
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = (matrix[block] @ transposed).toarray()
+        scores[np.arange(len(block)), block] = 0
+        yield block, scores
+
+
+def top_k_per_row(scores, k):
+    """Return (columns, scores) of the k best scores per row, best first"""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        columns = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    best = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-best, axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1), np.take_along_axis(best, order, axis=1)
+
+
+def _neighbour_entries(book_ids, matrix, rows, k):
+    """Yield (scores block, SimilarBook rows) for the top k neighbours of each row"""
+    for block, scores in _score_blocks(matrix, rows):
+        columns, best = top_k_per_row(scores, k)
+        entries = [
+            SimilarBook(book_id=int(book_ids[row]), similar_book_id=int(book_ids[column]), score=float(score))
+            for row, row_columns, row_scores in zip(block, columns, best)
+            for column, score in zip(row_columns, row_scores)
+            if score >= MIN_SCORE
+        ]
+        yield block, scores, entries
+
+
+def rebuild_similar_books(k=SIMILAR_BOOKS_K, batch_size=5000):
+    """
+    Rebuild the whole similar books table, returns the number of books indexed.
+
+    Neighbours are written one scored block at a time, each block replacing
+    its books' rows in a short transaction, so neither the write lock nor
+    memory grow with the catalog.
+    """
+    vectors = build_book_vectors()
+    book_ids = vectors.book_ids
+    indexed_at = timezone.now()
+    if len(book_ids) > 1:
+        for block, _, entries in _neighbour_entries(book_ids, vectors.matrix, np.arange(len(book_ids)), k):
+            block_ids = book_ids[block].tolist()
+            with transaction.atomic():
+                SimilarBook.objects.filter(book_id__in=block_ids).delete()
+                SimilarBook.objects.bulk_create(entries, batch_size=batch_size)
+                Book.objects.filter(id__in=block_ids).update(similar_indexed_at=indexed_at)
+    else:
+        Book.objects.filter(id__in=book_ids.tolist()).update(similar_indexed_at=indexed_at)
+    save_book_vectors(vectors)
+    bump_catalog_version()
+    return len(book_ids)
+
+
+def update_similar_books(new_book_ids, k=SIMILAR_BOOKS_K, batch_size=5000):
+    """
+    Index newly added books without rebuilding the whole table.
+
+    Only the new books are vectorized, with the weights of the last full
+    rebuild. They get their own top k, and every existing book whose top k
+    a new book beats has it merged in. Scores of existing pairs keep the IDF
+    weights they were built with until the next full rebuild. Returns the
+    number of books indexed. Without stored vectors every book is rebuilt,
+    as scores with newly fitted weights would not compare with the stored ones.
+    """
+    vectors = load_book_vectors(new_book_ids)
+    if vectors is None:
+        logger.warning('No similarity vectors stored, rebuilding the similar books of every book')
+        return rebuild_similar_books(k=k, batch_size=batch_size)
+    book_ids = vectors.book_ids
+    position = {int(book_id): row for row, book_id in enumerate(book_ids)}
+    rows = np.asarray(sorted(position[pk] for pk in set(new_book_ids) if pk in position), dtype=np.int64)
+    if not len(rows):
+        return 0
+    new_ids = book_ids[rows].tolist()
+    if len(book_ids) < 2:
+        Book.objects.filter(id__in=new_ids).update(similar_indexed_at=timezone.now())
+        return len(rows)
+
+    # A neighbour displaces an existing entry when it beats the book's weakest one
+    thresholds = np.full(len(book_ids), MIN_SCORE, dtype=np.float32)
+    existing = SimilarBook.objects.exclude(book_id__in=new_ids).order_by().values('book')
+    for row in existing.annotate(count=Count('id'), lowest=Min('score')):
+        if row['count'] >= k and row['book'] in position:
+            thresholds[position[row['book']]] = max(row['lowest'], MIN_SCORE)
+    thresholds[rows] = np.inf
+
+    entries = []
+    for block, scores, block_entries in _neighbour_entries(book_ids, vectors.matrix, rows, k):
+        entries.extend(block_entries)
+        # Similarity is symmetric, so column scores are the new books' scores for everyone else
+        new_rows, others = np.nonzero(scores >= thresholds)
+        entries.extend(
+            SimilarBook(book_id=int(book_ids[other]), similar_book_id=int(book_ids[block[new_row]]), score=float(scores[new_row, other]))
+            for new_row, other in zip(new_rows, others)
+        )
+
+    affected = {entry.book_id for entry in entries}
+    with transaction.atomic():
+        SimilarBook.objects.filter(book_id__in=new_ids).delete()
+        SimilarBook.objects.bulk_create(entries, batch_size=batch_size, ignore_conflicts=True)
+        trim_to_top_k(SimilarBook, affected, k)
+        Book.objects.filter(id__in=new_ids).update(similar_indexed_at=timezone.now())
+        bump_catalog_version()
+    save_book_vectors(vectors)
+    return len(rows)
+
+
+def trim_to_top_k(model, book_ids, k, chunk_size=500):
+    """Delete all but the k best scored rows of model per book"""
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), chunk_size):
+        entries = (
+            model.objects.filter(book_id__in=book_ids[start:start + chunk_size])
+            .order_by('book_id', '-score').values_list('id', 'book_id')
+        )
+        kept = Counter()
+        surplus = []
+        for entry_id, book_id in entries:
+            kept[book_id] += 1
+            if kept[book_id] > k:
+                surplus.append(entry_id)
+        for surplus_start in range(0, len(surplus), chunk_size):
+            model.objects.filter(id__in=surplus[surplus_start:surplus_start + chunk_size]).delete()
+
+
+def unindexed_book_ids():
+    """Ids of books whose neighbours have not been ranked yet"""
+    return list(Book.objects.filter(similar_indexed_at__isnull=True).values_list('id', flat=True))
+
+
+def get_similar_books(book, limit=SIMILAR_BOOKS_K):
+    """
+    Return the precomputed most similar books, best first, in one query.
+
+    Books that have not been indexed yet fall back to the newest books
+    sharing one of their categories.
+    """
+    similar_books = list(
+        Book.objects.filter(similar_to_entries__book=book)
+        .order_by('-similar_to_entries__score')
+        .prefetch_related('category')[:limit]
+    )
+    if not similar_books:
+        similar_books = list(
+            Book.objects.filter(category__in=book.category.all()).exclude(pk=book.pk).distinct()
+            .order_by('-created_at', '-id').prefetch_related('category')[:limit]
+        )
+    return similar_books
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+MIB = 1024 * 1024
+
+# PRAGMAs run on every new connection, chosen with SQLITE_PROFILE
+PROFILES = {
+    # Whatever the sqlite3 module and the database file already use
+    'default': {},
+    'production': {
+        # First, so the statements below wait for a lock instead of failing
+        'busy_timeout': 5000,
+        # Readers no longer block the writer and the writer no longer blocks readers
+        'journal_mode': 'WAL',
+        # Safe with WAL, a power cut can only lose the last commits
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * MIB,
+        # Negative means KiB, so 64 MiB of page cache per connection
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def profile_pragmas(profile=None):
+    profile = profile or settings.SQLITE_PROFILE
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ImproperlyConfigured(f"SQLITE_PROFILE must be one of {', '.join(PROFILES)}, not {profile!r}")
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    """Apply the SQLite profile as each connection opens"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = profile_pragmas()
+    if not pragmas:
+        return
+    # One script on the driver connection: this is connection setup, which
+    # the query counters would otherwise charge to whichever request opened it
+    connection.connection.executescript(''.join(f'PRAGMA {name} = {value};' for name, value in pragmas.items()))
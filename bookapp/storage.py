@@ -0,0 +1,231 @@
+from collections import Counter
+from datetime import timedelta
+from django.apps import apps
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.deconstruct import deconstructible
+import hashlib
+import os
+import posixpath
+import shutil
+import tempfile
+
+BLOB_DIR = 'blobs'
+HASH_BLOCK_SIZE = 1024 * 1024
+# Blobs without references are only collected after this long, a file is
+# saved to storage a moment before the row naming it
+BLOB_GRACE = timedelta(hours=1)
+
+
+def _blobs():
+    # Imported lazily, models.py needs this module for its field storage
+    return apps.get_model('bookapp', 'MediaBlob')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def link_or_copy(source, target):
+    """Hardlink source to target, copying only when the filesystem cannot link"""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        # Placed by a concurrent save of the same content
+        pass
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File storage that keeps each distinct content once.
+
+    Files are named blobs/ab/<sha256><ext> after their SHA-256, so saving
+    bytes that are already stored writes nothing and returns the existing
+    name. Each save takes a reference on the MediaBlob row and each delete
+    drops one, the file is removed with the last reference. Files on disk
+    are hardlinked or moved into place rather than copied where possible.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # The final name comes from the content, so it is never suffixed
+        return name
+
+    def blob_name(self, digest, name):
+        extension = posixpath.splitext(name)[1].lower()
+        return f'{BLOB_DIR}/{digest[:2]}/{digest}{extension}'
+
+    def _stage(self, content):
+        """Returns (digest, size, path, owned) with the content on disk at path"""
+        digest = hashlib.sha256()
+        size = 0
+        if hasattr(content, 'temporary_file_path'):
+            path, owned = content.temporary_file_path(), True
+            if getattr(content, 'sha256', None):
+                # Hashed when it was received, such as a finished chunked upload
+                return content.sha256, os.path.getsize(path), path, owned
+        elif isinstance(getattr(getattr(content, 'file', None), 'name', None), str) and os.path.isfile(content.file.name):
+            # A file that already lives on disk, such as media the commands relink
+            path, owned = content.file.name, False
+        else:
+            incoming = self.path(f'{BLOB_DIR}/incoming')
+            os.makedirs(incoming, exist_ok=True)
+            handle, path = tempfile.mkstemp(dir=incoming)
+            with os.fdopen(handle, 'wb') as staged:
+                for chunk in content.chunks():
+                    staged.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            return digest.hexdigest(), size, path, True
+        for chunk in content.chunks():
+            digest.update(chunk)
+            size += len(chunk)
+        return digest.hexdigest(), size, path, owned
+
+    def _save(self, name, content):
+        digest, size, staged, owned = self._stage(content)
+        name = self.blob_name(digest, name)
+        target = self.path(name)
+        try:
+            # The file is placed inside the transaction, so a concurrent
+            # delete of the same blob either finishes first or sees our reference
+            with transaction.atomic():
+                taken = _blobs().objects.filter(name=name).update(
+                    references=F('references') + 1, updated_at=timezone.now(),
+                )
+                if not taken:
+                    _blobs().objects.create(name=name, sha256=digest, size=size, references=1)
+                if not os.path.exists(target):
+                    twin = next((
+                        self.path(other) for other in
+                        _blobs().objects.filter(sha256=digest).exclude(name=name).values_list('name', flat=True)
+                        if self.exists(other)
+                    ), None)
+                    if twin is not None:
+                        # Same bytes under another extension
+                        link_or_copy(twin, target)
+                    elif owned:
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                        file_move_safe(staged, target, allow_overwrite=True)
+                    else:
+                        link_or_copy(staged, target)
+                    if self.file_permissions_mode is not None:
+                        os.chmod(target, self.file_permissions_mode)
+        finally:
+            if owned and os.path.exists(staged):
+                os.remove(staged)
+        return name
+
+    def place(self, path, name):
+        """
+        Hardlink or copy the file at path into the blob for its content.
+
+        Returns (blob name, sha256, size). No database access, so bulk
+        imports can place files from many threads and then record them all
+        at once with add_references().
+        """
+        digest = file_sha256(path)
+        blob = self.blob_name(digest, name)
+        target = self.path(blob)
+        if not os.path.exists(target):
+            link_or_copy(path, target)
+            if self.file_permissions_mode is not None:
+                os.chmod(target, self.file_permissions_mode)
+        return blob, digest, os.path.getsize(path)
+
+    def delete(self, name):
+        """Drop one reference to a blob, its file goes with the last one"""
+        with transaction.atomic():
+            released = _blobs().objects.filter(name=name, references__gt=0).update(
+                references=F('references') - 1, updated_at=timezone.now(),
+            )
+            blob = _blobs().objects.filter(name=name).first()
+            if blob is None:
+                # Files from before content addressing are left to dedupe_media
+                return
+            if not released or blob.references:
+                return
+            # Counts can drift when names are assigned without a save, check
+            # the models before removing anything
+            referenced = count_references(name)
+            if referenced:
+                blob.references = referenced
+                blob.save(update_fields=['references', 'updated_at'])
+                return
+            blob.delete()
+            super().delete(name)
+
+
+def add_references(placed, batch_size=500):
+    """Take one reference for each (name, sha256, size) returned by ContentAddressedStorage.place()"""
+    counts = Counter(name for name, _, _ in placed)
+    facts = {name: (digest, size) for name, digest, size in placed}
+    names = list(counts)
+    with transaction.atomic():
+        for start in range(0, len(names), batch_size):
+            batch = names[start:start + batch_size]
+            existing = set(_blobs().objects.filter(name__in=batch).values_list('name', flat=True))
+            for name in existing:
+                _blobs().objects.filter(name=name).update(
+                    references=F('references') + counts[name], updated_at=timezone.now(),
+                )
+            _blobs().objects.bulk_create([
+                _blobs()(name=name, sha256=facts[name][0], size=facts[name][1], references=counts[name])
+                for name in batch if name not in existing
+            ])
+
+
+def media_fields():
+    """(model, field name) of every file field stored content addressed"""
+    return [
+        (model, field.name)
+        for model in apps.get_models()
+        for field in model._meta.concrete_fields
+        if isinstance(field, models.FileField) and isinstance(field.storage, ContentAddressedStorage)
+    ]
+
+
+def count_references(name):
+    return sum(model._default_manager.filter(**{field: name}).count() for model, field in media_fields())
+
+
+def recount_references():
+    """Set every blob's reference count from the model fields, returns the counts by name"""
+    counts = {}
+    for model, field in media_fields():
+        rows = (
+            model._default_manager.filter(**{f'{field}__startswith': f'{BLOB_DIR}/'})
+            .values_list(field).annotate(total=models.Count('pk')).order_by()
+        )
+        for name, total in rows:
+            counts[name] = counts.get(name, 0) + total
+    for blob in _blobs().objects.only('id', 'name', 'references'):
+        if blob.references != counts.get(blob.name, 0):
+            _blobs().objects.filter(pk=blob.pk).update(references=counts.get(blob.name, 0))
+    return counts
+
+
+def collect_garbage(storage=None):
+    """Recount references and delete blobs nothing refers to, returns (count, bytes) freed"""
+    storage = storage or ContentAddressedStorage()
+    recount_references()
+    freed = size = 0
+    unreferenced = _blobs().objects.filter(references=0, updated_at__lt=timezone.now() - BLOB_GRACE)
+    for blob in unreferenced:
+        with transaction.atomic():
+            if not _blobs().objects.filter(pk=blob.pk, references=0).delete()[0]:
+                continue
+            FileSystemStorage.delete(storage, blob.name)
+        freed += 1
+        size += blob.size
+    return freed, size
@@ -0,0 +1,154 @@
+from bisect import bisect_left
+import heapq
+import logging
+import re
+import threading
+import time
+
+from django.db import connections
+
+from .catalog import get_catalog_version
+from .models import Book
+
+# Prefixes up to this length have their top suggestions precomputed, longer
+# ones are answered from a bisected range of the sorted key array
+PRECOMPUTED_PREFIX_LENGTH = 3
+MAX_SUGGESTIONS = 10
+# Ratings and reviews do not move the catalog version, so the popularity
+# ranking is refreshed at least this often
+POPULARITY_REFRESH_SECONDS = 600
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    """Lowercase and collapse everything but word characters to single spaces"""
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+class PrefixIndex:
+    """
+    Compact in-memory prefix index over book titles and authors.
+
+    Every title and author is indexed under its full normalized form and under
+    each word suffix ("twist" for "Oliver Twist"), stored as parallel sorted
+    arrays so a lookup is one bisect plus a short scan.
+    """
+
+    def __init__(self, books):
+        # books: iterable of (title, author, slug, popularity)
+        self.books = []
+        entries = []
+        for title, author, slug, popularity in books:
+            book_index = len(self.books)
+            self.books.append({'title': title, 'author': author, 'slug': slug})
+            rank = (-popularity, title.lower())
+            for key in self._keys(title) | self._keys(author):
+                entries.append((key, rank, book_index))
+        entries.sort()
+        self.keys = [key for key, _, _ in entries]
+        self.entries = [(rank, book_index) for _, rank, book_index in entries]
+        self.top = self._precompute_top(entries)
+
+    @staticmethod
+    def _keys(text):
+        words = normalize(text).split()
+        return {' '.join(words[start:]) for start in range(len(words))}
+
+    @staticmethod
+    def _precompute_top(entries):
+        top = {}
+        for key, rank, book_index in sorted(entries, key=lambda entry: entry[1]):
+            for length in range(1, min(len(key), PRECOMPUTED_PREFIX_LENGTH) + 1):
+                bucket = top.setdefault(key[:length], [])
+                if len(bucket) < MAX_SUGGESTIONS and book_index not in bucket:
+                    bucket.append(book_index)
+        return top
+
+    def lookup(self, prefix, limit=MAX_SUGGESTIONS):
+        """Return up to limit books whose title or author has a word starting with prefix"""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        limit = min(limit, MAX_SUGGESTIONS)
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH:
+            return [self.books[index] for index in self.top.get(prefix, [])[:limit]]
+
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + '\uffff', start)
+        best = heapq.nsmallest(limit * 4, self.entries[start:end])
+        results = []
+        for _, book_index in best:
+            if book_index not in results:
+                results.append(book_index)
+                if len(results) == limit:
+                    break
+        return [self.books[index] for index in results]
+
+
+_index = None
+_index_version = None
+_index_built_at = 0.0
+_rebuilding = False
+_index_lock = threading.Lock()
+_first_build_lock = threading.Lock()
+
+
+def build_prefix_index():
+    rows = Book.objects.values_list('title', 'author', 'slug', 'rating_count', 'review_count')
+    return PrefixIndex(
+        (title, author, slug, rating_count + review_count)
+        for title, author, slug, rating_count, review_count in rows.iterator()
+    )
+
+
+def _rebuild(version):
+    global _index, _index_version, _index_built_at, _rebuilding
+    try:
+        index = build_prefix_index()
+        with _index_lock:
+            _index, _index_version, _index_built_at = index, version, time.monotonic()
+    finally:
+        with _index_lock:
+            _rebuilding = False
+
+
+def _rebuild_in_background(version):
+    try:
+        _rebuild(version)
+    except Exception:
+        logger.exception('Rebuilding the prefix index failed, the previous one stays in use')
+    finally:
+        # This thread's connections are not closed by any request
+        connections.close_all()
+
+
+def get_prefix_index():
+    """
+    Return this worker's prefix index.
+
+    Only the first call builds it in the request. When the catalog version
+    moves or the popularity ranking is due a refresh, a background thread
+    builds the next index while the current one keeps being served.
+    """
+    global _rebuilding
+    version = get_catalog_version()
+    if _index is None:
+        with _first_build_lock:
+            if _index is None:
+                _rebuild(version)
+        return _index
+    if _index_version != version or time.monotonic() - _index_built_at > POPULARITY_REFRESH_SECONDS:
+        with _index_lock:
+            start = not _rebuilding
+            _rebuilding = True
+        if start:
+            threading.Thread(
+                target=_rebuild_in_background, args=(version,), name='prefix-index', daemon=True,
+            ).start()
+    return _index
+
+
+def suggest_books(prefix, limit=MAX_SUGGESTIONS):
+    """Top books by popularity for a title/author prefix"""
+    return get_prefix_index().lookup(prefix, limit)
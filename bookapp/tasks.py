@@ -0,0 +1,177 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+import logging
+import threading
+import traceback
+
+from .models import Task, TaskSchedule
+
+logger = logging.getLogger(__name__)
+
+# Running tasks refresh their lock this often, however long they take
+HEARTBEAT_INTERVAL = timedelta(minutes=1)
+# A lock not refreshed for this long is assumed to have lost its worker
+LOCK_TIMEOUT = timedelta(minutes=5)
+# Failed attempts are retried after RETRY_DELAY, 2 * RETRY_DELAY, 4 * RETRY_DELAY...
+RETRY_DELAY = timedelta(seconds=30)
+CLAIM_CANDIDATES = 10
+
+_registry = {}
+_schedules = {}
+
+
+def task(name=None, priority=0, max_attempts=3, every=None):
+    """
+    Register a function as a background task.
+
+    Tasks are queued by name with keyword arguments that must be JSON
+    serializable. With every=timedelta(...) the worker also queues the task
+    on that schedule.
+    """
+    def decorator(func):
+        task_name = name or func.__name__
+        _registry[task_name] = (func, priority, max_attempts)
+        if every is not None:
+            _schedules[task_name] = every
+        return func
+    return decorator
+
+
+def enqueue(name, priority=None, dedup_key=None, delay=None, **kwargs):
+    """
+    Queue a registered task, returns the Task.
+
+    When a task with the same dedup_key is still queued that one is returned
+    instead, so bursts of identical requests collapse into one run.
+    """
+    _, default_priority, max_attempts = _registry[name]
+    if dedup_key is not None:
+        existing = Task.objects.filter(status=Task.QUEUED, dedup_key=dedup_key).first()
+        if existing is not None:
+            return existing
+    try:
+        with transaction.atomic():
+            return Task.objects.create(
+                name=name, kwargs=kwargs, dedup_key=dedup_key,
+                priority=default_priority if priority is None else priority,
+                max_attempts=max_attempts, run_after=timezone.now() + (delay or timedelta(0)),
+            )
+    except IntegrityError:
+        # Another process queued the same key in the meantime
+        return Task.objects.get(status=Task.QUEUED, dedup_key=dedup_key)
+
+
+def claim_task(worker_name):
+    """Lock the most urgent due task for this worker, returns None when there is none"""
+    now = timezone.now()
+    candidates = (
+        Task.objects.filter(status=Task.QUEUED, run_after__lte=now)
+        .order_by('-priority', 'run_after')
+        .values_list('pk', flat=True)[:CLAIM_CANDIDATES]
+    )
+    for pk in candidates:
+        # The status check makes the update a compare-and-set between workers
+        claimed = Task.objects.filter(pk=pk, status=Task.QUEUED).update(
+            status=Task.RUNNING, locked_by=worker_name, locked_at=now, attempts=F('attempts') + 1,
+        )
+        if claimed:
+            return Task.objects.get(pk=pk)
+    return None
+
+
+def _requeue(task, run_after, last_error):
+    try:
+        with transaction.atomic():
+            Task.objects.filter(pk=task.pk).update(
+                status=Task.QUEUED, run_after=run_after, locked_by='', locked_at=None, last_error=last_error,
+            )
+    except IntegrityError:
+        # A fresh copy is already queued under the same key and will do the work
+        Task.objects.filter(pk=task.pk).update(
+            status=Task.DONE, finished_at=timezone.now(), last_error=last_error + '\nSuperseded by a queued copy',
+        )
+
+
+def _refresh_lock(task):
+    Task.objects.filter(pk=task.pk, status=Task.RUNNING, locked_by=task.locked_by).update(locked_at=timezone.now())
+
+
+@contextmanager
+def _heartbeat(task):
+    """Refresh the task's lock from a thread while the block runs"""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(HEARTBEAT_INTERVAL.total_seconds()):
+                try:
+                    _refresh_lock(task)
+                except Exception:
+                    logger.exception('Could not refresh the lock of task %s', task.pk)
+        finally:
+            # This thread's connections are not closed by anything else
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, name=f'task-heartbeat-{task.pk}', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_task(task):
+    """Run a claimed task and record the outcome, failures are retried with backoff"""
+    spec = _registry.get(task.name)
+    try:
+        if spec is None:
+            raise LookupError(f'Unknown task {task.name!r}')
+        with _heartbeat(task):
+            spec[0](**task.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception('Task %s (%s) failed on attempt %s', task.pk, task.name, task.attempts)
+        if spec is not None and task.attempts < task.max_attempts:
+            _requeue(task, timezone.now() + RETRY_DELAY * 2 ** (task.attempts - 1), error)
+        else:
+            Task.objects.filter(pk=task.pk).update(status=Task.FAILED, finished_at=timezone.now(), last_error=error)
+        return False
+    finally:
+        close_old_connections()
+    Task.objects.filter(pk=task.pk).update(status=Task.DONE, finished_at=timezone.now())
+    return True
+
+
+def requeue_stale_tasks():
+    """Put back tasks whose worker died while running them, returns how many"""
+    stale = Task.objects.filter(status=Task.RUNNING, locked_at__lt=timezone.now() - LOCK_TIMEOUT)
+    requeued = 0
+    for task in stale:
+        _requeue(task, timezone.now(), f'Worker {task.locked_by} stopped responding')
+        requeued += 1
+    return requeued
+
+
+def enqueue_due_schedules():
+    """Queue every periodic task whose interval has passed, returns their names"""
+    now = timezone.now()
+    queued = []
+    for name, every in _schedules.items():
+        # Claim the slot with a conditional update so only one worker queues it
+        if TaskSchedule.objects.filter(name=name, last_queued_at__lte=now - every).update(last_queued_at=now):
+            due = True
+        else:
+            try:
+                with transaction.atomic():
+                    TaskSchedule.objects.create(name=name, last_queued_at=now)
+                due = True
+            except IntegrityError:
+                due = False
+        if due:
+            enqueue(name, dedup_key=f'schedule:{name}')
+            queued.append(name)
+    return queued
@@ -1,3 +1,1046 @@
-from django.test import TestCase
+from datetime import timedelta
+import hashlib
+import io
+import json
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+from unittest import mock
+from urllib.parse import urlsplit
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.files.storage import FileSystemStorage
+from django.db import connection, connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve, reverse
+from django.utils import timezone
+from PIL import Image
 
-# Create your tests here.
+from .aggregates import rate_book, recompute_book_aggregates, review_book
+from .catalog import get_catalog_version, get_recommendations_version, render_home_sections
+from .delivery import _offload_response, parse_range
+from . import boot, ingest, jobs, search, storage, tasks, thumbnails, uploads
+from .management.commands import bootstrap
+from .models import AuthorStats, Book, BookRating, Category, ChunkedUpload, MediaBlob, PdfDocument, SimilarBook, Task
+from .querycount import query_budget
+from .pagination import decode_cursor, encode_cursor, paginate_keyset
+from .reconcile import file_stem, match_files
+from .routers import STICKY_COOKIE
+from .recommendations import refresh_recommendations
+from .search import build_match_query, search_books
+from .signals import remember_book_author
+from . import similarity, suggest
+
+# Tests never touch the shared file cache of a running site
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# Pages render without a collectstatic manifest
+TEST_STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+
+
+def make_book(title, **fields):
+    """Create a book with a unique slug from its title"""
+    fields.setdefault('author', 'Test Author')
+    fields.setdefault('summary', f'A book called {title}.')
+    return Book.objects.create(title=title, slug=title.lower().replace(' ', '-'), **fields)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.books = [make_book(f'Book {number}') for number in range(7)]
+        # Two books share a timestamp so the id has to break the tie
+        for number, book in enumerate(cls.books):
+            created_at = now - timedelta(minutes=min(number, 5))
+            Book.objects.filter(pk=book.pk).update(created_at=created_at)
+        cls.newest_first = list(Book.objects.order_by('-created_at', '-id'))
+
+    def test_cursor_round_trip(self):
+        book = self.newest_first[0]
+        self.assertEqual(decode_cursor(encode_cursor(book.created_at, book.pk)), (book.created_at, book.pk))
+
+    def test_malformed_cursor_is_ignored(self):
+        for cursor in ['', 'not base64!', 'bm90IGEgY3Vyc29y', encode_cursor(timezone.now(), 1)[:-3]]:
+            self.assertIsNone(decode_cursor(cursor), cursor)
+
+    def test_pages_cover_every_row_once_in_order(self):
+        seen, cursor = [], None
+        while True:
+            page = paginate_keyset(Book.objects.all(), after=cursor, page_size=3)
+            seen.extend(page)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, self.newest_first)
+
+    def test_first_page_has_no_previous(self):
+        page = paginate_keyset(Book.objects.all(), page_size=3)
+        self.assertFalse(page.has_previous)
+        self.assertTrue(page.has_next)
+
+    def test_before_returns_the_previous_page(self):
+        first = paginate_keyset(Book.objects.all(), page_size=3)
+        second = paginate_keyset(Book.objects.all(), after=first.next_cursor, page_size=3)
+        back = paginate_keyset(Book.objects.all(), before=second.previous_cursor, page_size=3)
+        self.assertEqual(list(back), list(first))
+        self.assertFalse(back.has_previous)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class AggregateTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = make_book('Rated Book', author='Rated Author')
+        cls.readers = [User.objects.create_user(f'reader{number}', password='secret') for number in range(3)]
+
+    def aggregates(self):
+        self.book.refresh_from_db()
+        return self.book.rating_sum, self.book.rating_count, self.book.review_count
+
+    def test_ratings_and_reviews_adjust_the_totals(self):
+        rate_book(self.readers[0], self.book, 4)
+        rate_book(self.readers[1], self.book, 2)
+        review_book(self.readers[0], self.book, 'Good', 'Liked it')
+        self.assertEqual(self.aggregates(), (6, 2, 1))
+        self.assertEqual(self.book.average_rating, 3)
+        stats = AuthorStats.objects.get(author='Rated Author')
+        self.assertEqual((stats.rating_sum, stats.rating_count, stats.review_count), (6, 2, 1))
+
+    def test_changing_a_rating_only_moves_the_sum(self):
+        rate_book(self.readers[0], self.book, 1)
+        rate_book(self.readers[0], self.book, 5)
+        self.assertEqual(self.aggregates(), (5, 1, 0))
+
+    def test_deleting_a_rating_takes_it_out(self):
+        rate_book(self.readers[0], self.book, 3)
+        rate_book(self.readers[1], self.book, 5)
+        BookRating.objects.get(user=self.readers[0]).delete()
+        self.assertEqual(self.aggregates(), (5, 1, 0))
+
+    def test_concurrent_first_rating_falls_back_to_update(self):
+        rate_book(self.readers[0], self.book, 2)
+        # The other request's row is invisible when this one looks first
+        with mock.patch.object(BookRating.objects, 'select_for_update', return_value=BookRating.objects.none()):
+            rating = rate_book(self.readers[0], self.book, 4)
+        self.assertEqual(rating.rating, 4)
+        self.assertEqual(self.aggregates(), (4, 1, 0))
+
+    def test_changing_the_author_moves_the_rollups(self):
+        rate_book(self.readers[0], self.book, 4)
+        book = Book.objects.get(pk=self.book.pk)
+        book.author = 'New Author'
+        book.save()
+        self.assertFalse(AuthorStats.objects.filter(author='Rated Author', book_count__gt=0).exists())
+        self.assertEqual(AuthorStats.objects.get(author='New Author').rating_sum, 4)
+        # The values loaded with the book are compared, not a fresh read
+        with mock.patch.object(Book.objects, 'filter', side_effect=AssertionError('read the row again')):
+            remember_book_author(Book, book)
+        self.assertEqual(book._previous_author, 'New Author')
+
+    def test_recompute_repairs_drift(self):
+        rate_book(self.readers[0], self.book, 4)
+        Book.objects.filter(pk=self.book.pk).update(rating_sum=40, review_count=7)
+        self.assertEqual(recompute_book_aggregates(), 1)
+        self.assertEqual(self.aggregates(), (4, 1, 0))
+        self.assertEqual(recompute_book_aggregates(), 0)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class HomeSectionsCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_book_changes_refresh_the_cached_sections(self):
+        book = make_book('Old Lighthouse', recommended_books=True)
+        self.assertIn('Old Lighthouse', render_home_sections())
+        with self.assertNumQueries(0):
+            render_home_sections()
+
+        version = get_catalog_version()
+        book.title = 'New Lighthouse'
+        book.save()
+        self.assertGreater(get_catalog_version(), version)
+        html = render_home_sections()
+        self.assertIn('New Lighthouse', html)
+        self.assertNotIn('Old Lighthouse', html)
+
+        version = get_catalog_version()
+        book.delete()
+        self.assertGreater(get_catalog_version(), version)
+        self.assertNotIn('New Lighthouse', render_home_sections())
+
+
+@override_settings(CACHES=TEST_CACHES, STATICFILES_STORAGE=TEST_STATICFILES_STORAGE)
+class ConditionalPageTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = make_book('Harbour Lights', recommended_books=True)
+        cls.reader = User.objects.create_user('reader', password='secret')
+
+    def setUp(self):
+        cache.clear()
+
+    def test_unchanged_home_page_is_not_rendered_again(self):
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.status_code, 200)
+        with mock.patch('bookapp.views.render_home_sections', side_effect=AssertionError('the view ran')):
+            revalidated = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(revalidated.status_code, 304)
+            revalidated = self.client.get(reverse('home'), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(revalidated.status_code, 304)
+        self.assertIn('no-cache', revalidated['Cache-Control'])
+
+    def test_catalog_change_invalidates_the_etag(self):
+        etag = self.client.get(reverse('home'))['ETag']
+        make_book('Harbour Nights')
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_book_page_revalidates_until_it_is_rated(self):
+        self.client.force_login(self.reader)
+        url = reverse('book_detail', args=[self.book.slug])
+        etag = self.client.get(url)['ETag']
+        with mock.patch('bookapp.views.get_similar_books', side_effect=AssertionError('the view ran')):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('private', response['Cache-Control'])
+        # Ratings update the aggregates in place, without touching updated_at
+        rate_book(self.reader, self.book, 5)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class BookSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.fantasy = Category.objects.create(name='Fantasy', slug='fantasy')
+        cls.history = Category.objects.create(name='History', slug='history')
+        # More dragon books than the limit, only the last in Fantasy by Le Guin
+        cls.books = [make_book(f'Dragon Tale {number}', author='Various Writers') for number in range(5)]
+        for book in cls.books:
+            book.category.add(cls.history)
+        cls.earthsea = make_book('Dragon of Earthsea', author='Ursula K. Le Guin')
+        cls.earthsea.category.add(cls.fantasy)
+
+    def test_input_is_quoted_into_prefix_terms(self):
+        self.assertEqual(build_match_query('Dragon OR "tale" NEAR(x*'), '"dragon"* "or"* "tale"* "near"* "x"*')
+        self.assertEqual(build_match_query('dragon ta', prefix_last_only=True), '"dragon" "ta"*')
+        self.assertIsNone(build_match_query('*"() -'))
+
+    def test_fts_syntax_in_the_query_is_matched_as_words(self):
+        self.assertEqual([book_id for book_id, _ in search_books('earth" OR "tale')], [])
+        self.assertEqual([book_id for book_id, _ in search_books('EARTH*')], [self.earthsea.pk])
+
+    def test_snippets_are_escaped_and_highlighted(self):
+        self.earthsea.summary = 'A <b>dragon</b> story.'
+        self.earthsea.save()
+        snippet = dict(search_books('story'))[self.earthsea.pk]
+        self.assertIn('&lt;b&gt;', snippet)
+        self.assertIn('<mark>story</mark>', snippet)
+
+    def test_filters_apply_before_the_limit(self):
+        for filters in [{'category': 'fanta'}, {'author': 'le guin'}]:
+            results = search_books('dragon', limit=2, **filters)
+            self.assertEqual([book_id for book_id, _ in results], [self.earthsea.pk], filters)
+
+    def test_filter_wildcards_are_literal(self):
+        self.assertEqual(search_books('dragon', author='%'), [])
+        self.assertEqual(search_books('dragon', category='_'), [])
+
+
+class PrefixIndexTests(SimpleTestCase):
+
+    def setUp(self):
+        self.index = suggest.PrefixIndex([
+            ('Oliver Twist', 'Charles Dickens', 'oliver-twist', 5),
+            ('Great Expectations', 'Charles Dickens', 'great-expectations', 9),
+            ('The Old Man and the Sea', 'Ernest Hemingway', 'old-man', 9),
+            ('Olive Kitteridge', 'Elizabeth Strout', 'olive-kitteridge', 1),
+        ])
+
+    def titles(self, prefix, **kwargs):
+        return [book['title'] for book in self.index.lookup(prefix, **kwargs)]
+
+    def test_short_prefixes_come_precomputed(self):
+        self.assertIn('ol', self.index.top)
+        # Most popular first, ties by title
+        self.assertEqual(self.titles('ol'), ['The Old Man and the Sea', 'Oliver Twist', 'Olive Kitteridge'])
+        self.assertEqual(self.titles('cha'), ['Great Expectations', 'Oliver Twist'])
+        self.assertEqual(self.titles('ol', limit=1), ['The Old Man and the Sea'])
+
+    def test_long_prefixes_bisect_the_sorted_keys(self):
+        self.assertEqual(self.index.keys, sorted(self.index.keys))
+        self.assertEqual(self.titles('olive'), ['Oliver Twist', 'Olive Kitteridge'])
+        self.assertEqual(self.titles('oliver tw'), ['Oliver Twist'])
+        # A book matching by title and by author is suggested once
+        self.assertEqual(self.titles('charles dick'), ['Great Expectations', 'Oliver Twist'])
+
+    def test_lookups_fold_case_and_punctuation(self):
+        self.assertEqual(self.titles('  TWIST!'), ['Oliver Twist'])
+        self.assertEqual(self.titles('Hemingway'), ['The Old Man and the Sea'])
+        self.assertEqual(self.titles('?!'), [])
+        self.assertEqual(self.titles('xyz'), [])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SuggestRebuildTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.reset_index()
+        self.addCleanup(self.reset_index)
+
+    def reset_index(self):
+        suggest._index = suggest._index_version = None
+        suggest._index_built_at = 0.0
+        suggest._rebuilding = False
+
+    def titles(self, prefix):
+        return [book['title'] for book in suggest.suggest_books(prefix)]
+
+    def test_catalog_change_rebuilds_in_the_background(self):
+        make_book('Harbour Lights')
+        self.assertEqual(self.titles('harb'), ['Harbour Lights'])
+        make_book('Harbour Nights')
+        with mock.patch.object(suggest.threading, 'Thread') as thread:
+            # The current index keeps being served while the next one builds
+            self.assertEqual(self.titles('harb'), ['Harbour Lights'])
+            self.assertEqual(self.titles('harbour'), ['Harbour Lights'])
+        thread.assert_called_once()
+        suggest._rebuild(*thread.call_args.kwargs['args'])
+        self.assertEqual(self.titles('harb'), ['Harbour Lights', 'Harbour Nights'])
+
+    def test_popularity_is_refreshed_without_a_catalog_change(self):
+        make_book('Harbour Lights')
+        quiet = make_book('Harbour Nights')
+        self.assertEqual(self.titles('harb'), ['Harbour Lights', 'Harbour Nights'])
+        Book.objects.filter(pk=quiet.pk).update(rating_count=3)
+        suggest._index_built_at -= suggest.POPULARITY_REFRESH_SECONDS + 1
+        with mock.patch.object(suggest.threading, 'Thread') as thread:
+            self.titles('harb')
+        suggest._rebuild(*thread.call_args.kwargs['args'])
+        self.assertEqual(self.titles('harb'), ['Harbour Nights', 'Harbour Lights'])
+
+
+@override_settings(CACHES=TEST_CACHES)
+class PageSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.keeper = make_book('Keeper Diaries')
+        cls.other = make_book('Coast Guard')
+        cls.store(cls.keeper, ['The lighthouse keeper wakes.', 'Nothing but fog.', 'Back to the lighthouse & home.'])
+        cls.store(cls.other, ['Another lighthouse on the coast.'])
+
+    @staticmethod
+    def store(book, pages):
+        return ingest.store_extraction(book.pk, {
+            'source_name': f'pdf/{book.slug}.pdf', 'file_size': 1, 'content_hash': book.slug,
+            'title': '', 'author': '', 'error': '', 'pages': pages,
+        })
+
+    def test_search_inside_a_book_returns_only_its_pages(self):
+        matches = search.search_pages('lighthouse', book_id=self.keeper.pk)
+        self.assertEqual([(book_id, number) for book_id, number, _ in matches], [(self.keeper.pk, 1), (self.keeper.pk, 3)])
+        self.assertIn('<mark>lighthouse</mark>', matches[0][2])
+        # Snippets are escaped before they are highlighted
+        self.assertIn('&amp; home', matches[1][2])
+        self.assertEqual([book_id for book_id, _, _ in search.search_pages('coast', book_id=self.keeper.pk)], [])
+        self.assertEqual({book_id for book_id, _, _ in search.search_pages('lighthouse')}, {self.keeper.pk, self.other.pk})
+
+    def test_extracting_again_leaves_no_stale_pages(self):
+        self.store(self.keeper, ['Only the open sea now.'])
+        self.assertEqual(search.search_pages('lighthouse', book_id=self.keeper.pk), [])
+        self.assertEqual([number for _, number, _ in search.search_pages('sea', book_id=self.keeper.pk)], [1])
+        # The other book's pages, now below the new range, are untouched
+        self.assertEqual([(book_id, number) for book_id, number, _ in search.search_pages('lighthouse')], [(self.other.pk, 1)])
+        self.assertEqual(len(search.search_pages('lighthouse', book_id=self.other.pk)), 1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SimilarBooksTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dragons = [make_book(f'Dragon Fire {number}', summary='Dragons guard the mountain gold.') for number in range(3)]
+        # Terms in over half the books are ignored, so dragons stay a minority
+        cls.others = [make_book(f'Quiet Accounting {number}', summary='Ledgers balance.') for number in range(4)]
+        cls.loner = make_book('Seaside Poems', summary='Waves crash.')
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.vectors_file = f'{directory.name}/data/similarity_vectors.npz'
+        settings = override_settings(SIMILARITY_VECTORS_FILE=self.vectors_file)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_books_without_neighbours_count_as_indexed(self):
+        similarity.rebuild_similar_books()
+        self.assertEqual(similarity.unindexed_book_ids(), [])
+        self.assertFalse(SimilarBook.objects.filter(book=self.loner).exists())
+
+    def test_new_books_are_merged_into_the_last_build(self):
+        similarity.rebuild_similar_books()
+        new = make_book('Dragon Fire Returns', summary='Dragons guard the mountain gold again.')
+        self.assertEqual(similarity.unindexed_book_ids(), [new.pk])
+        self.assertEqual(similarity.update_similar_books([new.pk]), 1)
+        self.assertEqual(similarity.unindexed_book_ids(), [])
+        self.assertTrue(SimilarBook.objects.filter(book=new, similar_book=self.dragons[0]).exists())
+        self.assertTrue(SimilarBook.objects.filter(book=self.dragons[0], similar_book=new).exists())
+
+    def test_deleted_books_leave_the_stored_vectors(self):
+        similarity.rebuild_similar_books()
+        self.dragons[1].delete()
+        new = make_book('Dragon Fire Returns', summary='Dragons guard the mountain gold again.')
+        similarity.update_similar_books([new.pk])
+        self.assertNotIn(self.dragons[1].pk, similarity.load_book_vectors().book_ids.tolist())
+
+    def test_stored_vectors_round_trip_outside_the_cache(self):
+        built = similarity.build_book_vectors()
+        similarity.save_book_vectors(built)
+        cache.clear()
+        loaded = similarity.load_book_vectors()
+        self.assertEqual(loaded.book_ids.tolist(), built.book_ids.tolist())
+        self.assertEqual(loaded.vocabulary, built.vocabulary)
+        self.assertEqual(loaded.category_columns, built.category_columns)
+        self.assertEqual((loaded.matrix != built.matrix).nnz, 0)
+
+    def test_missing_vectors_rebuild_every_book(self):
+        self.assertIsNone(similarity.load_book_vectors())
+        new = make_book('Dragon Fire Returns', summary='Dragons guard the mountain gold again.')
+        with self.assertLogs('bookapp.similarity', 'WARNING'):
+            self.assertEqual(similarity.update_similar_books([new.pk]), Book.objects.count())
+        self.assertEqual(similarity.unindexed_book_ids(), [])
+        self.assertTrue(os.path.exists(self.vectors_file))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RecommendationRefreshTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = [make_book(f'Shelf Book {number}') for number in range(3)]
+        cls.readers = [User.objects.create_user(f'reader{number}', password='secret') for number in range(3)]
+        for reader in cls.readers:
+            for book in cls.books[:2]:
+                rate_book(reader, book, 4)
+
+    def test_only_refreshes_that_write_move_the_version(self):
+        catalog_version = get_catalog_version()
+        refresh_recommendations(full=True)
+        version = get_recommendations_version()
+        refresh = refresh_recommendations()
+        self.assertEqual((refresh.books_refreshed, refresh.users_refreshed), (0, 0))
+        self.assertEqual(get_recommendations_version(), version)
+
+        rate_book(self.readers[0], self.books[2], 5)
+        self.assertGreater(refresh_recommendations().books_refreshed, 0)
+        self.assertGreater(get_recommendations_version(), version)
+        self.assertEqual(get_catalog_version(), catalog_version)
+
+
+class PdfExtractionTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = FileSystemStorage(location=directory.name)
+        self.storage.save('broken.pdf', ContentFile(b'%PDF-1.4 not really'))
+
+    def test_any_parse_error_is_recorded(self):
+        with mock.patch.object(ingest, 'PdfReader', side_effect=RecursionError('too deep')), self.assertLogs(ingest.logger, 'WARNING'):
+            result = ingest.extract_pdf('broken.pdf', storage=self.storage)
+        self.assertEqual(result['error'], 'RecursionError: too deep')
+        self.assertEqual(result['file_size'], 19)
+        self.assertEqual(result['pages'], [])
+
+    def test_pool_worker_returns_errors(self):
+        with mock.patch.object(ingest, 'extract_pdf', side_effect=RuntimeError('boom')), self.assertLogs(ingest.logger, 'ERROR'):
+            self.assertEqual(ingest._extract_for_pool('broken.pdf'), ('broken.pdf', None, 'RuntimeError: boom'))
+
+
+class ParseRangeTests(TestCase):
+
+    def test_whole_file_when_there_is_no_single_range(self):
+        for header in ['', 'bytes=-', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b']:
+            self.assertIsNone(parse_range(header, 100), header)
+
+    def test_ranges_are_clamped_to_the_file(self):
+        self.assertEqual(parse_range('bytes=10-19', 100), (10, 19))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-500', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-500', 100), (0, 99))
+
+    def test_unsatisfiable_ranges_raise(self):
+        for header, size in [('bytes=100-', 100), ('bytes=20-10', 100), ('bytes=-0', 100), ('bytes=-5', 0)]:
+            with self.assertRaises(ValueError, msg=header):
+                parse_range(header, size)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT_PREFIX='/protected/')
+    def test_accel_redirect_path_is_encoded(self):
+        field_file = mock.Mock()
+        field_file.name = 'pdf/war & peace?#1.pdf'
+        response = _offload_response(field_file, 'application/pdf')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/pdf/war%20%26%20peace%3F%231.pdf')
+
+
+class CoverVariantTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.storage = FileSystemStorage(location=directory.name)
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 600), 'red').save(buffer, format='PNG')
+        self.storage.save('img/cover.png', ContentFile(buffer.getvalue()))
+
+    def test_variants_record_the_names_the_storage_used(self):
+        first = thumbnails.render_cover_variants('img/cover.png', storage=self.storage)
+        self.assertEqual([variant['width'] for variant in first['jpeg']], [240, 360])
+        # Another render writes the file again between the delete and the save
+        with mock.patch.object(self.storage, 'delete'):
+            second = thumbnails.render_cover_variants('img/cover.png', storage=self.storage)
+        for variant in second['jpeg'] + second['webp']:
+            self.assertTrue(self.storage.exists(variant['name']), variant['name'])
+        self.assertNotEqual(first['jpeg'][0]['name'], second['jpeg'][0]['name'])
+
+
+@tasks.task(name='test_fails', max_attempts=2)
+def failing_task(message):
+    raise RuntimeError(message)
+
+
+@tasks.task(name='test_succeeds', priority=5)
+def succeeding_task():
+    pass
+
+
+_lock_refreshed = threading.Event()
+
+
+@tasks.task(name='test_outlives_a_heartbeat')
+def long_task():
+    if not _lock_refreshed.wait(5):
+        raise RuntimeError('the lock was never refreshed')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TaskQueueTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_queued_duplicates_collapse(self):
+        first = tasks.enqueue('test_succeeds', dedup_key='only-once')
+        self.assertEqual(tasks.enqueue('test_succeeds', dedup_key='only-once'), first)
+        self.assertEqual(Task.objects.count(), 1)
+
+    def test_claims_the_most_urgent_due_task_once(self):
+        tasks.enqueue('test_fails', message='later', delay=timedelta(minutes=5))
+        low = tasks.enqueue('test_fails', message='low')
+        high = tasks.enqueue('test_succeeds')
+        self.assertEqual(tasks.claim_task('worker-a'), high)
+        claimed = tasks.claim_task('worker-b')
+        self.assertEqual(claimed, low)
+        self.assertEqual((claimed.status, claimed.locked_by, claimed.attempts), (Task.RUNNING, 'worker-b', 1))
+        self.assertIsNone(tasks.claim_task('worker-c'))
+
+    def test_failures_retry_with_backoff_then_fail(self):
+        task = tasks.enqueue('test_fails', message='broken')
+        with self.assertLogs(tasks.logger, 'ERROR'):
+            self.assertFalse(tasks.run_task(tasks.claim_task('worker')))
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.QUEUED)
+        self.assertGreater(task.run_after, timezone.now() + tasks.RETRY_DELAY - timedelta(seconds=5))
+        self.assertIn('RuntimeError: broken', task.last_error)
+
+        Task.objects.filter(pk=task.pk).update(run_after=timezone.now())
+        with self.assertLogs(tasks.logger, 'ERROR'):
+            tasks.run_task(tasks.claim_task('worker'))
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.FAILED, 2))
+
+    def test_success_is_recorded(self):
+        task = tasks.enqueue('test_succeeds')
+        self.assertTrue(tasks.run_task(tasks.claim_task('worker')))
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.DONE)
+        self.assertIsNotNone(task.finished_at)
+
+    def test_stale_running_tasks_are_requeued(self):
+        task = tasks.enqueue('test_succeeds')
+        tasks.claim_task('lost-worker')
+        Task.objects.filter(pk=task.pk).update(locked_at=timezone.now() - tasks.LOCK_TIMEOUT - timedelta(minutes=1))
+        self.assertEqual(tasks.requeue_stale_tasks(), 1)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.locked_by), (Task.QUEUED, ''))
+
+    def test_a_refreshed_lock_is_not_stale(self):
+        task = tasks.enqueue('test_succeeds')
+        claimed = tasks.claim_task('busy-worker')
+        Task.objects.filter(pk=task.pk).update(locked_at=timezone.now() - tasks.LOCK_TIMEOUT - timedelta(minutes=1))
+        tasks._refresh_lock(claimed)
+        self.assertEqual(tasks.requeue_stale_tasks(), 0)
+
+    def test_running_tasks_refresh_their_lock(self):
+        tasks.enqueue('test_outlives_a_heartbeat')
+        _lock_refreshed.clear()
+        with mock.patch.object(tasks, 'HEARTBEAT_INTERVAL', timedelta(milliseconds=10)), \
+                mock.patch.object(tasks, '_refresh_lock', side_effect=lambda task: _lock_refreshed.set()) as refresh:
+            self.assertTrue(tasks.run_task(tasks.claim_task('busy-worker')))
+        self.assertEqual(refresh.call_args.args[0].locked_by, 'busy-worker')
+
+    def test_catalog_changes_queue_one_warm_up(self):
+        with mock.patch.object(tasks, 'enqueue', wraps=tasks.enqueue) as enqueue:
+            for number in range(3):
+                make_book(f'Burst {number}')
+        warm_ups = [call for call in enqueue.call_args_list if call.args[0] == 'warm_catalog_cache']
+        self.assertEqual(len(warm_ups), 1)
+        self.assertEqual(Task.objects.filter(name='warm_catalog_cache').count(), 1)
+
+
+class TemporaryMediaMixin:
+    """Run each test with empty MEDIA_ROOT and CHUNKED_UPLOAD_DIR folders"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.media_root = f'{directory.name}/media'
+        settings = override_settings(MEDIA_ROOT=self.media_root, CHUNKED_UPLOAD_DIR=f'{directory.name}/uploads')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+
+@override_settings(CACHES=TEST_CACHES, STATICFILES_STORAGE=TEST_STATICFILES_STORAGE, CHUNKED_UPLOAD_MAX_SIZE=1000)
+class ChunkedUploadTests(TemporaryMediaMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('uploader', password='secret')
+        cls.category = Category.objects.create(name='Essays', slug='essays')
+
+    def send(self, upload, offset, data, expected_sha256=''):
+        return uploads.write_chunk(upload, offset, io.BytesIO(data), len(data), expected_sha256)
+
+    def test_size_must_fit_the_limit(self):
+        for size in [0, 1001]:
+            with self.assertRaises(uploads.UploadError) as raised:
+                uploads.start_upload(self.user, 'book.pdf', size)
+            self.assertEqual(raised.exception.status, 413)
+
+    def test_chunks_must_continue_at_the_received_offset(self):
+        upload = uploads.start_upload(self.user, 'book.pdf', 10)
+        self.assertEqual(self.send(upload, 0, b'abcd'), 4)
+        for offset in [0, 8]:
+            with self.assertRaises(uploads.UploadError) as raised:
+                self.send(upload, offset, b'ef')
+            self.assertEqual(raised.exception.status, 409)
+        with self.assertRaises(uploads.UploadError) as raised:
+            self.send(upload, 4, b'efghijklmn')
+        self.assertEqual(raised.exception.status, 413)
+        self.assertEqual(self.send(upload, 4, b'efghij'), 10)
+
+    def test_a_corrupted_chunk_is_refused(self):
+        upload = uploads.start_upload(self.user, 'book.pdf', 4)
+        with self.assertRaises(uploads.UploadError) as raised:
+            self.send(upload, 0, b'abcd', expected_sha256='0' * 64)
+        self.assertEqual(raised.exception.status, 422)
+        upload.refresh_from_db()
+        self.assertEqual(upload.received, 0)
+
+    def test_a_short_body_keeps_what_arrived(self):
+        upload = uploads.start_upload(self.user, 'book.pdf', 10)
+        self.assertEqual(uploads.write_chunk(upload, 0, io.BytesIO(b'abc'), 6), 3)
+
+    def test_finalize_is_verified_by_the_worker(self):
+        data = b'%PDF-1.4 whole file'
+        upload = uploads.start_upload(self.user, 'book.pdf', len(data), hashlib.sha256(data).hexdigest())
+        with self.assertRaises(uploads.UploadError):
+            uploads.request_finalize(upload)
+        self.send(upload, 0, data)
+        uploads.request_finalize(upload)
+        upload.refresh_from_db()
+        self.assertEqual(upload.status, ChunkedUpload.VERIFYING)
+        task = Task.objects.get(name='finalize_upload')
+        jobs.finalize_upload(**task.kwargs)
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.sha256), (ChunkedUpload.COMPLETE, hashlib.sha256(data).hexdigest()))
+
+    def test_a_whole_file_mismatch_fails_the_upload(self):
+        upload = uploads.start_upload(self.user, 'book.pdf', 4, '0' * 64)
+        self.send(upload, 0, b'abcd')
+        uploads.request_finalize(upload)
+        jobs.finalize_upload(str(upload.pk))
+        upload.refresh_from_db()
+        self.assertEqual(upload.status, ChunkedUpload.FAILED)
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.request_finalize(upload)
+        self.assertEqual(raised.exception.status, 422)
+
+    def test_upload_page_keeps_the_form_when_the_pdf_cannot_be_attached(self):
+        upload = uploads.start_upload(self.user, 'book.pdf', 4)
+        self.send(upload, 0, b'abcd')
+        uploads.finalize_upload(upload)
+        self.client.force_login(self.user)
+        form = {
+            'title': 'Unattached', 'author': 'uploader', 'summary': 'Text.',
+            'category': [self.category.pk], 'pdf_upload': str(upload.pk),
+        }
+        with mock.patch.object(uploads, 'attach_upload', side_effect=uploads.UploadError('Disk full')):
+            response = self.client.post(reverse('upload_book'), form)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Disk full')
+        self.assertFalse(Book.objects.filter(title='Unattached').exists())
+
+        response = self.client.post(reverse('upload_book'), form)
+        book = Book.objects.get(title='Unattached')
+        self.assertRedirects(response, reverse('book_detail', args=[book.slug]), fetch_redirect_response=False)
+        self.assertTrue(book.pdf.name.startswith('blobs/'))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class MediaBlobTests(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.storage = storage.ContentAddressedStorage()
+
+    def blob(self, name):
+        return MediaBlob.objects.filter(name=name).values_list('references', flat=True).first()
+
+    def test_same_content_is_stored_once(self):
+        first = self.storage.save('pdf/a.pdf', ContentFile(b'same bytes'))
+        second = self.storage.save('pdf/b.pdf', ContentFile(b'same bytes'))
+        digest = hashlib.sha256(b'same bytes').hexdigest()
+        self.assertEqual(first, second)
+        self.assertEqual(first, f'blobs/{digest[:2]}/{digest}.pdf')
+        self.assertEqual(self.blob(first), 2)
+
+    def test_file_goes_with_the_last_reference(self):
+        name = self.storage.save('pdf/a.pdf', ContentFile(b'shared'))
+        self.storage.save('pdf/b.pdf', ContentFile(b'shared'))
+        self.storage.delete(name)
+        self.assertEqual(self.blob(name), 1)
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete(name)
+        self.assertIsNone(self.blob(name))
+        self.assertFalse(self.storage.exists(name))
+
+    def test_a_file_still_named_by_a_model_is_kept(self):
+        book = make_book('Kept', pdf=ContentFile(b'kept', name='kept.pdf'))
+        # The count drifted, a row names the file without a reference
+        MediaBlob.objects.filter(name=book.pdf.name).update(references=1)
+        self.storage.save('pdf/other.pdf', ContentFile(b'kept'))
+        self.storage.delete(book.pdf.name)
+        self.storage.delete(book.pdf.name)
+        self.assertEqual(self.blob(book.pdf.name), 1)
+        self.assertTrue(self.storage.exists(book.pdf.name))
+
+    def test_books_release_replaced_and_deleted_files(self):
+        book = make_book('Owner', pdf=ContentFile(b'first', name='first.pdf'))
+        other = make_book('Sharer', pdf=ContentFile(b'first', name='copy.pdf'))
+        first = book.pdf.name
+        self.assertEqual(self.blob(first), 2)
+        book.pdf.save('second.pdf', ContentFile(b'second'))
+        self.assertEqual(self.blob(first), 1)
+        self.assertEqual(self.blob(book.pdf.name), 1)
+        other.delete()
+        self.assertIsNone(self.blob(first))
+        self.assertFalse(self.storage.exists(first))
+
+    def test_recount_repairs_drifted_counts(self):
+        book = make_book('Counted', pdf=ContentFile(b'counted', name='counted.pdf'))
+        MediaBlob.objects.filter(name=book.pdf.name).update(references=5)
+        self.assertEqual(storage.recount_references(), {book.pdf.name: 1})
+        self.assertEqual(self.blob(book.pdf.name), 1)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class CreateBooksFromImagesTests(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        files = {
+            'img/oliver_twist.jpg': b'shared cover',
+            'img/purple_hibiscus.jpg': b'shared cover',
+            'img/linux_tips.jpg': b'penguin cover',
+            'pdf/oliver_twist.pdf': b'%PDF-1.4 not really',
+        }
+        for name, content in files.items():
+            path = os.path.join(self.media_root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as handle:
+                handle.write(content)
+
+    def references(self, name):
+        return MediaBlob.objects.get(name=name).references
+
+    def test_books_are_created_in_bulk_with_their_files(self):
+        version = get_catalog_version()
+        call_command('create_books_from_images', stdout=io.StringIO())
+        books = {book.title: book for book in Book.objects.prefetch_related('category')}
+        self.assertEqual(set(books), {'Oliver Twist', 'Purple Hibiscus', 'Linux Tips, Tricks & Hacks'})
+        oliver, purple, linux = books['Oliver Twist'], books['Purple Hibiscus'], books['Linux Tips, Tricks & Hacks']
+        self.assertEqual((oliver.author, linux.author), ('Charles Dickens', 'Linux Community'))
+        self.assertEqual([category.slug for category in oliver.category.all()], ['fiction'])
+        self.assertEqual([category.slug for category in linux.category.all()], ['technology'])
+        self.assertTrue(oliver.recommended_books and oliver.fiction_books)
+
+        # Identical covers share one blob, each book holds a reference
+        self.assertEqual(oliver.cover_image.name, purple.cover_image.name)
+        self.assertEqual(self.references(oliver.cover_image.name), 2)
+        self.assertEqual(self.references(linux.cover_image.name), 1)
+        self.assertEqual(self.references(oliver.pdf.name), 1)
+        self.assertIsNone(oliver.pdf_url)
+        self.assertFalse(linux.pdf)
+        self.assertTrue(linux.pdf_url)
+
+        self.assertEqual([book_id for book_id, _ in search_books('dickens')], [oliver.pk])
+        self.assertEqual(AuthorStats.objects.get(author='Charles Dickens').book_count, 1)
+        self.assertGreater(get_catalog_version(), version)
+        self.assertTrue(Task.objects.filter(name='extract_missing_pdfs').exists())
+
+    def test_existing_books_are_skipped(self):
+        call_command('create_books_from_images', stdout=io.StringIO())
+        output = io.StringIO()
+        call_command('create_books_from_images', stdout=output)
+        self.assertIn('Created 0 books', output.getvalue())
+        self.assertEqual(Book.objects.count(), 3)
+        self.assertEqual(self.references(Book.objects.get(slug='oliver-twist').cover_image.name), 2)
+
+
+class ReconcileMatchingTests(TestCase):
+
+    def test_storage_suffixes_are_not_part_of_the_stem(self):
+        self.assertEqual(file_stem('img/the_hobbit_aB3dE9x.jpg'), 'the_hobbit')
+        # Seven lowercase letters are a word, not a suffix
+        self.assertEqual(file_stem('pdf/history_romance.pdf'), 'history_romance')
+
+    def test_titles_pair_with_their_files(self):
+        matches = match_files(
+            [(1, 'The Hobbit'), (2, 'Pride and Prejudice'), (3, 'Nothing Alike')],
+            ['pride-and-prejudice.pdf', 'the_hobbit_aB3dE9x.pdf', 'cookbook.pdf'],
+        )
+        self.assertEqual({(key, name) for key, name, _ in matches}, {
+            (1, 'the_hobbit_aB3dE9x.pdf'), (2, 'pride-and-prejudice.pdf'),
+        })
+
+    def test_misspelt_names_still_match(self):
+        matches = match_files([(1, 'Hibiscus Purple')], ['purple_hibiskus.jpg'])
+        self.assertEqual([name for _, name, _ in matches], ['purple_hibiskus.jpg'])
+
+    def test_each_file_goes_to_one_book(self):
+        matches = match_files([(1, 'Dune'), (2, 'Dune Messiah')], ['dune_messiah.pdf'])
+        self.assertEqual([(key, name) for key, name, _ in matches], [(2, 'dune_messiah.pdf')])
+
+    def test_weak_matches_are_dropped(self):
+        self.assertEqual(match_files([(1, 'The Great Gatsby Returns Again')], ['great.pdf'], min_score=0.9), [])
+
+
+class PendingIngestionTests(TestCase):
+
+    def test_only_books_with_an_unextracted_pdf_are_pending(self):
+        extracted = make_book('Extracted', pdf='pdf/extracted.pdf')
+        changed = make_book('Changed', pdf='pdf/new.pdf')
+        fresh = make_book('Fresh', pdf='pdf/fresh.pdf')
+        make_book('No PDF')
+        PdfDocument.objects.create(book=extracted, source_name='pdf/extracted.pdf', file_size=1, content_hash='a')
+        PdfDocument.objects.create(book=changed, source_name='pdf/old.pdf', file_size=1, content_hash='b')
+        expected = [changed.pk, fresh.pk]
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(ingest.pending_ingestion(Book.objects.all()).values_list('id', flat=True)), expected)
+        books = list(Book.objects.all())
+        with self.assertNumQueries(1):
+            pending = [book.pk for book in ingest._needing_ingestion(books)]
+        self.assertEqual(sorted(pending), expected)
+
+
+class BootTests(TestCase):
+
+    def migrate(self, force=False):
+        """Whether bootstrap ran migrate"""
+        with mock.patch.object(bootstrap, 'call_command') as call_command:
+            bootstrap.Command(stdout=io.StringIO()).migrate(force)
+        return call_command.called
+
+    def test_migrate_runs_only_when_the_migration_files_change(self):
+        # A fresh or restored database has no hash, or the one of its own files
+        self.assertTrue(self.migrate())
+        self.assertFalse(self.migrate())
+        boot.set_state(boot.SCHEMA_KEY, 'hash of older migration files')
+        self.assertTrue(self.migrate())
+        self.assertTrue(self.migrate(force=True))
+
+
+@override_settings(CACHES=TEST_CACHES, STATICFILES_STORAGE=TEST_STATICFILES_STORAGE, REPLICA_DATABASES=['replica'])
+class ReplicaRouterTests(TransactionTestCase):
+    """Two SQLite files, the test database as primary and a stale copy of it as the replica"""
+
+    def setUp(self):
+        cache.clear()
+        self.book = make_book('Primary Title')
+        self.addCleanup(self.drop_replica)
+        handle, path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        connection.ensure_connection()
+        with sqlite3.connect(path) as replica:
+            connection.connection.backup(replica)
+            replica.execute("UPDATE bookapp_book SET title = 'Replica Title'")
+        replica.close()
+        connections.databases['replica'] = {**connection.settings_dict, 'NAME': path}
+        # Created after the copy, so only the primary has them
+        self.user = User.objects.create_user('fresh', password='secret')
+        self.user.profile.user_type = 'writer'
+        self.user.profile.save()
+
+    def drop_replica(self):
+        if 'replica' in connections.databases:
+            connections['replica'].close()
+            del connections['replica']
+            del connections.databases['replica']
+
+    def test_replica_reads_views_read_the_replica(self):
+        response = self.client.get(reverse('all_books'))
+        self.assertContains(response, 'Replica Title')
+        self.assertNotContains(response, 'Primary Title')
+
+    def test_client_sticks_to_the_primary_after_a_write(self):
+        response = self.client.post(
+            reverse('newsletter_subscribe'), json.dumps({'email': 'reader@example.com'}), content_type='application/json',
+        )
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        # The test client sends the cookie back
+        self.assertContains(self.client.get(reverse('all_books')), 'Primary Title')
+        self.client.cookies.pop(STICKY_COOKIE)
+        self.assertContains(self.client.get(reverse('all_books')), 'Replica Title')
+
+    def test_users_and_profiles_are_read_from_the_primary(self):
+        self.client.force_login(self.user)
+        # Signed in and opening the replica connection, still within budget
+        with query_budget('all_books'):
+            response = self.client.get(reverse('all_books'))
+        self.assertContains(response, 'Replica Title')
+        self.assertContains(response, 'fresh')
+        self.assertEqual(response.context['user'].profile.user_type, 'writer')
+
+
+# Read whole on purpose, they stay a handful of rows
+FULL_SCAN_ALLOWED = frozenset(['bookapp_category', 'django_content_type'])
+# SCAN <table> without an index; SCAN ... USING INDEX walks an index in order
+_FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}},
+    STATICFILES_STORAGE=TEST_STATICFILES_STORAGE,
+)
+class HotViewQueryTests(TestCase):
+    """The hot views with nothing cached, so the queries behind cached fragments run too"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories = [
+            Category.objects.create(name=f'Genre {number}', slug=f'genre-{number}') for number in range(4)
+        ]
+        cls.books = []
+        for number in range(24):
+            book = make_book(
+                f'Lantern Tale {number}', author=f'Author {number % 6}',
+                recommended_books=number % 3 == 0, fiction_books=number % 2 == 0,
+            )
+            book.category.add(cls.categories[number % 4], cls.categories[(number + 1) % 4])
+            cls.books.append(book)
+        cls.readers = [User.objects.create_user(f'reader{number}', password='secret') for number in range(4)]
+        for number, reader in enumerate(cls.readers):
+            for book in cls.books[number::3]:
+                rate_book(reader, book, 1 + (book.pk + number) % 5)
+            review_book(reader, cls.books[0], f'Review {number}', 'Worth a read.')
+        cls.writer = User.objects.create_user('Author 0', password='secret')
+        cls.writer.profile.user_type = 'writer'
+        cls.writer.profile.save()
+
+    def hot_requests(self):
+        """(user, method, url, data, tables it may also scan) of every request checked"""
+        book, category, search_url = self.books[0], self.categories[0], reverse('book_search')
+        reader = self.readers[0]
+        return [
+            (reader, 'GET', reverse('home'), None, ()),
+            (reader, 'GET', reverse('all_books'), None, ()),
+            (reader, 'GET', reverse('category_detail', args=[category.slug]), None, ()),
+            (reader, 'GET', reverse('book_detail', args=[book.slug]), None, ()),
+            (reader, 'GET', reverse('book_reviews', args=[book.slug]), None, ()),
+            (reader, 'POST', search_url, {'name_of_book': 'Lantern'}, ()),
+            # Any part of the name matches, which no index can seek
+            (reader, 'GET', f'{search_url}?author=Author+1', None, ('bookapp_book',)),
+            (reader, 'GET', reverse('dashboard'), None, ()),
+            (self.writer, 'GET', reverse('dashboard'), None, ()),
+            (reader, 'POST', reverse('newsletter_subscribe'), json.dumps({'email': 'plans@example.com'}), ()),
+        ]
+
+    def request(self, method, url, data):
+        if method == 'POST' and isinstance(data, str):
+            return self.client.post(url, data, content_type='application/json')
+        if method == 'POST':
+            return self.client.post(url, data)
+        return self.client.get(url)
+
+    def full_scans(self, queries, allowed):
+        """[(table, sql)] of the SELECTs whose plan reads a whole table other than the allowed ones"""
+        scans = []
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query['sql']
+                if not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+                    continue
+                # Captured SQL has its parameters inlined, which plans the same
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+                for row in cursor.fetchall():
+                    match = _FULL_SCAN.match(row[-1])
+                    if match and match.group(1) not in FULL_SCAN_ALLOWED.union(allowed):
+                        scans.append((match.group(1), sql))
+        return scans
+
+    def test_hot_views_use_indexes(self):
+        for user, method, url, data, allowed in self.hot_requests():
+            with self.subTest(url=url, user=user.username):
+                self.client.force_login(user)
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.request(method, url, data)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(self.full_scans(captured.captured_queries, allowed), [])
+
+    def test_hot_views_stay_within_their_query_budgets(self):
+        for user, method, url, data, _ in self.hot_requests():
+            url_name = resolve(urlsplit(url).path).url_name
+            with self.subTest(url=url, user=user.username):
+                self.client.force_login(user)
+                with query_budget(url_name):
+                    response = self.request(method, url, data)
+                self.assertEqual(response.status_code, 200)
+
+    def test_category_page_lists_its_books(self):
+        category = self.categories[1]
+        self.client.force_login(self.readers[0])
+        with query_budget('category_detail'):
+            response = self.client.get(reverse('category_detail', args=[category.slug]))
+        listed = [book.pk for book in response.context['books']]
+        self.assertEqual(sorted(listed), sorted(book.pk for book in category.book_set.all()))
+        self.assertContains(response, 'Lantern Tale 1<')
+        self.assertEqual(self.client.get(reverse('category_detail', args=['no-such-genre'])).status_code, 404)
@@ -0,0 +1,172 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections
+from PIL import Image, ImageOps
+import io
+import logging
+import posixpath
+
+logger = logging.getLogger(__name__)
+
+# Card covers are shown 240-400 CSS pixels wide, the larger widths serve 2x screens
+COVER_WIDTHS = (240, 360, 480, 720)
+COVER_FORMATS = {
+    'jpeg': {'extension': 'jpg', 'options': {'quality': 82, 'optimize': True, 'progressive': True}},
+    'webp': {'extension': 'webp', 'options': {'quality': 80, 'method': 4}},
+}
+THUMBNAIL_DIR = 'img/thumbs'
+
+
+def _variant_name(source_name, width, extension):
+    # Keep the original extension in the stem so a.jpg and a.png never collide
+    stem = posixpath.basename(source_name).replace('.', '_')
+    return f'{THUMBNAIL_DIR}/{stem}-{width}w.{extension}'
+
+
+def render_cover_variants(source_name, storage=default_storage):
+    """
+    Write fixed-width JPEG and WebP derivatives of a cover image.
+
+    Widths larger than the original are skipped, and the original width is
+    used instead when it is smaller than every target. Returns the
+    cover_variants value to store on the book. It touches only storage, so
+    it is safe to call from worker processes.
+    """
+    with storage.open(source_name, 'rb') as source:
+        image = Image.open(source)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    image = image.convert('RGB')
+
+    widths = [width for width in COVER_WIDTHS if width < image.width] or [image.width]
+    variants = {'source': source_name}
+    for format_name, spec in COVER_FORMATS.items():
+        variants[format_name] = []
+        for width in widths:
+            height = round(image.height * width / image.width)
+            resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, format=format_name.upper(), **spec['options'])
+            name = _variant_name(source_name, width, spec['extension'])
+            if storage.exists(name):
+                storage.delete(name)
+            # A concurrent render can take the name first, the storage then picks another
+            name = storage.save(name, ContentFile(buffer.getvalue()))
+            variants[format_name].append({'width': width, 'height': height, 'name': name})
+    return variants
+
+
+def refresh_cover_variants(book):
+    """
+    Regenerate a book's derivatives when its cover changed since they were made.
+
+    Stale derivative files are removed. Returns True when the stored
+    variants changed.
+    """
+    if variants_are_current(book):
+        return False
+    previous = book.cover_variants
+    books = type(book).objects.exclude(pk=book.pk)
+    variants = {}
+    if book.cover_image:
+        # Covers are stored once per content, a book with the same cover
+        # may already have the derivatives
+        variants = next((
+            shared for shared in books.filter(cover_image=book.cover_image.name).values_list('cover_variants', flat=True)
+            if shared.get('source') == book.cover_image.name
+        ), None)
+        if variants is None:
+            try:
+                variants = render_cover_variants(book.cover_image.name)
+            except OSError:
+                logger.exception('Could not build cover derivatives for %s', book.cover_image.name)
+                return False
+    if previous == variants:
+        return False
+    if not previous.get('source') or not books.filter(cover_image=previous['source']).exists():
+        current_names = {variant['name'] for name in COVER_FORMATS for variant in variants.get(name, [])}
+        delete_cover_variants(previous, keep=current_names)
+    type(book).objects.filter(pk=book.pk).update(cover_variants=variants)
+    book.cover_variants = variants
+    return True
+
+
+def variants_are_current(book):
+    """True when the stored derivatives were made from the book's current cover"""
+    if not book.cover_image:
+        return not book.cover_variants
+    return book.cover_variants.get('source') == book.cover_image.name
+
+
+def delete_cover_variants(variants, keep=(), storage=default_storage):
+    for format_name in COVER_FORMATS:
+        for variant in variants.get(format_name, []):
+            if variant['name'] not in keep and storage.exists(variant['name']):
+                storage.delete(variant['name'])
+
+
+def srcset(variants, format_name, storage=default_storage):
+    """Build an srcset attribute value from stored derivatives"""
+    return ', '.join(
+        f"{storage.url(variant['name'])} {variant['width']}w"
+        for variant in variants.get(format_name, [])
+    )
+
+
+def _render_for_backfill(source_name):
+    # Runs in a worker process, errors are reported back rather than raised
+    try:
+        return source_name, render_cover_variants(source_name), None
+    except OSError as error:
+        return source_name, None, str(error)
+
+
+def backfill_cover_variants(books, jobs=1, batch_size=200):
+    """
+    Build derivatives for many books, resizing in up to jobs processes.
+
+    Workers only read and write storage, the parent stores the results with
+    bulk updates. Yields (book, error) as each cover finishes, error is None
+    on success.
+    """
+    books_by_source = {}
+    for book in books:
+        books_by_source.setdefault(book.cover_image.name, []).append(book)
+    model = None
+    pending = []
+
+    def flush():
+        model.objects.bulk_update(pending, ['cover_variants'])
+        pending.clear()
+
+    if jobs > 1:
+        # Forked workers must not share the parent's database connections
+        connections.close_all()
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(_render_for_backfill, books_by_source, chunksize=8)
+    else:
+        executor = None
+        results = map(_render_for_backfill, books_by_source)
+    try:
+        for source_name, variants, error in results:
+            for book in books_by_source[source_name]:
+                if error is None:
+                    delete_cover_variants(book.cover_variants, keep={
+                        variant['name'] for name in COVER_FORMATS for variant in variants[name]
+                    })
+                    book.cover_variants = variants
+                    model = type(book)
+                    pending.append(book)
+                yield book, error
+            if len(pending) >= batch_size:
+                flush()
+        if pending:
+            flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
@@ -0,0 +1,193 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+import hashlib
+import os
+
+from . import tasks
+from .models import ChunkedUpload
+
+# Clients are told to send chunks of this size, larger ones are refused
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+COPY_BLOCK_SIZE = 64 * 1024
+# Unfinished or unattached uploads are deleted after this long
+UPLOAD_EXPIRY = timedelta(days=1)
+
+
+class UploadError(Exception):
+    """A chunk or finalize request the upload cannot accept, status is the HTTP code"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class _UploadedFile(File):
+    # FileSystemStorage moves files that report a temporary path instead of copying them
+    def __init__(self, file, sha256):
+        super().__init__(file)
+        # Checked by finalize_upload, so the storage need not hash it again
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def temp_path(upload):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f'{upload.pk}.part')
+
+
+def start_upload(user, filename, size, expected_sha256=''):
+    """Open an upload session and create its empty temp file"""
+    if size <= 0 or size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        raise UploadError(f'Uploads must be between 1 byte and {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes', 413)
+    upload = ChunkedUpload.objects.create(
+        user=user, filename=os.path.basename(filename)[:255], size=size, expected_sha256=expected_sha256.lower(),
+    )
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(temp_path(upload), 'wb').close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length, expected_sha256=''):
+    """
+    Write length bytes from stream at offset, returns the new received size.
+
+    The offset must be where the upload stands, so a client resumes by
+    asking for the current size and continuing from there. Bytes go
+    straight to the temp file at their offset, which makes resending a chunk
+    harmless. When the connection drops part way the bytes that did arrive
+    still count.
+    """
+    if upload.status != ChunkedUpload.UPLOADING:
+        raise UploadError('This upload is already finished', 409)
+    if offset != upload.received:
+        raise UploadError(f'Expected offset {upload.received}', 409)
+    if length > MAX_CHUNK_SIZE or offset + length > upload.size:
+        raise UploadError('Chunk is too large', 413)
+
+    digest = hashlib.sha256()
+    written = 0
+    with open(temp_path(upload), 'r+b') as part:
+        part.seek(offset)
+        try:
+            while written < length:
+                block = stream.read(min(COPY_BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                part.write(block)
+                digest.update(block)
+                written += len(block)
+        except OSError:
+            # Client went away, keep what was received
+            pass
+    if expected_sha256 and written == length and digest.hexdigest() != expected_sha256.lower():
+        raise UploadError('Chunk checksum mismatch', 422)
+
+    # Compare-and-set, a concurrent resend of the same chunk must not count twice
+    ChunkedUpload.objects.filter(pk=upload.pk, received=offset).update(
+        received=offset + written, updated_at=timezone.now(),
+    )
+    upload.refresh_from_db(fields=['received'])
+    return upload.received
+
+
+def request_finalize(upload, book=None):
+    """
+    Have the task worker verify a fully received upload, attaching it to
+    book once it checks out.
+
+    Hashing a file of up to CHUNKED_UPLOAD_MAX_SIZE takes too long for a
+    request, so the upload is only marked verifying here. It moves on to
+    complete (or attached) or failed, which the client polls for. An upload
+    verified already is attached straight away.
+    """
+    if upload.status == ChunkedUpload.FAILED:
+        raise UploadError(upload.error, 422)
+    if upload.status == ChunkedUpload.ATTACHED:
+        if book is not None:
+            raise UploadError('This upload is already attached', 409)
+        return upload
+    if upload.status == ChunkedUpload.COMPLETE:
+        if book is not None:
+            attach_upload(upload, book)
+        return upload
+    if upload.received != upload.size:
+        raise UploadError(f'Only {upload.received} of {upload.size} bytes received', 409)
+    ChunkedUpload.objects.filter(pk=upload.pk, status=ChunkedUpload.UPLOADING).update(
+        status=ChunkedUpload.VERIFYING, updated_at=timezone.now(),
+    )
+    upload.status = ChunkedUpload.VERIFYING
+    tasks.enqueue(
+        'finalize_upload', dedup_key=f'finalize_upload:{upload.pk}',
+        upload_id=str(upload.pk), book_id=book.pk if book is not None else None,
+    )
+    return upload
+
+
+def finalize_upload(upload):
+    """
+    Check the size and whole-file SHA-256 of a fully received upload.
+
+    Runs in the task worker. A checksum mismatch marks the upload failed
+    with the reason in error.
+    """
+    if upload.status not in (ChunkedUpload.UPLOADING, ChunkedUpload.VERIFYING):
+        return upload
+    if upload.received != upload.size:
+        raise UploadError(f'Only {upload.received} of {upload.size} bytes received', 409)
+    digest = hashlib.sha256()
+    with open(temp_path(upload), 'rb') as part:
+        for block in iter(lambda: part.read(COPY_BLOCK_SIZE * 16), b''):
+            digest.update(block)
+    if upload.expected_sha256 and digest.hexdigest() != upload.expected_sha256:
+        upload.status = ChunkedUpload.FAILED
+        upload.error = 'File checksum mismatch, start the upload again'
+        upload.save(update_fields=['status', 'error', 'updated_at'])
+        return upload
+    upload.sha256 = digest.hexdigest()
+    upload.status = ChunkedUpload.COMPLETE
+    upload.save(update_fields=['sha256', 'status', 'updated_at'])
+    return upload
+
+
+def attach_upload(upload, book):
+    """
+    Move a finished upload into book.pdf.
+
+    The temp file is renamed into storage and the book saved in one
+    transaction, so a failure leaves either the old PDF or the new one,
+    never a half written file.
+    """
+    if upload.status != ChunkedUpload.COMPLETE:
+        raise UploadError('The upload is not complete', 409)
+    field = book.pdf.field
+    with open(temp_path(upload), 'rb') as part:
+        name = field.storage.save(field.generate_filename(book, upload.filename), _UploadedFile(part, upload.sha256))
+    try:
+        with transaction.atomic():
+            book.pdf.name = name
+            book.save(update_fields=['pdf', 'updated_at'])
+            upload.status = ChunkedUpload.ATTACHED
+            upload.save(update_fields=['status', 'updated_at'])
+    except Exception:
+        field.storage.delete(name)
+        raise
+    return book
+
+
+def purge_stale_uploads():
+    """Delete uploads untouched for UPLOAD_EXPIRY with their temp files, returns how many"""
+    stale = ChunkedUpload.objects.filter(updated_at__lt=timezone.now() - UPLOAD_EXPIRY)
+    purged = 0
+    for upload in stale:
+        try:
+            os.remove(temp_path(upload))
+        except FileNotFoundError:
+            pass
+        upload.delete()
+        purged += 1
+    return purged
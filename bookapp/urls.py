@@ -6,10 +6,17 @@ urlpatterns = [
 	path('genre/<str:slug>/', views.category_detail, name = 'category_detail'),
 	path('book/<str:slug>/', views.book_detail, name = 'book_detail'),
 	path('book/<str:slug>/review/', views.add_review, name = 'add_review'),
+	path('book/<str:slug>/reviews/', views.book_reviews, name = 'book_reviews'),
 	path('book/<str:slug>/read/', views.read_book, name = 'read_book'),
+	path('book/<str:slug>/pdf/', views.book_pdf, name = 'book_pdf'),
 	path('dashboard/', views.dashboard, name = 'dashboard'),
 	path('search/', views.search_book, name = 'book_search'),
+	path('search/pages/', views.page_search, name = 'page_search'),
+	path('suggest/', views.book_suggest, name = 'book_suggest'),
 	path('upload/', views.upload_book, name = 'upload_book'),
+	path('uploads/', views.upload_start, name = 'upload_start'),
+	path('uploads/<uuid:upload_id>/', views.upload_chunk, name = 'upload_chunk'),
+	path('uploads/<uuid:upload_id>/finalize/', views.upload_finalize, name = 'upload_finalize'),
 	path('register/', views.register_page, name = 'register'),
 	path('login/', views.login_page, name = 'login'),
 	path('logout/', views.logout_user, name = 'logout'),
@@ -1,6 +1,12 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
 def get_category_icon(category_name):
     """
     Returns appropriate Font Awesome icon for each category
+
+    Results are memoized per name, so the partial match scan runs once.
     """
     icon_mapping = {
         'fiction': 'fas fa-magic',
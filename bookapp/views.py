@@ -1,88 +1,116 @@
 
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import Book, Category, NewsletterSubscription, BookRating, BookReview, UserProfile
+from .models import Book, Category, NewsletterSubscription, BookRating, BookReview, UserProfile, AuthorStats, ChunkedUpload
 from django.contrib.auth.forms import UserCreationForm
 from .forms import CreateUserForm, BookUploadForm
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
-from django.http import JsonResponse
+from django.http import JsonResponse, Http404
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_POST, require_http_methods
+from django.views.decorators.clickjacking import xframe_options_sameorigin
 import os
 import re
 from django.utils import timezone
 import json
-from django.db import models
+from django.db import models, transaction
+from django.utils.safestring import mark_safe
+from .catalog import render_home_sections, get_catalog_book_count, get_catalog_authors, get_category_links
+from . import search
+from .suggest import suggest_books
+from django.urls import reverse
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control
+from .pagination import paginate_keyset
+from .aggregates import rate_book, review_book
+from .similarity import get_similar_books
+from .recommendations import get_co_rated_books, get_recommended_books
+from .utils import get_category_icon
+from .conditional import conditional_page, catalog_etag, catalog_last_modified, book_etag
+from .delivery import serve_file
+from . import uploads
+from .routers import replica_reads
 
 # Create your views here.
 
 
+@replica_reads
+@conditional_page(catalog_etag, catalog_last_modified)
 def home(request):
-	"""Discription goes here
+	"""Home page with the recommended, fiction and business sections.
+
+	The sections are rendered once per catalog version and served from cache.
 	"""
-	recommended_books = Book.objects.filter(recommended_books=True)
-	fiction_books = Book.objects.filter(fiction_books=True)
-	business_books = Book.objects.filter(business_books=True)
-	
-	# If no specific books are found, show some general books
-	if not recommended_books.exists():
-		recommended_books = Book.objects.all()[:6]
-	if not fiction_books.exists():
-		fiction_books = Book.objects.all()[:6]
-	if not business_books.exists():
-		business_books = Book.objects.all()[:6]
-	
-	# Debug logging
-	print(f"DEBUG: Home view - Recommended: {recommended_books.count()}, Fiction: {fiction_books.count()}, Business: {business_books.count()}")
-	
-	# Debug image status for each book
-	for book in recommended_books:
-		if book.cover_image:
-			print(f"DEBUG: Recommended book {book.title} - Image: {book.cover_image.url}, Exists: {os.path.exists(book.cover_image.path)}")
-		else:
-			print(f"DEBUG: Recommended book {book.title} - NO IMAGE")
-	
-	for book in fiction_books:
-		if book.cover_image:
-			print(f"DEBUG: Fiction book {book.title} - Image: {book.cover_image.url}, Exists: {os.path.exists(book.cover_image.path)}")
-		else:
-			print(f"DEBUG: Fiction book {book.title} - NO IMAGE")
-	
-	for book in business_books:
-		if book.cover_image:
-			print(f"DEBUG: Business book {book.title} - Image: {book.cover_image.url}, Exists: {os.path.exists(book.cover_image.path)}")
-		else:
-			print(f"DEBUG: Business book {book.title} - NO IMAGE")
-	
-	return render(request, 'home.html', {'recommended_books':recommended_books,
-	'fiction_books': fiction_books, 'business_books': business_books
-	})
+	return render(request, 'home.html', {'home_sections': mark_safe(render_home_sections())})
+
+ALL_BOOKS_PAGE_SIZE = 24
 
+@replica_reads
+@conditional_page(catalog_etag, catalog_last_modified)
 def all_books(request):
-	books = Book.objects.all()
-	print(f"DEBUG: Found {books.count()} books in database")
-	for book in books:
-		print(f"DEBUG: Book: {book.title} - {book.author}")
-		if book.cover_image:
-			print(f"DEBUG: Book {book.title} has cover image: {book.cover_image.url}")
-			print(f"DEBUG: Image path: {book.cover_image.path}")
-			print(f"DEBUG: Image exists: {os.path.exists(book.cover_image.path)}")
-		else:
-			print(f"DEBUG: Book {book.title} has NO cover image")
-	return render(request, 'all_books.html', {'books':books})
+	"""Browse the whole catalog newest first, one keyset page at a time"""
+	page = paginate_keyset(
+		Book.objects.prefetch_related('category'),
+		after=request.GET.get('after'),
+		before=request.GET.get('before'),
+		page_size=ALL_BOOKS_PAGE_SIZE,
+	)
+	return render(request, 'all_books.html', {'books': page, 'total_books': get_catalog_book_count()})
 
+@conditional_page(catalog_etag, catalog_last_modified)
 def category_detail(request, slug):
-	category = Category.objects.get(slug = slug)
-	return render(request, 'genre_detail.html', {'category': category})
+	category = get_object_or_404(Category, slug=slug)
+	category.icon = get_category_icon(category.name)
+	# The genre's books and the categories each one shows, in two queries
+	books = list(category.book_set.prefetch_related('category').order_by('-created_at', '-id'))
+	for book in books:
+		for book_category in book.category.all():
+			book_category.icon = get_category_icon(book_category.name)
+	return render(request, 'genre_detail.html', {'category': category, 'books': books})
 
+@replica_reads
 @login_required(login_url='login')
+@conditional_page(book_etag)
 def book_detail(request, slug):
+	book = get_object_or_404(Book.objects.select_related('pdf_document'), slug=slug)
+	similar_books = get_similar_books(book)
+	for similar_book in similar_books:
+		for category in similar_book.category.all():
+			category.icon = get_category_icon(category.name)
+	return render(request, 'book_detail.html', {
+		'book': book,
+		'similar_books': similar_books,
+		'co_rated_books': get_co_rated_books(book),
+		'reviews': paginate_keyset(public_reviews(book), page_size=REVIEW_PAGE_SIZE),
+	})
+
+REVIEW_PAGE_SIZE = 10
+
+def public_reviews(book):
+	"""A book's public reviews with the reviewer, their profile and their rating in one query"""
+	rating = (
+		BookRating.objects.filter(user=models.OuterRef('user'), book=models.OuterRef('book'))
+		.order_by().values('rating')[:1]
+	)
+	# is_public=True compiles to a bare column test on SQLite, which cannot
+	# seek the (book, is_public, created_at) index, an equality can
+	return (
+		BookReview.objects.filter(book=book, is_public__in=[True])
+		.select_related('user__profile')
+		.annotate(rating=models.Subquery(rating))
+	)
+
+@login_required(login_url='login')
+def book_reviews(request, slug):
+	"""Further pages of a book's reviews as rendered HTML for the load more button"""
 	book = get_object_or_404(Book, slug=slug)
-	book_category = book.category.first()
-	similar_books = Book.objects.filter(category__name__startswith = book_category)
-	return render(request, 'book_detail.html', {'book': book, 'similar_books': similar_books})
+	reviews = paginate_keyset(public_reviews(book), after=request.GET.get('after'), page_size=REVIEW_PAGE_SIZE)
+	return JsonResponse({
+		'html': render_to_string('review_items.html', {'reviews': reviews}, request=request),
+		'next_cursor': reviews.next_cursor,
+	})
 
 @login_required(login_url='login')
 def add_review(request, slug):
@@ -93,24 +121,9 @@ def add_review(request, slug):
         review_title = request.POST.get('review_title')
         review_content = request.POST.get('review_content')
         
-        if rating and review_title and review_content:
-            # Create or update rating
-            rating_obj, created = BookRating.objects.get_or_create(
-                user=request.user,
-                book=book,
-                defaults={'rating': rating}
-            )
-            if not created:
-                rating_obj.rating = rating
-                rating_obj.save()
-            
-            # Create review
-            review = BookReview.objects.create(
-                user=request.user,
-                book=book,
-                title=review_title,
-                content=review_content
-            )
+        if rating in ('1', '2', '3', '4', '5') and review_title and review_content:
+            rate_book(request.user, book, int(rating))
+            review_book(request.user, book, review_title, review_content)
             
             messages.success(request, 'Your review has been submitted successfully!')
         else:
@@ -124,31 +137,40 @@ def read_book(request, slug):
     book = get_object_or_404(Book, slug=slug)
     return render(request, 'read_book.html', {'book': book})
 
+@login_required(login_url='login')
+@xframe_options_sameorigin
+def book_pdf(request, slug):
+    """Stream a book's PDF to signed in readers, with Range support for the viewer"""
+    book = get_object_or_404(Book.objects.only('id', 'slug', 'pdf'), slug=slug)
+    if not book.pdf:
+        raise Http404('This book has no PDF')
+    return serve_file(
+        request, book.pdf, 'application/pdf', f'{book.slug}.pdf',
+        as_attachment='download' in request.GET,
+    )
+
 @login_required(login_url='login')
 def dashboard(request):
     """User dashboard based on user type"""
     user = request.user
     
     if hasattr(user, 'profile') and user.profile.user_type == 'writer':
-        # Writer dashboard
-        uploaded_books = Book.objects.filter(author=user.username).order_by('-created_at')
-        total_books = uploaded_books.count()
-        total_ratings = sum(book.rating_count for book in uploaded_books)
-        total_reviews = sum(book.review_count for book in uploaded_books)
-        average_rating = uploaded_books.aggregate(avg_rating=models.Avg('ratings__rating'))['avg_rating'] or 0
+        # Writer dashboard, totals come from the author rollup
+        stats = AuthorStats.objects.filter(author=user.username).first() or AuthorStats(author=user.username)
+        uploaded_books = list(Book.objects.filter(author=user.username).order_by('-created_at'))
         
         context = {
             'user_type': 'writer',
             'uploaded_books': uploaded_books,
-            'total_books': total_books,
-            'total_ratings': total_ratings,
-            'total_reviews': total_reviews,
-            'average_rating': round(average_rating, 1),
+            'total_books': stats.book_count,
+            'total_ratings': stats.rating_count,
+            'total_reviews': stats.review_count,
+            'average_rating': round(stats.average_rating, 1),
         }
     else:
         # Reader dashboard
-        user_ratings = BookRating.objects.filter(user=user).order_by('-created_at')
-        user_reviews = BookReview.objects.filter(user=user).order_by('-created_at')
+        user_ratings = BookRating.objects.filter(user=user).select_related('book').order_by('-created_at')
+        user_reviews = BookReview.objects.filter(user=user).select_related('user', 'book').order_by('-created_at')
         total_books_read = user_ratings.count()
         total_reviews_written = user_reviews.count()
         average_rating_given = user_ratings.aggregate(avg_rating=models.Avg('rating'))['avg_rating'] or 0
@@ -164,10 +186,14 @@ def dashboard(request):
             'total_reviews_written': total_reviews_written,
             'average_rating_given': round(average_rating_given, 1),
             'recently_read': recently_read,
+            'recommended_books': get_recommended_books(user),
         }
     
     return render(request, 'dashboard.html', context)
 
+SEARCH_RESULT_LIMIT = 200
+
+@replica_reads
 def search_book(request):
     """Enhanced search with filters"""
     if request.method == 'POST':
@@ -182,26 +208,42 @@ def search_book(request):
     
     # Start with all books
     books = Book.objects.all()
+    snippets = {}
     
     # Apply search filters
-    if query:
-        books = books.filter(
-            models.Q(title__icontains=query) |
-            models.Q(author__icontains=query) |
-            models.Q(summary__icontains=query)
-        )
-    
-    if category_filter:
-        books = books.filter(category__name__icontains=category_filter)
+    if query and search.search_index_available():
+        # The index applies the filters itself, before it cuts off the ranking
+        snippets = dict(search.search_books(
+            query, limit=SEARCH_RESULT_LIMIT, category=category_filter, author=author_filter,
+        ))
+        books = books.filter(id__in=snippets)
+    else:
+        if query:
+            books = books.filter(
+                models.Q(title__icontains=query) |
+                models.Q(author__icontains=query) |
+                models.Q(summary__icontains=query)
+            )
+        
+        if category_filter:
+            books = books.filter(category__name__icontains=category_filter).distinct()
+        
+        if author_filter:
+            books = books.filter(author__icontains=author_filter)
     
-    if author_filter:
-        books = books.filter(author__icontains=author_filter)
+    books = list(books.prefetch_related('category')[:SEARCH_RESULT_LIMIT])
+    if snippets:
+        # Keep the BM25 ranking from the index
+        rank = {book_id: position for position, book_id in enumerate(snippets)}
+        books.sort(key=lambda book: rank[book.pk])
+        for book in books:
+            book.search_snippet = snippets[book.pk]
     
     # Get all categories for filter dropdown
-    categories = Category.objects.all()
+    categories = get_category_links()
     
     # Get unique authors for filter dropdown
-    authors = Book.objects.values_list('author', flat=True).distinct()
+    authors = get_catalog_authors()
     
     context = {
         'searched_books': books,
@@ -214,6 +256,45 @@ def search_book(request):
     
     return render(request, 'search_book.html', context)
 
+PAGE_SEARCH_LIMIT = 50
+
+@login_required(login_url='login')
+def page_search(request):
+    """Passages in extracted PDF pages, across the catalog or inside ?book=<slug>"""
+    query = request.GET.get('q', '')[:200]
+    book_id = None
+    if request.GET.get('book'):
+        book_id = get_object_or_404(Book.objects.only('id'), slug=request.GET['book']).pk
+    matches = search.search_pages(query, book_id=book_id, limit=PAGE_SEARCH_LIMIT)
+    books = Book.objects.only('id', 'title', 'author', 'slug').in_bulk({match[0] for match in matches})
+    results = [
+        {
+            'title': books[match_book].title,
+            'author': books[match_book].author,
+            'page': number,
+            'snippet': snippet,
+            'url': f"{reverse('read_book', args=[books[match_book].slug])}#page={number}",
+        }
+        for match_book, number, snippet in matches
+        if match_book in books
+    ]
+    return JsonResponse({'query': query, 'results': results})
+
+def book_suggest(request):
+    """Typeahead suggestions for the navbar search box"""
+    query = request.GET.get('q', '')[:100]
+    suggestions = [
+        {
+            'title': book['title'],
+            'author': book['author'],
+            'url': reverse('book_detail', args=[book['slug']]),
+        }
+        for book in suggest_books(query)
+    ]
+    response = JsonResponse({'query': query, 'suggestions': suggestions})
+    patch_cache_control(response, public=True, max_age=60)
+    return response
+
 def register_page(request):
 	register_form = CreateUserForm()
 	if request.method == 'POST':
@@ -264,6 +345,13 @@ def upload_book(request):
     """Upload a new book"""
     if request.method == 'POST':
         form = BookUploadForm(request.POST, request.FILES)
+        pdf_upload = None
+        if form.is_valid() and form.cleaned_data['pdf_upload']:
+            pdf_upload = ChunkedUpload.objects.filter(
+                pk=form.cleaned_data['pdf_upload'], user=request.user, status=ChunkedUpload.COMPLETE,
+            ).first()
+            if pdf_upload is None:
+                form.add_error('pdf', 'The uploaded PDF could not be found, please choose it again.')
         if form.is_valid():
             book = form.save(commit=False)
             
@@ -278,18 +366,26 @@ def upload_book(request):
             book.business_books = any(cat.name.lower() == 'business' for cat in categories)
             
             # Add PDFDrive.com link if no PDF is uploaded
-            if not book.pdf:
+            if not book.pdf and pdf_upload is None:
                 import urllib.parse
                 clean_title = book.title.replace(':', '').replace('(', '').replace(')', '')
                 clean_title = ' '.join(clean_title.split())
                 encoded_title = urllib.parse.quote(clean_title)
                 book.pdf_url = f'https://www.welib.org/search?q={encoded_title}'
             
-            book.save()
-            form.save_m2m()  # Save many-to-many relationships
-            
-            messages.success(request, f'Book "{book.title}" uploaded successfully!')
-            return redirect('book_detail', slug=book.slug)
+            try:
+                # A book whose PDF cannot be attached is not created at all
+                with transaction.atomic():
+                    book.save()
+                    form.save_m2m()  # Save many-to-many relationships
+                    if pdf_upload is not None:
+                        uploads.attach_upload(pdf_upload, book)
+            except uploads.UploadError as error:
+                form.add_error('pdf', str(error))
+                messages.error(request, 'Please correct the errors below.')
+            else:
+                messages.success(request, f'Book "{book.title}" uploaded successfully!')
+                return redirect('book_detail', slug=book.slug)
         else:
             messages.error(request, 'Please correct the errors below.')
     else:
@@ -297,6 +393,84 @@ def upload_book(request):
     
     return render(request, 'upload_book.html', {'form': form})
 
+def _upload_error(error):
+    return JsonResponse({'error': str(error)}, status=error.status)
+
+def _upload_state(upload):
+    return {
+        'id': str(upload.pk),
+        'offset': upload.received,
+        'size': upload.size,
+        'status': upload.status,
+        'error': upload.error,
+        'sha256': upload.sha256,
+        'chunk_size': uploads.CHUNK_SIZE,
+        'url': reverse('upload_chunk', args=[upload.pk]),
+    }
+
+@login_required(login_url='login')
+@require_POST
+def upload_start(request):
+    """Open a resumable upload: {filename, size, sha256?}"""
+    try:
+        data = json.loads(request.body)
+        upload = uploads.start_upload(
+            request.user, str(data['filename']), int(data['size']), str(data.get('sha256', '')),
+        )
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'filename and size are required'}, status=400)
+    except uploads.UploadError as error:
+        return _upload_error(error)
+    return JsonResponse(_upload_state(upload), status=201)
+
+@login_required(login_url='login')
+@require_http_methods(['GET', 'PUT'])
+def upload_chunk(request, upload_id):
+    """GET reports how far an upload got, PUT ?offset=N appends the request body there"""
+    upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+    if request.method == 'PUT':
+        try:
+            offset = int(request.GET.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return JsonResponse({'error': 'offset and Content-Length are required'}, status=400)
+        try:
+            upload.received = uploads.write_chunk(
+                upload, offset, request, length, request.headers.get('X-Chunk-SHA256', ''),
+            )
+        except uploads.UploadError as error:
+            response = _upload_error(error)
+            response['Upload-Offset'] = str(upload.received)
+            return response
+    response = JsonResponse(_upload_state(upload))
+    response['Upload-Offset'] = str(upload.received)
+    patch_cache_control(response, no_store=True)
+    return response
+
+@login_required(login_url='login')
+@require_POST
+def upload_finalize(request, upload_id):
+    """Have a fully sent upload verified, with {book: slug} it then also replaces that book's PDF"""
+    upload = get_object_or_404(ChunkedUpload, pk=upload_id, user=request.user)
+    book_slug = request.POST.get('book')
+    if request.content_type == 'application/json':
+        try:
+            book_slug = json.loads(request.body).get('book')
+        except (ValueError, AttributeError):
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    book = None
+    if book_slug:
+        book = get_object_or_404(Book, slug=book_slug)
+        if not (request.user.is_staff or book.author == request.user.username):
+            return JsonResponse({'error': 'You can only replace the PDF of your own books'}, status=403)
+    try:
+        uploads.request_finalize(upload, book)
+    except uploads.UploadError as error:
+        return _upload_error(error)
+    # Still verifying in the worker, the client polls the upload for the outcome
+    status = 202 if upload.status == ChunkedUpload.VERIFYING else 200
+    return JsonResponse(_upload_state(upload), status=status)
+
 def media_test(request):
     """Simple view to test media file serving"""
     from django.http import HttpResponse